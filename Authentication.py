@@ -10,7 +10,7 @@
 ## Licensing unclear/undetermined
 #############################################
 
-import requests
+import http_utils
 #from pyquery import PyQuery as pq
 import lxml.html as lh
 from lxml.html import fromstring
@@ -34,7 +34,7 @@ class Authentication:
      #params = {'username': self.username,'password': self.password}
      params = {'apikey': self.apikey}
      h = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain", "User-Agent":"python" }
-     r = requests.post(uri+auth_endpoint,data=params,headers=h)
+     r = http_utils.post(uri+auth_endpoint,data=params,headers=h)
      response = fromstring(r.text)
      ## extract the entire URL needed from the HTML form (action attribute) returned - looks similar to https://utslogin.nlm.nih.gov/cas/v1/tickets/TGT-36471-aYqNLN2rFIJPXKzxwdTNC5ZT7z3B3cTAKfSc5ndHQcUxeaDOLN-cas
      ## we make a POST call to this URL in the getst method
@@ -45,7 +45,7 @@ class Authentication:
 
      params = {'service': self.service}
      h = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain", "User-Agent":"python" }
-     r = requests.post(tgt,data=params,headers=h)
+     r = http_utils.post(tgt,data=params,headers=h)
      st = r.text
      return st
    
@@ -0,0 +1,221 @@
+import logging as log
+
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib.parse import urlsplit
+
+import umls_utils as uu
+
+########################################################################
+## Asyncio front end for the UMLS look-ups in umls_utils.  Each call
+## runs the existing (pooled, cached) synchronous request code on a
+## worker thread, gated by a global concurrency limit and a per-host
+## limit so a whole frontier of CUIs can be resolved at once without
+## going over the request rate UTS allows us.
+########################################################################
+
+UTS_HOST = urlsplit( uu.UTS_URI ).hostname
+RXNAV_HOST = urlsplit( uu.RXNAV_URI ).hostname
+
+DEFAULT_CONCURRENCY = 20
+default_host_limits = { UTS_HOST : 20 ,
+                        RXNAV_HOST : 20 }
+
+
+class AsyncUmlsClient:
+    """
+    Same surface as the lookup functions in umls_utils, minus the
+    `auth_client` argument, as coroutines.  `backend` may be any
+    object exposing those functions (umls_utils by default).
+    """
+
+    def __init__( self , backend = uu , auth_client = None ,
+                  max_concurrency = DEFAULT_CONCURRENCY ,
+                  host_limits = None ):
+        self.backend = backend
+        self.auth_client = auth_client
+        self.max_concurrency = max( 1 , int( max_concurrency ) )
+        self.host_limits = dict( default_host_limits )
+        if( host_limits is not None ):
+            self.host_limits.update( host_limits )
+        self.executor = ThreadPoolExecutor( max_workers = self.max_concurrency )
+        self._loop = None
+        self._global_limit = None
+        self._host_limit = {}
+
+    def close( self ):
+        self.executor.shutdown( wait = True )
+
+    def _limits( self , host ):
+        ## Semaphores belong to the event loop they were created on,
+        ## so rebuild them whenever we are driven by a new loop
+        loop = asyncio.get_running_loop()
+        if( loop is not self._loop ):
+            self._loop = loop
+            self._global_limit = asyncio.Semaphore( self.max_concurrency )
+            self._host_limit = {}
+        if( host not in self._host_limit ):
+            self._host_limit[ host ] = asyncio.Semaphore( self.host_limits.get( host ,
+                                                                                self.max_concurrency ) )
+        return( self._global_limit , self._host_limit[ host ] )
+
+    async def _call( self , host , func , *args , **kwargs ):
+        global_limit , host_limit = self._limits( host )
+        async with global_limit:
+            async with host_limit:
+                return( await self._loop.run_in_executor( self.executor ,
+                                                          functools.partial( func , *args , **kwargs ) ) )
+
+    ####################################################################
+
+    async def get_cuis_preferred_atom( self , version , identifier ):
+        return( await self._call( UTS_HOST , self.backend.get_cuis_preferred_atom ,
+                                  self.auth_client , version , identifier ) )
+
+    async def get_cuis_atom( self , version , identifier , atom_type ):
+        return( await self._call( UTS_HOST , self.backend.get_cuis_atom ,
+                                  self.auth_client , version , identifier , atom_type ) )
+
+    async def get_cuis_eng_atom( self , version , identifier ):
+        return( await self._call( UTS_HOST , self.backend.get_cuis_eng_atom ,
+                                  self.auth_client , version , identifier ) )
+
+    async def get_typed_relation( self , version , identifier ,
+                                  target_relation_type , target_relation_label ):
+        return( await self._call( UTS_HOST , self.backend.get_typed_relation ,
+                                  self.auth_client , version , identifier ,
+                                  target_relation_type , target_relation_label ) )
+
+    async def get_rbs( self , version , identifier ):
+        return( await self._call( UTS_HOST , self.backend.get_rbs ,
+                                  self.auth_client , version , identifier ) )
+
+    async def get_rns( self , version , identifier ):
+        return( await self._call( UTS_HOST , self.backend.get_rns ,
+                                  self.auth_client , version , identifier ) )
+
+    async def get_ros( self , version , identifier ):
+        return( await self._call( UTS_HOST , self.backend.get_ros ,
+                                  self.auth_client , version , identifier ) )
+
+    async def get_family_tree( self , version , identifier ,
+                               relation_type , root_source = 'SNOMEDCT_US' ):
+        return( await self._call( UTS_HOST , self.backend.get_family_tree ,
+                                  self.auth_client , version , identifier ,
+                                  relation_type , root_source = root_source ) )
+
+    async def get_concept_bundle( self , version , identifier ):
+        return( await self._call( UTS_HOST , self.backend.get_concept_bundle ,
+                                  self.auth_client , version , identifier ) )
+
+    async def get_cui( self , version , identifier , source ):
+        return( await self._call( UTS_HOST , self.backend.get_cui ,
+                                  self.auth_client , version , identifier , source ) )
+
+    ####################################################################
+
+    async def get_concept_details( self , version , cui ):
+        """
+        (preferred term, TUI, ENG atoms) for a CUI, matching what
+        spreadsheet_utils.flesh_out_seed_concept stores.
+        """
+        return( concept_details( await self.get_concept_bundle( version , cui ) ) )
+
+    async def get_snomed_children( self , version , concept_id ):
+        """
+        [ ( child concept id , CUI ) ] for the children of a SNOMED CT
+        concept, sorted by concept id
+        """
+        child_ids = sorted( await self.get_family_tree( version , concept_id , 'children' ) )
+        cuis = await asyncio.gather( *[ self.get_cui( version , child_id , 'SNOMEDCT_US' )
+                                        for child_id in child_ids ] )
+        return( list( zip( child_ids , cuis ) ) )
+
+    async def fetch_frontier( self , version , details_cuis , rb_cuis ):
+        """
+        Resolve a whole BFS frontier at once.  Returns two dicts keyed
+        by CUI:  the concept details for `details_cuis` and the RB
+        relations for `rb_cuis`.
+        """
+        details , rbs , snomed = await self.fetch_level( version , details_cuis , rb_cuis , [] )
+        return( details , rbs )
+
+    async def fetch_level( self , version , details_cuis , rb_cuis , snomed_ids ):
+        """
+        fetch_frontier plus, as a third dict keyed by concept id, the
+        get_snomed_children of `snomed_ids`, all resolved concurrently
+        """
+        details_cuis = list( details_cuis )
+        rb_cuis = list( rb_cuis )
+        snomed_ids = list( snomed_ids )
+        results = await asyncio.gather( *( [ self.get_concept_details( version , cui )
+                                             for cui in details_cuis ] +
+                                           [ self.get_rbs( version , cui )
+                                             for cui in rb_cuis ] +
+                                           [ self.get_snomed_children( version , concept_id )
+                                             for concept_id in snomed_ids ] ) )
+        details = dict( zip( details_cuis , results[ :len( details_cuis ) ] ) )
+        results = results[ len( details_cuis ): ]
+        rbs = dict( zip( rb_cuis , results[ :len( rb_cuis ) ] ) )
+        snomed = dict( zip( snomed_ids , results[ len( rb_cuis ): ] ) )
+        log.debug( 'Fetched frontier:  {} concepts , {} RB lists , {} SNOMED concepts'.format( len( details ) ,
+                                                                                             len( rbs ) ,
+                                                                                             len( snomed ) ) )
+        return( details , rbs , snomed )
+
+
+def concept_details( bundle ):
+    if( bundle is None ):
+        return( ( None , '' , set() ) )
+    tui = bundle.tuis[ 0 ] if bundle.tuis else None
+    return( ( bundle.name , tui , bundle.eng_atoms ) )
+
+
+def fetch_frontier( auth_client , details_cuis , rb_cuis ,
+                    concurrency = DEFAULT_CONCURRENCY , backend = uu ):
+    """
+    Synchronous entry point for `AsyncUmlsClient.fetch_frontier`.
+    Backends with batched look-ups (e.g., a local engine over an
+    indexed database) answer the whole frontier directly instead.
+    """
+    details , rbs , snomed = fetch_level( auth_client , details_cuis , rb_cuis , [] ,
+                                          concurrency = concurrency ,
+                                          backend = backend )
+    return( details , rbs )
+
+
+def fetch_level( auth_client , details_cuis , rb_cuis , snomed_ids ,
+                 concurrency = DEFAULT_CONCURRENCY , backend = uu ):
+    """
+    Synchronous entry point for `AsyncUmlsClient.fetch_level`
+    """
+    if( hasattr( backend , 'get_concept_bundles' ) ):
+        details_cuis = list( details_cuis )
+        bundles = backend.get_concept_bundles( auth_client , 'current' , details_cuis )
+        rbs = backend.get_typed_relations( auth_client , 'current' , list( rb_cuis ) , 'RB' )
+        snomed = {}
+        for concept_id in snomed_ids:
+            child_ids = sorted( backend.get_family_tree( auth_client , 'current' ,
+                                                         concept_id , 'children' ) )
+            child_cuis = backend.get_cuis( auth_client , 'current' , child_ids , 'SNOMEDCT_US' )
+            snomed[ concept_id ] = [ ( child_id , child_cuis[ child_id ] )
+                                     for child_id in child_ids ]
+        return( dict( ( cui , concept_details( bundles[ cui ] ) ) for cui in details_cuis ) ,
+                rbs , snomed )
+    client = AsyncUmlsClient( backend = backend ,
+                              auth_client = auth_client ,
+                              max_concurrency = concurrency )
+    try:
+        loop = asyncio.new_event_loop()
+        try:
+            return( loop.run_until_complete( client.fetch_level( 'current' ,
+                                                                 details_cuis ,
+                                                                 rb_cuis ,
+                                                                 snomed_ids ) ) )
+        finally:
+            loop.close()
+    finally:
+        client.close()
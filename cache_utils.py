@@ -0,0 +1,509 @@
+import logging as log
+
+import os
+import sys
+
+import argparse
+
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+
+########################################################################
+## Persistent on-disk cache for UTS and RxNav responses.  Entries are
+## keyed by the normalized endpoint + query parameters and namespaced
+## by the terminology release they came from (e.g., 'UMLS-2023AB') so
+## a new release never serves stale answers.
+########################################################################
+
+DEFAULT_TTL = 30 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+## Query parameters that identify the caller rather than the
+## question being asked.  They never take part in a cache key.
+auth_params = [ 'apiKey' , 'ticket' ]
+
+## How many writes to allow between checks on the total cache size
+EVICTION_CHECK_INTERVAL = 500
+
+## How many cache hits to note in memory before writing their access
+## times out together, so reads don't each cost a disk write
+ACCESS_FLUSH_INTERVAL = 256
+
+## Negative results ("this code maps to no CUI", "this CUI is gone")
+## expire sooner than ordinary responses in case a new release fills
+## them in
+DEFAULT_NEGATIVE_TTL = 7 * 24 * 60 * 60
+
+## Responses kept in memory in front of the on-disk cache
+DEFAULT_MEMORY_ENTRIES = int( os.environ.get( 'LEXICON_MEMORY_CACHE_SIZE' , 20000 ) )
+
+#############################################
+##
+#############################################
+
+def initialize_arg_parser():
+    parser = argparse.ArgumentParser( description = """
+    Inspect, prune, or clear the on-disk UTS/RxNav response cache
+    """ )
+    parser.add_argument( '-v' , '--verbose' ,
+                         help = "print more information" ,
+                         action = "store_true" )
+
+    parser.add_argument( '--cache-file' , required = True ,
+                         dest = 'cacheFile' ,
+                         help = 'SQLite file holding the response cache' )
+
+    parser.add_argument( '--namespace' , default = None ,
+                         dest = 'namespace' ,
+                         help = 'Limit the action (stats, prune or clear) to a single release namespace (e.g., UMLS-2023AB)' )
+
+    parser.add_argument( '--ttl-days' , default = None , type = float ,
+                         dest = 'ttlDays' ,
+                         help = 'Entries older than this many days are considered expired when pruning' )
+
+    parser.add_argument( '--negative-ttl-days' , default = None , type = float ,
+                         dest = 'negativeTtlDays' ,
+                         help = 'Negative results older than this many days are considered expired when pruning' )
+
+    parser.add_argument( '--max-mb' , default = None , type = float ,
+                         dest = 'maxMb' ,
+                         help = 'Evict least recently used entries until the cache is below this size when pruning' )
+
+    parser.add_argument( 'action' ,
+                         choices = [ 'stats' , 'prune' , 'clear' ] ,
+                         help = 'stats lists entries per namespace, prune drops expired entries and enforces the size bound, clear drops everything' )
+    ##
+    return parser
+
+#############################################
+##
+#############################################
+
+def cache_key( url , params = None ):
+    """
+    Normalize a request into a stable key:  the scheme/host/path plus
+    the sorted, non-authentication query parameters (whether they were
+    baked into the URL or passed separately).
+    """
+    parts = urlsplit( url )
+    query = [ pair for pair in parse_qsl( parts.query , keep_blank_values = True ) ]
+    if( params is not None ):
+        query += [ ( str( k ) , str( v ) ) for k , v in params.items() ]
+    query = sorted( pair for pair in query if pair[ 0 ] not in auth_params )
+    return( '{}://{}{}?{}'.format( parts.scheme , parts.netloc , parts.path ,
+                                   urlencode( query ) ) )
+
+
+class LRUCache:
+    """
+    Small thread-safe in-memory LRU map with hit/miss counters
+    """
+
+    def __init__( self , max_entries = DEFAULT_MEMORY_ENTRIES ):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__( self ):
+        return( len( self._entries ) )
+
+    def get( self , key ):
+        with self._lock:
+            if( key not in self._entries ):
+                self.misses += 1
+                return( None )
+            self._entries.move_to_end( key )
+            self.hits += 1
+            return( self._entries[ key ] )
+
+    def put( self , key , value ):
+        if( self.max_entries <= 0 ):
+            return
+        with self._lock:
+            self._entries[ key ] = value
+            self._entries.move_to_end( key )
+            while( len( self._entries ) > self.max_entries ):
+                self._entries.popitem( last = False )
+
+    def clear( self ):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class _Flight:
+
+    def __init__( self ):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key:  the first caller runs
+    the function and everyone who asks for that key while it is still
+    running waits for, and shares, its result (or exception).
+    """
+
+    def __init__( self ):
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do( self , key , func ):
+        with self._lock:
+            flight = self._flights.get( key )
+            leader = flight is None
+            if( leader ):
+                flight = _Flight()
+                self._flights[ key ] = flight
+            else:
+                self.shared += 1
+        if( not leader ):
+            flight.done.wait()
+            if( flight.error is not None ):
+                raise flight.error
+            return( flight.result )
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[ key ]
+            flight.done.set()
+        return( flight.result )
+
+
+class NegativeCache:
+    """
+    Remembers look-ups that came back empty, keyed by (namespace, kind,
+    identifier), with their own TTL.  Always kept in memory for the
+    current run; also persisted to `filename` (usually the response
+    cache file) when one is given.  Hits and stores are counted per
+    kind for the run stats.
+    """
+
+    def __init__( self , filename = None , ttl = DEFAULT_NEGATIVE_TTL ):
+        self.filename = filename
+        self.ttl = ttl
+        self.hits = {}
+        self.stores = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.conn = None
+        if( filename is not None ):
+            self.conn = sqlite3.connect( filename , timeout = 60 ,
+                                         check_same_thread = False )
+            self.conn.execute( 'PRAGMA journal_mode=WAL' )
+            self.conn.execute( '''CREATE TABLE IF NOT EXISTS negatives (
+                                    namespace TEXT NOT NULL ,
+                                    kind TEXT NOT NULL ,
+                                    identifier TEXT NOT NULL ,
+                                    created REAL NOT NULL ,
+                                    PRIMARY KEY ( namespace , kind , identifier ) )''' )
+            self.conn.commit()
+
+    def close( self ):
+        with self._lock:
+            if( self.conn is not None ):
+                self.conn.close()
+                self.conn = None
+
+    def _expired( self , created , now ):
+        return( self.ttl is not None and now - created > self.ttl )
+
+    def contains( self , namespace , kind , identifier ):
+        now = time.time()
+        entry = ( namespace , kind , identifier )
+        with self._lock:
+            created = self._entries.get( entry )
+            if( created is None and self.conn is not None ):
+                row = self.conn.execute( '''SELECT created FROM negatives
+                                            WHERE namespace = ? AND kind = ? AND identifier = ?''' ,
+                                         entry ).fetchone()
+                if( row is not None ):
+                    created = row[ 0 ]
+                    self._entries[ entry ] = created
+            if( created is None ):
+                return( False )
+            if( self._expired( created , now ) ):
+                del self._entries[ entry ]
+                if( self.conn is not None ):
+                    self.conn.execute( '''DELETE FROM negatives
+                                          WHERE namespace = ? AND kind = ? AND identifier = ?''' ,
+                                       entry )
+                    self.conn.commit()
+                return( False )
+            self.hits[ kind ] = self.hits.get( kind , 0 ) + 1
+        return( True )
+
+    def add( self , namespace , kind , identifier ):
+        now = time.time()
+        entry = ( namespace , kind , identifier )
+        with self._lock:
+            self._entries[ entry ] = now
+            self.stores[ kind ] = self.stores.get( kind , 0 ) + 1
+            if( self.conn is not None ):
+                self.conn.execute( '''INSERT OR REPLACE INTO negatives
+                                      ( namespace , kind , identifier , created )
+                                      VALUES ( ? , ? , ? , ? )''' ,
+                                   entry + ( now , ) )
+                self.conn.commit()
+
+    def prune( self , namespace = None ):
+        removed = 0
+        with self._lock:
+            now = time.time()
+            for entry in [ entry for entry , created in self._entries.items()
+                           if( self._expired( created , now ) and
+                               ( namespace is None or entry[ 0 ] == namespace ) ) ]:
+                del self._entries[ entry ]
+            if( self.conn is not None and self.ttl is not None ):
+                if( namespace is None ):
+                    cursor = self.conn.execute( 'DELETE FROM negatives WHERE created < ?' ,
+                                                ( now - self.ttl , ) )
+                else:
+                    cursor = self.conn.execute( 'DELETE FROM negatives WHERE created < ? AND namespace = ?' ,
+                                                ( now - self.ttl , namespace ) )
+                removed = cursor.rowcount
+                self.conn.commit()
+        return( removed )
+
+    def clear( self , namespace = None ):
+        removed = 0
+        with self._lock:
+            for entry in [ entry for entry in self._entries
+                           if namespace is None or entry[ 0 ] == namespace ]:
+                del self._entries[ entry ]
+            if( self.conn is not None ):
+                if( namespace is None ):
+                    cursor = self.conn.execute( 'DELETE FROM negatives' )
+                else:
+                    cursor = self.conn.execute( 'DELETE FROM negatives WHERE namespace = ?' ,
+                                                ( namespace , ) )
+                removed = cursor.rowcount
+                self.conn.commit()
+        return( removed )
+
+    def counts( self ):
+        with self._lock:
+            if( self.conn is not None ):
+                return( self.conn.execute( '''SELECT namespace , kind , COUNT(*) FROM negatives
+                                              GROUP BY namespace , kind
+                                              ORDER BY namespace , kind''' ).fetchall() )
+            counts = {}
+            for namespace , kind , identifier in self._entries:
+                counts[ ( namespace , kind ) ] = counts.get( ( namespace , kind ) , 0 ) + 1
+            return( sorted( key + ( count , ) for key , count in counts.items() ) )
+
+
+class ResponseCache:
+
+    def __init__( self , filename ,
+                  ttl = DEFAULT_TTL ,
+                  max_bytes = DEFAULT_MAX_BYTES ):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes_since_check = 0
+        ## ( namespace , key ) -> time of the latest hit not yet written
+        self._accessed = {}
+        self.conn = sqlite3.connect( filename , timeout = 60 ,
+                                     check_same_thread = False )
+        self.conn.execute( 'PRAGMA journal_mode=WAL' )
+        self.conn.execute( 'PRAGMA synchronous=NORMAL' )
+        self.conn.execute( '''CREATE TABLE IF NOT EXISTS responses (
+                                namespace TEXT NOT NULL ,
+                                key TEXT NOT NULL ,
+                                body TEXT NOT NULL ,
+                                created REAL NOT NULL ,
+                                accessed REAL NOT NULL ,
+                                size INTEGER NOT NULL ,
+                                PRIMARY KEY ( namespace , key ) )''' )
+        self.conn.execute( '''CREATE INDEX IF NOT EXISTS responses_accessed
+                                ON responses ( accessed )''' )
+        self.conn.commit()
+
+    def close( self ):
+        with self._lock:
+            self._flush_accessed()
+            self.conn.close()
+
+    def _flush_accessed( self ):
+        ## Caller must hold the lock
+        if( len( self._accessed ) == 0 ):
+            return
+        self.conn.executemany( '''UPDATE responses SET accessed = ?
+                                  WHERE namespace = ? AND key = ?''' ,
+                               [ ( accessed , namespace , key )
+                                 for ( namespace , key ) , accessed in self._accessed.items() ] )
+        self.conn.commit()
+        self._accessed = {}
+
+    def get( self , namespace , key ):
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute( '''SELECT body , created FROM responses
+                                        WHERE namespace = ? AND key = ?''' ,
+                                     ( namespace , key ) ).fetchone()
+            if( row is None ):
+                return( None )
+            body , created = row
+            if( self.ttl is not None and
+                now - created > self.ttl ):
+                self.conn.execute( 'DELETE FROM responses WHERE namespace = ? AND key = ?' ,
+                                   ( namespace , key ) )
+                self.conn.commit()
+                self._accessed.pop( ( namespace , key ) , None )
+                return( None )
+            self._accessed[ ( namespace , key ) ] = now
+            if( len( self._accessed ) >= ACCESS_FLUSH_INTERVAL ):
+                self._flush_accessed()
+        return( body )
+
+    def put( self , namespace , key , body ):
+        now = time.time()
+        with self._lock:
+            self.conn.execute( '''INSERT OR REPLACE INTO responses
+                                  ( namespace , key , body , created , accessed , size )
+                                  VALUES ( ? , ? , ? , ? , ? , ? )''' ,
+                               ( namespace , key , body , now , now ,
+                                 len( key ) + len( body ) ) )
+            self.conn.commit()
+            self._writes_since_check += 1
+            if( self._writes_since_check >= EVICTION_CHECK_INTERVAL ):
+                self._writes_since_check = 0
+                self._evict()
+
+    def total_bytes( self ):
+        with self._lock:
+            row = self.conn.execute( 'SELECT COALESCE( SUM( size ) , 0 ) FROM responses' ).fetchone()
+        return( row[ 0 ] )
+
+    def _evict( self , namespace = None ):
+        ## Caller must hold the lock.  With a namespace, only its
+        ## entries are evicted to get under the bound.
+        if( self.max_bytes is None ):
+            return( 0 )
+        self._flush_accessed()
+        total = self.conn.execute( 'SELECT COALESCE( SUM( size ) , 0 ) FROM responses' ).fetchone()[ 0 ]
+        if( total <= self.max_bytes ):
+            return( 0 )
+        ## Drop the least recently used entries until we are
+        ## comfortably (90%) below the limit
+        target = total - int( self.max_bytes * 0.9 )
+        freed = 0
+        evicted = 0
+        if( namespace is None ):
+            cursor = self.conn.execute( '''SELECT namespace , key , size FROM responses
+                                           ORDER BY accessed ASC''' )
+        else:
+            cursor = self.conn.execute( '''SELECT namespace , key , size FROM responses
+                                           WHERE namespace = ?
+                                           ORDER BY accessed ASC''' ,
+                                        ( namespace , ) )
+        doomed = []
+        for namespace , key , size in cursor:
+            if( freed >= target ):
+                break
+            doomed.append( ( namespace , key ) )
+            freed += size
+        for namespace , key in doomed:
+            self.conn.execute( 'DELETE FROM responses WHERE namespace = ? AND key = ?' ,
+                               ( namespace , key ) )
+            evicted += 1
+        self.conn.commit()
+        log.debug( 'Evicted {} cached responses ( {} bytes )'.format( evicted , freed ) )
+        return( evicted )
+
+    def prune( self , namespace = None ):
+        """
+        Drop expired entries and enforce the size bound (from the one
+        `namespace`, if given).  Returns the number of entries removed.
+        """
+        removed = 0
+        with self._lock:
+            if( self.ttl is not None ):
+                if( namespace is None ):
+                    cursor = self.conn.execute( 'DELETE FROM responses WHERE created < ?' ,
+                                                ( time.time() - self.ttl , ) )
+                else:
+                    cursor = self.conn.execute( 'DELETE FROM responses WHERE created < ? AND namespace = ?' ,
+                                                ( time.time() - self.ttl , namespace ) )
+                removed += cursor.rowcount
+                self.conn.commit()
+            removed += self._evict( namespace )
+        return( removed )
+
+    def clear( self , namespace = None ):
+        with self._lock:
+            if( namespace is None ):
+                cursor = self.conn.execute( 'DELETE FROM responses' )
+            else:
+                cursor = self.conn.execute( 'DELETE FROM responses WHERE namespace = ?' ,
+                                            ( namespace , ) )
+            self.conn.commit()
+        return( cursor.rowcount )
+
+    def stats( self ):
+        with self._lock:
+            rows = self.conn.execute( '''SELECT namespace , COUNT(*) , SUM( size ) ,
+                                                MIN( created ) , MAX( created )
+                                         FROM responses GROUP BY namespace
+                                         ORDER BY namespace''' ).fetchall()
+        return( rows )
+
+#############################################
+##
+#############################################
+
+if __name__ == "__main__":
+    ##
+    args = initialize_arg_parser().parse_args( sys.argv[ 1: ] )
+    if( not os.path.exists( args.cacheFile ) ):
+        log.error( 'The cache file does not exist:  {}'.format( args.cacheFile ) )
+        exit( 1 )
+    cache = ResponseCache( args.cacheFile ,
+                           ttl = DEFAULT_TTL if args.ttlDays is None else args.ttlDays * 24 * 60 * 60 ,
+                           max_bytes = None if args.maxMb is None else int( args.maxMb * 1024 * 1024 ) )
+    negatives = NegativeCache( args.cacheFile ,
+                               ttl = DEFAULT_NEGATIVE_TTL if args.negativeTtlDays is None else args.negativeTtlDays * 24 * 60 * 60 )
+    if( args.action == 'stats' ):
+        print( 'Namespace\tEntries\tBytes\tOldest\tNewest' )
+        for namespace , count , size , oldest , newest in cache.stats():
+            if( args.namespace is not None and
+                namespace != args.namespace ):
+                continue
+            print( '{}\t{}\t{}\t{}\t{}'.format( namespace , count , size ,
+                                                time.strftime( '%Y-%m-%d %H:%M:%S' ,
+                                                               time.localtime( oldest ) ) ,
+                                                time.strftime( '%Y-%m-%d %H:%M:%S' ,
+                                                               time.localtime( newest ) ) ) )
+        print( '\nNamespace\tNegative Kind\tEntries' )
+        for namespace , kind , count in negatives.counts():
+            if( args.namespace is not None and
+                namespace != args.namespace ):
+                continue
+            print( '{}\t{}\t{}'.format( namespace , kind , count ) )
+    elif( args.action == 'prune' ):
+        print( 'Pruned {} entries'.format( cache.prune( args.namespace ) ) )
+        print( 'Pruned {} negative results'.format( negatives.prune( args.namespace ) ) )
+    elif( args.action == 'clear' ):
+        print( 'Cleared {} entries'.format( cache.clear( args.namespace ) ) )
+        print( 'Cleared {} negative results'.format( negatives.clear( args.namespace ) ) )
+    negatives.close()
+    cache.close()
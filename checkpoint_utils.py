@@ -0,0 +1,316 @@
+import logging as log
+
+import os
+
+import glob
+import pickle
+import struct
+import zlib
+
+########################################################################
+## Crash-safe progress for long extraction runs.  Rather than pickling
+## the whole state after every CUI, each step appends just what it
+## changed to a journal, as a list of ops over named tables (dicts of
+## dicts, e.g., cui_dict and concepts):
+##
+##   ( 'set' , table , key , value )         -- table[ key ] = value
+##   ( 'update' , table , key , fields )     -- table[ key ].update( fields )
+##   ( 'add' , table , key , field , item )  -- table[ key ][ field ].add( item )
+##
+## Every so often the whole state is compacted into a snapshot and the
+## journal restarts.  Resuming loads the snapshot and replays the
+## journal on top of it.  Replaying an op twice is harmless.
+##
+## Files (in the partials directory):
+##   <name>.snapshot.pkl       -- { 'state' : ... , 'done' : ... }
+##   <name>.journal            -- ( stage , key , ops ) records since
+##   <name>.snapshot.prev.pkl  -- the snapshot and journal before
+##   <name>.journal.prev          those, kept as a fallback
+##
+## Snapshots and journal records are each framed with their length and
+## a CRC32, so a file cut short by a killed run is detected and skipped
+## rather than unpickled.
+########################################################################
+
+## Records written between fsyncs of the journal
+DEFAULT_SYNC_EVERY = 64
+## Records written between compacted snapshots
+DEFAULT_SNAPSHOT_EVERY = 5000
+
+## Payload length and CRC32 in front of every snapshot / record
+FRAME = struct.Struct( '<II' )
+SNAPSHOT_MAGIC = b'LXCKPT01'
+
+#############################################
+##
+#############################################
+
+def apply_ops( state , ops ):
+    for op in ops:
+        if( op[ 0 ] == 'set' ):
+            state[ op[ 1 ] ][ op[ 2 ] ] = op[ 3 ]
+        elif( op[ 0 ] == 'update' ):
+            state[ op[ 1 ] ].setdefault( op[ 2 ] , {} ).update( op[ 3 ] )
+        elif( op[ 0 ] == 'add' ):
+            state[ op[ 1 ] ].setdefault( op[ 2 ] , {} ).setdefault( op[ 3 ] , set() ).add( op[ 4 ] )
+        else:
+            raise ValueError( 'Unknown checkpoint op:  {}'.format( op[ 0 ] ) )
+
+
+def frame( payload ):
+    return( FRAME.pack( len( payload ) , zlib.crc32( payload ) ) + payload )
+
+
+def read_frame( fp ):
+    """
+    The next framed payload in `fp`, or None at the end of the file or
+    at a frame that is cut short or fails its checksum
+    """
+    header = fp.read( FRAME.size )
+    if( len( header ) < FRAME.size ):
+        return( None )
+    length , crc = FRAME.unpack( header )
+    payload = fp.read( length )
+    if( len( payload ) < length or
+        zlib.crc32( payload ) != crc ):
+        return( None )
+    return( payload )
+
+
+def read_journal( journal_file ):
+    """
+    The ( stage , key , ops ) records in a journal and the byte offset
+    just past the last good one (anything after it is a torn write
+    from a crash)
+    """
+    records = []
+    good_offset = 0
+    if( journal_file is None or
+        not os.path.exists( journal_file ) ):
+        return( records , good_offset )
+    with open( journal_file , 'rb' ) as fp:
+        while( True ):
+            payload = read_frame( fp )
+            if( payload is None ):
+                break
+            records.append( pickle.loads( payload ) )
+            good_offset = fp.tell()
+        if( good_offset < os.path.getsize( journal_file ) ):
+            log.warning( 'Ignoring a torn record at the end of {}'.format( journal_file ) )
+    return( records , good_offset )
+
+
+def write_snapshot( filename , payload ):
+    ## Written to the side first, so `filename` is only ever replaced
+    ## by a complete snapshot
+    partial_file = '{}.partial'.format( filename )
+    with open( partial_file , 'wb' ) as fp:
+        fp.write( SNAPSHOT_MAGIC )
+        fp.write( frame( pickle.dumps( payload , protocol = pickle.HIGHEST_PROTOCOL ) ) )
+        fp.flush()
+        os.fsync( fp.fileno() )
+    return( partial_file )
+
+
+def save_snapshot( filename , payload ):
+    os.replace( write_snapshot( filename , payload ) , filename )
+    return( filename )
+
+
+def read_snapshot( filename ):
+    """
+    The payload of a snapshot file, or None if it is missing or fails
+    its checksum
+    """
+    if( not os.path.exists( filename ) ):
+        return( None )
+    with open( filename , 'rb' ) as fp:
+        if( fp.read( len( SNAPSHOT_MAGIC ) ) != SNAPSHOT_MAGIC ):
+            log.warning( 'Skipping unrecognized snapshot:  {}'.format( filename ) )
+            return( None )
+        payload = read_frame( fp )
+    if( payload is None ):
+        log.warning( 'Skipping truncated or corrupt snapshot:  {}'.format( filename ) )
+        return( None )
+    return( pickle.loads( payload ) )
+
+#############################################
+##
+#############################################
+
+class ResumeManager:
+    """
+    Finds the newest consistent checkpoint in a partials directory and
+    says what is left to do.  Checked in order:
+
+      - the current snapshot plus its journal
+      - the previous snapshot plus its journal and the current one
+      - per-CUI processed_<CUI>.pkl files from older versions (the
+        newest one that loads; every CUI pickled up to then is done)
+    """
+
+    def __init__( self , partials_dir , name = 'checkpoint' ):
+        self.partials_dir = partials_dir
+        self.name = name
+        self.state = None
+        self.done = set()
+        self.source = None
+        self.journal_offset = 0
+
+    def path( self , suffix ):
+        return( os.path.join( self.partials_dir , '{}.{}'.format( self.name , suffix ) ) )
+
+    def load( self ):
+        """
+        Load the newest consistent checkpoint, if any.  Returns True
+        when one was found.
+        """
+        if( self.partials_dir is None ):
+            return( False )
+        journal_file = self.path( 'journal' )
+        for snapshot_file , journal_files in [ ( self.path( 'snapshot.pkl' ) ,
+                                                 [ journal_file ] ) ,
+                                               ( self.path( 'snapshot.prev.pkl' ) ,
+                                                 [ self.path( 'journal.prev' ) , journal_file ] ) ]:
+            snapshot = read_snapshot( snapshot_file )
+            if( snapshot is None ):
+                continue
+            self.state = snapshot[ 'state' ]
+            self.done = snapshot[ 'done' ]
+            for filename in journal_files:
+                records , self.journal_offset = read_journal( filename )
+                for stage , key , ops in records:
+                    apply_ops( self.state , ops )
+                    self.done.add( ( stage , key ) )
+            self.source = snapshot_file
+            log.debug( 'Resuming from {}'.format( snapshot_file ) )
+            return( True )
+        return( self.load_legacy() )
+
+    def load_legacy( self ):
+        pickle_files = sorted( glob.glob( os.path.join( self.partials_dir , 'processed_*.pkl' ) ) ,
+                               key = lambda filename : ( os.path.getmtime( filename ) , filename ) )
+        for position in range( len( pickle_files ) - 1 , -1 , -1 ):
+            try:
+                with open( pickle_files[ position ] , 'rb' ) as fp:
+                    saved = pickle.load( fp )
+            except ( EOFError , pickle.UnpicklingError , ValueError ,
+                     TypeError , AttributeError , IndexError ) as e:
+                log.warning( 'Skipping unreadable partial {}:  {}'.format( pickle_files[ position ] , e ) )
+                continue
+            ## [ cui_dict , concepts ] or, from parse_focused_allergens,
+            ## [ cui_dict , synonym_dict , concepts ]
+            self.state = { 'cui_dict' : saved[ 0 ] ,
+                           'concepts' : saved[ -1 ] }
+            self.done = set( ( 'heads' , os.path.basename( filename )[ len( 'processed_' ):-len( '.pkl' ) ] )
+                             for filename in pickle_files[ :position + 1 ] )
+            self.journal_offset = 0
+            self.source = pickle_files[ position ]
+            log.debug( 'Resuming from the older partial {}'.format( pickle_files[ position ] ) )
+            return( True )
+        return( False )
+
+    def is_done( self , stage , key ):
+        return( ( stage , key ) in self.done )
+
+    def remaining( self , stage , keys ):
+        return( [ key for key in keys
+                  if( ( stage , key ) not in self.done ) ] )
+
+#############################################
+##
+#############################################
+
+class CheckpointJournal:
+
+    def __init__( self , partials_dir , name = 'checkpoint' ,
+                  sync_every = DEFAULT_SYNC_EVERY ,
+                  snapshot_every = DEFAULT_SNAPSHOT_EVERY ):
+        self.partials_dir = partials_dir
+        self.resume = ResumeManager( partials_dir , name = name )
+        self.snapshot_file = self.resume.path( 'snapshot.pkl' )
+        self.journal_file = self.resume.path( 'journal' )
+        self.sync_every = max( 1 , int( sync_every ) )
+        self.snapshot_every = max( 1 , int( snapshot_every ) )
+        self.state = None
+        self._fp = None
+        self._unsynced = 0
+        self._since_snapshot = 0
+
+    def open( self , state ):
+        """
+        Resume from the newest consistent checkpoint if there is one
+        (returning its state in place of `state`), or else start a new
+        journal from `state`.  Returns ( state , resume ), where
+        `resume` is the ResumeManager tracking which steps are done.
+        """
+        os.makedirs( self.partials_dir , exist_ok = True )
+        if( self.resume.load() ):
+            self.state = self.resume.state
+            if( self.resume.source == self.snapshot_file ):
+                ## Carry on from the last good record of the journal
+                self._fp = open( self.journal_file , 'ab' )
+                self._fp.truncate( self.resume.journal_offset )
+            else:
+                ## Recovered from a fallback; compact it into a fresh
+                ## snapshot before going on
+                self.snapshot()
+        else:
+            self.state = state
+            self.snapshot()
+        return( self.state , self.resume )
+
+    def record( self , stage , key , ops ):
+        """
+        Append one step's changes (already made to the live state)
+        """
+        self._fp.write( frame( pickle.dumps( ( stage , key , ops ) ,
+                                             protocol = pickle.HIGHEST_PROTOCOL ) ) )
+        self.resume.done.add( ( stage , key ) )
+        self._unsynced += 1
+        self._since_snapshot += 1
+        if( self._since_snapshot >= self.snapshot_every ):
+            self.snapshot()
+        elif( self._unsynced >= self.sync_every ):
+            self.sync()
+
+    def sync( self ):
+        if( self._fp is not None and self._unsynced > 0 ):
+            self._fp.flush()
+            os.fsync( self._fp.fileno() )
+        self._unsynced = 0
+
+    def snapshot( self ):
+        """
+        Compact the live state into a new snapshot and restart the
+        journal, keeping the old pair as the fallback
+        """
+        partial_file = write_snapshot( self.snapshot_file , { 'state' : self.state ,
+                                                              'done' : self.resume.done } )
+        if( self._fp is not None ):
+            self._fp.close()
+        if( os.path.exists( self.snapshot_file ) ):
+            os.replace( self.snapshot_file , self.resume.path( 'snapshot.prev.pkl' ) )
+            if( os.path.exists( self.journal_file ) ):
+                os.replace( self.journal_file , self.resume.path( 'journal.prev' ) )
+        os.replace( partial_file , self.snapshot_file )
+        self._fp = open( self.journal_file , 'wb' )
+        self._unsynced = 0
+        self._since_snapshot = 0
+
+    def close( self ):
+        if( self._fp is None ):
+            return
+        self.snapshot()
+        self._fp.close()
+        self._fp = None
+
+
+def load_state( partials_dir , name = 'checkpoint' ):
+    """
+    The state checkpointed in `partials_dir`, read-only
+    """
+    resume = ResumeManager( partials_dir , name = name )
+    if( not resume.load() ):
+        raise IOError( 'No checkpoint found in {}'.format( partials_dir ) )
+    return( resume.state )
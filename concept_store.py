@@ -0,0 +1,291 @@
+import sys
+
+########################################################################
+## Compact concept records.  Each entry of `concepts` used to be its own
+## dict; with hundreds of thousands of CUIs the per-entry dict (and a
+## set per variant list) is most of the memory and pickle size of a run.
+## A Concept keeps the same fields in __slots__ with interned CUI/TUI
+## strings and variant terms frozen into sorted tuples, but still reads
+## and writes like the dict it replaces.  Terms added one at a time
+## (add_variant_term) go into a set, which is frozen the next time the
+## concept is read or pickled, so building up a long list stays linear:
+##
+##   concepts[ cui ][ 'preferred_term' ]
+##   'head_cui' in concepts[ cui ]
+##   concepts[ head ].setdefault( 'related_cuis' , set() ).add( cui )
+##
+## A ConceptStore is a dict of CUI -> Concept that turns any dict stored
+## in it into a Concept, so code written against plain dicts of dicts
+## (e.g., `concepts[ cui ] = {}`) works on it unchanged.
+##
+## Terms recur across many concepts ("Pain", brand names shared by every
+## RxNorm product, ...), so each distinct term is kept once in a process
+## wide TermTable and concepts refer to that one copy.  The pool only
+## grows, holding every term seen for as long as the process runs (one
+## lex_gen batch); TERMS.clear() lets go of it once the concepts that
+## were built with it are gone (e.g., after a worker's share), and
+## concepts still around simply keep their own copies.  A pickled
+## ConceptStore (and so every checkpoint snapshot) carries the terms it
+## uses once, with each concept listing its terms by number.  That
+## numbering exists only within the one pickle:  it is rebuilt for
+## every snapshot, and journal records carry the terms themselves.
+########################################################################
+
+FIELDS = ( 'preferred_term' , 'tui' , 'variant_terms' ,
+           'head_cui' , 'related_cuis' , 'SNOMEDCT' )
+
+FIELD_SET = frozenset( FIELDS )
+
+#############################################
+##
+#############################################
+
+def intern_cui( value ):
+    if( type( value ) is str ):
+        return( sys.intern( value ) )
+    return( value )
+
+
+class TermTable:
+    """
+    Each distinct term once; equal terms from different concepts share
+    the pooled copy
+    """
+
+    def __init__( self ):
+        self.pool = {}
+
+    def __len__( self ):
+        return( len( self.pool ) )
+
+    def clear( self ):
+        self.pool = {}
+
+    def canonical( self , term ):
+        if( type( term ) is not str ):
+            return( term )
+        return( self.pool.setdefault( term , term ) )
+
+    def canonical_terms( self , terms ):
+        """
+        The pooled copies of a collection of terms, deduplicated and
+        sorted
+        """
+        return( tuple( sorted( set( self.canonical( term ) for term in terms ) ) ) )
+
+
+## Shared by every Concept in the process
+TERMS = TermTable()
+
+
+def compact_value( field , value ):
+    if( field in ( 'tui' , 'head_cui' ) ):
+        return( intern_cui( value ) )
+    elif( field == 'preferred_term' ):
+        return( TERMS.canonical( value ) )
+    elif( field == 'variant_terms' ):
+        if( type( value ) is tuple ):
+            return( value )
+        return( TERMS.canonical_terms( value ) )
+    return( value )
+
+
+def add_variant_term( entry , term ):
+    """
+    Add `term` to an entry's variant_terms, whether the entry is a
+    Concept (a frozen tuple) or a plain dict (a set)
+    """
+    if( isinstance( entry , Concept ) ):
+        variant_terms = getattr( entry , 'variant_terms' , () )
+        if( type( variant_terms ) is not set ):
+            ## Left as a set until the concept is next read (see
+            ## Concept.freeze)
+            variant_terms = set( variant_terms )
+            entry.variant_terms = variant_terms
+        variant_terms.add( TERMS.canonical( term ) )
+        return
+    entry.setdefault( 'variant_terms' , set() ).add( term )
+
+#############################################
+##
+#############################################
+
+def restore_concept( mask , *values ):
+    concept = Concept()
+    values = iter( values )
+    for position , field in enumerate( FIELDS ):
+        if( mask & ( 1 << position ) ):
+            concept[ field ] = next( values )
+    return( concept )
+
+
+def restore_concept_store( terms , records ):
+    terms = [ TERMS.canonical( term ) for term in terms ]
+    concepts = ConceptStore()
+    for cui , packed in records:
+        concept = restore_concept( *packed[ :-1 ] )
+        if( packed[ -1 ] is not None ):
+            concept.variant_terms = tuple( terms[ position ] for position in packed[ -1 ] )
+        dict.__setitem__( concepts , intern_cui( cui ) , concept )
+    return( concepts )
+
+
+class Concept:
+    """
+    One entry of `concepts` with the dict interface the writers and
+    checkpoints rely on.  Unset fields are simply absent.
+    """
+
+    __slots__ = FIELDS
+
+    def __init__( self , fields = None ):
+        if( fields is not None ):
+            self.update( fields )
+
+    def __reduce__( self ):
+        return( ( restore_concept , self.pack() ) )
+
+    def freeze( self ):
+        """
+        Turn variant terms gathered in a set into the sorted tuple
+        every reader sees
+        """
+        variant_terms = getattr( self , 'variant_terms' , None )
+        if( type( variant_terms ) is set ):
+            self.variant_terms = tuple( sorted( variant_terms ) )
+        return( self )
+
+    def pack( self , term_positions = None ):
+        """
+        A bit mask of the fields present and their values, without
+        repeating the field names for every concept.  Given a
+        `term_positions` dict (term -> number, added to as needed), the
+        variant terms are left out of the values and returned last as
+        numbers instead.
+        """
+        self.freeze()
+        mask = 0
+        values = []
+        positions = None
+        for position , field in enumerate( FIELDS ):
+            if( not hasattr( self , field ) ):
+                continue
+            elif( field == 'variant_terms' and term_positions is not None ):
+                positions = tuple( term_positions.setdefault( term , len( term_positions ) )
+                                   for term in self.variant_terms )
+                continue
+            mask |= 1 << position
+            values.append( getattr( self , field ) )
+        if( term_positions is not None ):
+            values.append( positions )
+        return( ( mask , ) + tuple( values ) )
+
+    def __contains__( self , field ):
+        return( field in FIELD_SET and hasattr( self , field ) )
+
+    def __getitem__( self , field ):
+        if( field not in FIELD_SET ):
+            raise KeyError( field )
+        if( field == 'variant_terms' ):
+            self.freeze()
+        try:
+            return( getattr( self , field ) )
+        except AttributeError:
+            raise KeyError( field )
+
+    def __setitem__( self , field , value ):
+        if( field not in FIELD_SET ):
+            raise KeyError( 'Unknown concept field:  {}'.format( field ) )
+        setattr( self , field , compact_value( field , value ) )
+
+    def __delitem__( self , field ):
+        if( field not in self ):
+            raise KeyError( field )
+        delattr( self , field )
+
+    def __iter__( self ):
+        return( iter( self.keys() ) )
+
+    def __len__( self ):
+        return( len( self.keys() ) )
+
+    def __eq__( self , other ):
+        if( isinstance( other , ( Concept , dict ) ) ):
+            return( dict( self.items() ) == dict( other.items() ) )
+        return( NotImplemented )
+
+    def __ne__( self , other ):
+        equal = self.__eq__( other )
+        if( equal is NotImplemented ):
+            return( equal )
+        return( not equal )
+
+    def __repr__( self ):
+        return( 'Concept({})'.format( dict( self.items() ) ) )
+
+    def get( self , field , default = None ):
+        if( field in self ):
+            return( self[ field ] )
+        return( default )
+
+    def setdefault( self , field , default = None ):
+        if( field not in self ):
+            self[ field ] = default
+        return( self[ field ] )
+
+    def keys( self ):
+        return( [ field for field in FIELDS if hasattr( self , field ) ] )
+
+    def values( self ):
+        return( [ self[ field ] for field in self.keys() ] )
+
+    def items( self ):
+        return( [ ( field , self[ field ] ) for field in self.keys() ] )
+
+    def update( self , fields ):
+        for field , value in dict( fields ).items():
+            self[ field ] = value
+
+#############################################
+##
+#############################################
+
+class ConceptStore( dict ):
+    """
+    CUI -> Concept, converting plain dicts as they are stored
+    """
+
+    __slots__ = ()
+
+    def __init__( self , concepts = None ):
+        super().__init__()
+        if( concepts is not None ):
+            self.update( concepts )
+
+    def __setitem__( self , cui , entry ):
+        if( not isinstance( entry , Concept ) ):
+            entry = Concept( entry )
+        super().__setitem__( intern_cui( cui ) , entry )
+
+    def setdefault( self , cui , default = None ):
+        if( cui not in self ):
+            self[ cui ] = {} if default is None else default
+        return( self[ cui ] )
+
+    def update( self , *args , **kwargs ):
+        for cui , entry in dict( *args , **kwargs ).items():
+            self[ cui ] = entry
+
+    def copy( self ):
+        return( ConceptStore( self ) )
+
+    def __reduce__( self ):
+        ## The terms used by these concepts, once, and each concept's
+        ## terms by their position in that list
+        positions = {}
+        records = [ ( cui , concept.pack( term_positions = positions ) )
+                    for cui , concept in self.items() ]
+        terms = [ None ] * len( positions )
+        for term , position in positions.items():
+            terms[ position ] = term
+        return( ( restore_concept_store , ( terms , records ) ) )
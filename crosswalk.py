@@ -0,0 +1,170 @@
+import logging as log
+
+import os
+import sys
+
+import argparse
+
+import threading
+
+import rrf_utils
+
+########################################################################
+## Source code <-> CUI crosswalk (e.g., SNOMED CT concept ids or RxNorm
+## RXCUIs to UMLS CUIs) held as in-memory dicts, so whole lists of codes
+## can be mapped without a get_cui search each.  It is built from the
+## MRCONSO rows of the sources we care about or harvested from earlier
+## API answers, and saved as a tab-separated file of
+##
+##   SAB <tab> CODE <tab> CUI
+##
+## lines, sorted, one per code/CUI pair.
+########################################################################
+
+DEFAULT_SABS = [ 'SNOMEDCT_US' , 'RXNORM' ]
+
+#############################################
+##
+#############################################
+
+def initialize_arg_parser():
+    parser = argparse.ArgumentParser( description = """
+    Build a source code to CUI crosswalk from MRCONSO for bulk get_cui look-ups
+    """ )
+    parser.add_argument( '-v' , '--verbose' ,
+                         help = "print more information" ,
+                         action = "store_true" )
+
+    parser.add_argument( '--rrf-dir' , required = True ,
+                         dest = 'rrfDir' ,
+                         help = 'Directory holding MRCONSO.RRF' )
+
+    parser.add_argument( '--crosswalk-file' , required = True ,
+                         dest = 'crosswalkFile' ,
+                         help = 'File to write the crosswalk to' )
+
+    parser.add_argument( '--sabs' , default = ','.join( DEFAULT_SABS ) ,
+                         dest = 'sabs' ,
+                         help = 'Comma-separated source vocabularies to include' )
+    ##
+    return parser
+
+#############################################
+##
+#############################################
+
+class Crosswalk:
+    """
+    Which CUIs each ( SAB , code ) belongs to, and the reverse
+    """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._code_cuis = {}
+        self._cui_codes = {}
+
+    def __len__( self ):
+        return( len( self._code_cuis ) )
+
+    def add( self , sab , code , cui ):
+        ## Readers don't take the lock, so new lists are built in full
+        ## before they replace the old ones
+        with self._lock:
+            cuis = self._code_cuis.get( ( sab , code ) , [] )
+            if( cui not in cuis ):
+                self._code_cuis[ ( sab , code ) ] = cuis + [ cui ]
+                self._cui_codes[ ( sab , cui ) ] = self._cui_codes.get( ( sab , cui ) , [] ) + [ code ]
+
+    def has_code( self , sab , code ):
+        return( ( sab , code ) in self._code_cuis )
+
+    def get_cui( self , sab , code ):
+        """
+        The CUI for a code, the highest when a code maps to several as
+        umls_utils.search_umls and the local engine pick (None if the
+        code is unknown)
+        """
+        cuis = self._code_cuis.get( ( sab , code ) )
+        if( not cuis ):
+            return( None )
+        return( sorted( cuis )[ -1 ] )
+
+    def get_cuis( self , sab , codes ):
+        """
+        get_cui for many codes at once, as a dict covering only the
+        codes we know
+        """
+        return( dict( ( code , self.get_cui( sab , code ) )
+                      for code in codes
+                      if( self.has_code( sab , code ) ) ) )
+
+    def get_codes( self , sab , cuis ):
+        """
+        The `sab` codes for each of `cuis`, as a dict of sorted lists
+        covering only the CUIs we know
+        """
+        return( dict( ( cui , sorted( self._cui_codes[ ( sab , cui ) ] ) )
+                      for cui in cuis
+                      if( ( sab , cui ) in self._cui_codes ) ) )
+
+    ####################################################################
+
+    def save( self , filename ):
+        with self._lock:
+            lines = sorted( '{}\t{}\t{}\n'.format( sab , code , cui )
+                            for ( sab , code ) , cuis in self._code_cuis.items()
+                            for cui in cuis )
+        ## Write to the side and swap in, so an interrupted save never
+        ## leaves a truncated crosswalk behind
+        partial_file = '{}.partial'.format( filename )
+        with open( partial_file , 'w' , encoding = 'utf-8' ) as fp:
+            fp.writelines( lines )
+        os.replace( partial_file , filename )
+        return( filename )
+
+
+def load_crosswalk( filename ):
+    crosswalk = Crosswalk()
+    with open( filename , 'r' , encoding = 'utf-8' ) as fp:
+        for line in fp:
+            cols = line.rstrip( '\n' ).split( '\t' )
+            if( len( cols ) != 3 ):
+                continue
+            crosswalk.add( *cols )
+    log.debug( 'Loaded {} codes from {}'.format( len( crosswalk ) , filename ) )
+    return( crosswalk )
+
+
+def build_crosswalk( rrf_dir , sabs = DEFAULT_SABS ):
+    """
+    A Crosswalk over every unsuppressed `sabs` atom in `rrf_dir`'s
+    MRCONSO
+    """
+    crosswalk = Crosswalk()
+    log.info( 'Reading MRCONSO from {}'.format( rrf_dir ) )
+    for cols in rrf_utils.read_rrf( rrf_utils.rrf_file( rrf_dir , 'MRCONSO' ) ):
+        row = rrf_utils.conso_row( cols )
+        if( row.sab in sabs and
+            row.suppress in rrf_utils.UNSUPPRESSED ):
+            crosswalk.add( row.sab , row.code , row.cui )
+    log.info( 'Codes:  {}'.format( len( crosswalk ) ) )
+    return( crosswalk )
+
+#############################################
+##
+#############################################
+
+if __name__ == "__main__":
+    ##
+    log.basicConfig( level = log.INFO )
+    args = initialize_arg_parser().parse_args( sys.argv[ 1: ] )
+    if( args.verbose ):
+        log.getLogger().setLevel( log.DEBUG )
+    if( not os.path.exists( args.rrfDir ) ):
+        log.error( 'The RRF directory does not exist:  {}'.format( args.rrfDir ) )
+        exit( 1 )
+    crosswalk = build_crosswalk( args.rrfDir ,
+                                 sabs = [ sab.strip() for sab in args.sabs.split( ',' )
+                                          if sab.strip() != '' ] )
+    crosswalk.save( args.crosswalkFile )
+    print( 'Wrote the crosswalk to {}'.format( args.crosswalkFile ) )
@@ -0,0 +1,213 @@
+import logging as log
+
+import os
+import sys
+
+import argparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import rrf_utils
+
+########################################################################
+## The concept-level RB/RN/RO graph from MRREL as integer-encoded CUIs
+## in CSR arrays (NumPy `.npy` files, memory-mapped when loaded):
+##
+##   cuis.npy               -- every CUI with a relation, sorted
+##   <REL>.indptr.npy       -- row i's neighbors are
+##   <REL>.indices.npy         indices[ indptr[ i ]:indptr[ i + 1 ] ]
+##
+## Row i holds the CUIs that CUI i relates to by REL, as seen from the
+## CUI2 side like rrf_utils.RelRow (so RB rows list narrower concepts),
+## sorted.  CsrGraph.expand then runs one BFS level as a few array
+## operations over the whole frontier.
+########################################################################
+
+GRAPH_RELS = [ 'RB' , 'RN' , 'RO' ]
+
+#############################################
+##
+#############################################
+
+def initialize_arg_parser():
+    parser = argparse.ArgumentParser( description = """
+    Build CSR adjacency arrays of the UMLS RB/RN/RO graph for the local engine
+    """ )
+    parser.add_argument( '-v' , '--verbose' ,
+                         help = "print more information" ,
+                         action = "store_true" )
+
+    parser.add_argument( '--rrf-dir' , required = True ,
+                         dest = 'rrfDir' ,
+                         help = 'Directory holding MRREL.RRF' )
+
+    parser.add_argument( '--graph-dir' , required = True ,
+                         dest = 'graphDir' ,
+                         help = 'Directory to write the graph arrays to' )
+    ##
+    return parser
+
+
+def require_numpy():
+    if( np is None ):
+        raise ImportError( 'The CSR graph requires numpy (pip install numpy)' )
+
+
+def graph_file( graph_dir , name ):
+    return( os.path.join( graph_dir , '{}.npy'.format( name ) ) )
+
+#############################################
+##
+#############################################
+
+def build_graph( rrf_dir , graph_dir ):
+    """
+    (Re)build the CSR arrays in `graph_dir` from the unsuppressed
+    concept-level relations in `rrf_dir`'s MRREL
+    """
+    require_numpy()
+    headers = rrf_utils.mrrel_headers
+    edges = dict( ( rel , ( [] , [] ) ) for rel in GRAPH_RELS )
+    log.info( 'Reading MRREL from {}'.format( rrf_dir ) )
+    for cols in rrf_utils.read_rrf( rrf_utils.rrf_file( rrf_dir , 'MRREL' ) ):
+        rel = cols[ headers[ 'REL' ] - 1 ]
+        if( rel not in edges or
+            cols[ headers[ 'SUPPRESS' ] - 1 ] not in rrf_utils.UNSUPPRESSED or
+            not rrf_utils.is_concept_relation( cols ) ):
+            continue
+        edges[ rel ][ 0 ].append( cols[ headers[ 'CUI2' ] - 1 ] )
+        edges[ rel ][ 1 ].append( cols[ headers[ 'CUI1' ] - 1 ] )
+    ##
+    cuis = np.unique( np.array( [ cui for sources , targets in edges.values()
+                                  for cui in sources + targets ] , dtype = 'S' ) )
+    os.makedirs( graph_dir , exist_ok = True )
+    np.save( graph_file( graph_dir , 'cuis' ) , cuis )
+    size = max( len( cuis ) , 1 )
+    for rel in GRAPH_RELS:
+        sources = np.searchsorted( cuis , np.array( edges[ rel ][ 0 ] , dtype = cuis.dtype ) )
+        targets = np.searchsorted( cuis , np.array( edges[ rel ][ 1 ] , dtype = cuis.dtype ) )
+        ## Sorting the ( source , target ) pairs as one key both orders
+        ## each row and drops duplicate edges
+        pairs = np.unique( sources.astype( np.int64 ) * size + targets )
+        indptr = np.zeros( len( cuis ) + 1 , dtype = np.int64 )
+        np.cumsum( np.bincount( pairs // size , minlength = len( cuis ) ) ,
+                   out = indptr[ 1: ] )
+        np.save( graph_file( graph_dir , '{}.indptr'.format( rel ) ) , indptr )
+        np.save( graph_file( graph_dir , '{}.indices'.format( rel ) ) ,
+                 ( pairs % size ).astype( np.int32 ) )
+        log.info( '{} edges:  {}'.format( rel , len( pairs ) ) )
+    return( graph_dir )
+
+#############################################
+##
+#############################################
+
+class CsrGraph:
+
+    def __init__( self , graph_dir ):
+        require_numpy()
+        if( not os.path.exists( graph_file( graph_dir , 'cuis' ) ) ):
+            raise IOError( 'Missing CSR graph:  {}'.format( graph_dir ) )
+        self.graph_dir = graph_dir
+        self.cuis = np.load( graph_file( graph_dir , 'cuis' ) , mmap_mode = 'r' )
+        self.indptr = {}
+        self.indices = {}
+        for rel in GRAPH_RELS:
+            self.indptr[ rel ] = np.load( graph_file( graph_dir , '{}.indptr'.format( rel ) ) ,
+                                          mmap_mode = 'r' )
+            self.indices[ rel ] = np.load( graph_file( graph_dir , '{}.indices'.format( rel ) ) ,
+                                           mmap_mode = 'r' )
+
+    def encode( self , cuis ):
+        """
+        Node ids for `cuis` (-1 for CUIs without any relation)
+        """
+        if( len( cuis ) == 0 or len( self.cuis ) == 0 ):
+            return( np.full( len( cuis ) , -1 , dtype = np.int64 ) )
+        wanted = np.array( list( cuis ) , dtype = self.cuis.dtype )
+        ids = np.minimum( np.searchsorted( self.cuis , wanted ) , len( self.cuis ) - 1 )
+        return( np.where( self.cuis[ ids ] == wanted , ids , -1 ) )
+
+    def visited( self , cuis = () ):
+        """
+        A bitmap over the graph's nodes with `cuis` marked, for expand
+        """
+        visited = np.zeros( len( self.cuis ) , dtype = bool )
+        self.mark( visited , cuis )
+        return( visited )
+
+    def mark( self , visited , cuis ):
+        ids = self.encode( cuis )
+        visited[ ids[ ids >= 0 ] ] = True
+
+    def decode( self , ids ):
+        return( [ cui.decode( 'utf-8' ) for cui in self.cuis[ ids ] ] )
+
+    def neighbors( self , rel , ids ):
+        """
+        ( owners , neighbors ):  for every node in `ids` (in order), the
+        position in `ids` it came from and each of its `rel` neighbors
+        """
+        ids = np.asarray( ids , dtype = np.int64 )
+        indptr = self.indptr[ rel ]
+        starts = indptr[ ids ]
+        counts = indptr[ ids + 1 ] - starts
+        owners = np.repeat( np.arange( len( ids ) ) , counts )
+        ## Offsets of each neighbor within its own row
+        within = np.arange( counts.sum() ) - np.repeat( np.cumsum( counts ) - counts , counts )
+        return( owners , np.asarray( self.indices[ rel ][ starts[ owners ] + within ] , dtype = np.int64 ) )
+
+    def expand( self , parents , heads , exclude_lists , visited , rel = 'RB' ):
+        """
+        One level of the parse_problems_queue walk.  `parents` (sorted)
+        are expanded in order, each on behalf of the matching head CUI
+        in `heads`; a neighbor is skipped if it is in its head's entry
+        of `exclude_lists` or already `visited` (a bitmap from visited(),
+        to which the new children are added) and otherwise goes to the
+        first parent that reaches it.  Returns [ ( cui , head ) ] in
+        seeding order.
+        """
+        parent_ids = self.encode( parents )
+        known = parent_ids >= 0
+        owners , children = self.neighbors( rel , parent_ids[ known ] )
+        if( len( children ) == 0 ):
+            return( [] )
+        ## Head CUIs as small integers so ( head , child ) pairs can be
+        ## matched as single keys
+        head_list , head_ids = np.unique( np.array( heads , dtype = object )[ known ] ,
+                                          return_inverse = True )
+        head_ids = head_ids[ owners ]
+        size = len( self.cuis )
+        excluded = [ head_id * size + child_id
+                     for head_id , head in enumerate( head_list )
+                     for child_id in self.encode( exclude_lists.get( head , [] ) )
+                     if child_id >= 0 ]
+        keep = ~np.isin( head_ids * size + children , excluded )
+        keep &= ~visited[ children ]
+        children = children[ keep ]
+        head_ids = head_ids[ keep ]
+        ## The first parent to reach a child claims it
+        children , first = np.unique( children , return_index = True )
+        order = np.argsort( first , kind = 'stable' )
+        visited[ children ] = True
+        return( list( zip( self.decode( children[ order ] ) ,
+                           [ head_list[ head_id ] for head_id in head_ids[ first[ order ] ] ] ) ) )
+
+#############################################
+##
+#############################################
+
+if __name__ == "__main__":
+    ##
+    log.basicConfig( level = log.INFO )
+    args = initialize_arg_parser().parse_args( sys.argv[ 1: ] )
+    if( args.verbose ):
+        log.getLogger().setLevel( log.DEBUG )
+    if( not os.path.exists( args.rrfDir ) ):
+        log.error( 'The RRF directory does not exist:  {}'.format( args.rrfDir ) )
+        exit( 1 )
+    build_graph( args.rrfDir , args.graphDir )
+    print( 'Wrote the CSR graph to {}'.format( args.graphDir ) )
@@ -0,0 +1,272 @@
+import logging as log
+
+import os
+
+import email.utils
+import random
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+########################################################################
+## Connection pooling for the UTS, UTS login, and RxNav hosts.  Every
+## HTTP call in this package goes through a single keep-alive session
+## per host so that paging through results re-uses an open TCP+TLS
+## connection instead of paying for a fresh handshake every time.
+########################################################################
+
+## Maximum number of open connections kept alive per host.  Hosts not
+## listed here fall back to the default pool size.
+host_pool_sizes = { 'uts-ws.nlm.nih.gov' : 20 ,
+                    'utslogin.nlm.nih.gov' : 4 ,
+                    'rxnav.nlm.nih.gov' : 20 }
+default_pool_size = int( os.environ.get( 'LEXICON_HTTP_POOL_SIZE' , 10 ) )
+
+## Seconds to wait when connecting to / reading from a host
+default_timeout = ( 10 , 120 )
+
+## Sustained requests per second and burst size allowed per host.
+## UTS and RxNav both ask clients to stay under 20 requests/second.
+host_rate_limits = { 'uts-ws.nlm.nih.gov' : ( 20 , 20 ) ,
+                     'utslogin.nlm.nih.gov' : ( 5 , 5 ) ,
+                     'rxnav.nlm.nih.gov' : ( 20 , 20 ) }
+default_rate_limit = ( 20 , 20 )
+
+## HTTP statuses that are worth trying again after a pause
+RETRY_STATUSES = ( 429 , 500 , 502 , 503 , 504 )
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+########################################################################
+## Client-side throttling and retries
+########################################################################
+
+class TokenBucket:
+    """
+    Thread-safe token bucket:  `rate` tokens are added per second up
+    to `capacity`, and every request takes one.
+    """
+
+    def __init__( self , rate , capacity ):
+        self.rate = float( rate )
+        self.capacity = float( capacity )
+        self.tokens = float( capacity )
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill( self , now ):
+        self.tokens = min( self.capacity ,
+                           self.tokens + ( now - self.last ) * self.rate )
+        self.last = now
+
+    def acquire( self ):
+        while( True ):
+            with self._lock:
+                self._refill( time.monotonic() )
+                if( self.tokens >= 1 ):
+                    self.tokens -= 1
+                    return
+                wait = ( 1 - self.tokens ) / self.rate
+            time.sleep( wait )
+
+    def pause( self , seconds ):
+        ## Empty the bucket so that every thread sharing it holds off
+        ## for (roughly) `seconds`, e.g., after a 429
+        with self._lock:
+            self._refill( time.monotonic() )
+            self.tokens = min( self.tokens , -seconds * self.rate )
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff.  Waits are drawn uniformly from
+    [0, min( max_delay , base_delay * 2 ** attempt )] ("full jitter"),
+    unless the server told us how long to wait via Retry-After.
+    """
+
+    def __init__( self , max_retries = 5 , base_delay = 0.5 , max_delay = 60 ,
+                  retry_statuses = RETRY_STATUSES ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+
+    def backoff( self , attempt ):
+        return( random.uniform( 0 , min( self.max_delay ,
+                                         self.base_delay * ( 2 ** attempt ) ) ) )
+
+    def delay( self , attempt , response = None ):
+        if( response is not None ):
+            retry_after = retry_after_seconds( response )
+            if( retry_after is not None ):
+                return( min( self.max_delay , retry_after ) )
+        return( self.backoff( attempt ) )
+
+
+host_retry_policies = {}
+default_retry_policy = RetryPolicy()
+
+
+def retry_after_seconds( response ):
+    value = response.headers.get( 'Retry-After' )
+    if( value is None ):
+        return( None )
+    try:
+        return( max( 0.0 , float( value ) ) )
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime( value )
+    except ( TypeError , ValueError ):
+        return( None )
+    return( max( 0.0 , when.timestamp() - time.time() ) )
+
+
+def configure_host( host , rate = None , burst = None , retry_policy = None ):
+    """
+    Override the rate limit (requests/second and burst) and/or retry
+    policy used for a single host.
+    """
+    if( rate is not None ):
+        old_rate , old_burst = host_rate_limits.get( host , default_rate_limit )
+        host_rate_limits[ host ] = ( rate , burst if burst is not None else old_burst )
+        with _buckets_lock:
+            _buckets.pop( host , None )
+    if( retry_policy is not None ):
+        host_retry_policies[ host ] = retry_policy
+
+
+def get_bucket( url ):
+    host = urlsplit( url ).hostname
+    with _buckets_lock:
+        if( host not in _buckets ):
+            rate , burst = host_rate_limits.get( host , default_rate_limit )
+            _buckets[ host ] = TokenBucket( rate , burst )
+        return( _buckets[ host ] )
+
+
+def get_retry_policy( url ):
+    return( host_retry_policies.get( urlsplit( url ).hostname ,
+                                     default_retry_policy ) )
+
+
+def configure_pools( pool_sizes = None , pool_size = None , timeout = None ):
+    """
+    Update the per-host pool sizes (dict of host -> connection count),
+    the default pool size, and/or the default timeout.  Any sessions
+    already opened are closed so that the new sizes take effect on the
+    next request.
+    """
+    global default_pool_size , default_timeout
+    if( pool_sizes is not None ):
+        host_pool_sizes.update( pool_sizes )
+    if( pool_size is not None ):
+        default_pool_size = int( pool_size )
+    if( timeout is not None ):
+        default_timeout = timeout
+    close_sessions()
+
+
+def close_sessions():
+    with _sessions_lock:
+        for host in list( _sessions ):
+            _sessions.pop( host ).close()
+
+
+def reset_after_fork( workers = 1 ):
+    """
+    Give a freshly forked worker process sessions of its own (the
+    parent's connections are left to the parent rather than closed) and
+    a `workers`-way share of every host's rate limit, so the pool of
+    workers as a whole stays within it
+    """
+    global _sessions , _sessions_lock , _buckets , _buckets_lock , default_rate_limit
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+    _buckets = {}
+    _buckets_lock = threading.Lock()
+    workers = max( 1 , int( workers ) )
+    for host , ( rate , burst ) in list( host_rate_limits.items() ):
+        host_rate_limits[ host ] = ( float( rate ) / workers , max( 1.0 , float( burst ) / workers ) )
+    rate , burst = default_rate_limit
+    default_rate_limit = ( float( rate ) / workers , max( 1.0 , float( burst ) / workers ) )
+
+
+def get_session( url ):
+    """
+    Return the shared keep-alive session for the host in `url`,
+    creating it (and its connection pool) the first time we see the
+    host.
+    """
+    host = urlsplit( url ).hostname
+    session = _sessions.get( host )
+    if( session is not None ):
+        return( session )
+    with _sessions_lock:
+        if( host not in _sessions ):
+            pool_size = host_pool_sizes.get( host , default_pool_size )
+            log.debug( 'Opening connection pool for {} ( size = {} )'.format( host , pool_size ) )
+            adapter = HTTPAdapter( pool_connections = 1 ,
+                                   pool_maxsize = pool_size ,
+                                   pool_block = True )
+            session = requests.Session()
+            session.headers.update( { 'Connection' : 'keep-alive' } )
+            session.mount( 'https://' , adapter )
+            session.mount( 'http://' , adapter )
+            _sessions[ host ] = session
+        return( _sessions[ host ] )
+
+
+def request( method , url , **kwargs ):
+    """
+    Send a request through the host's pooled session, throttled by the
+    host's token bucket.  Connection errors, timeouts, 429s and 5xx
+    responses are retried with backoff (honoring Retry-After).  Once
+    retries run out, the last response is returned (or the last
+    exception raised) for the caller to deal with.
+    """
+    kwargs.setdefault( 'timeout' , default_timeout )
+    session = get_session( url )
+    bucket = get_bucket( url )
+    policy = get_retry_policy( url )
+    attempt = 0
+    while( True ):
+        bucket.acquire()
+        try:
+            response = session.request( method , url , **kwargs )
+        except ( requests.ConnectionError , requests.Timeout ) as e:
+            if( attempt >= policy.max_retries ):
+                raise
+            delay = policy.backoff( attempt )
+            log.warning( '{} for {} ( retry {} of {} in {:.1f}s )'.format( type( e ).__name__ , url ,
+                                                                          attempt + 1 ,
+                                                                          policy.max_retries ,
+                                                                          delay ) )
+        else:
+            if( response.status_code not in policy.retry_statuses or
+                attempt >= policy.max_retries ):
+                return( response )
+            delay = policy.delay( attempt , response )
+            if( response.status_code == 429 ):
+                bucket.pause( delay )
+            log.warning( 'HTTP {} for {} ( retry {} of {} in {:.1f}s )'.format( response.status_code , url ,
+                                                                                attempt + 1 ,
+                                                                                policy.max_retries ,
+                                                                                delay ) )
+        time.sleep( delay )
+        attempt += 1
+
+
+def get( url , params = None , **kwargs ):
+    return( request( 'GET' , url , params = params , **kwargs ) )
+
+
+def post( url , data = None , **kwargs ):
+    return( request( 'POST' , url , data = data , **kwargs ) )
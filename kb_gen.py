@@ -10,6 +10,8 @@ from tqdm import tqdm
 
 import csv
 
+import rrf_parquet
+
 #############################################
 ## 
 #############################################
@@ -81,6 +83,10 @@ def initialize_arg_parser():
                          dest = 'inputFormat' ,
                          help = 'Input format for extracting concepts' )
     
+    parser.add_argument( '--parquet-dir' , default = None ,
+                         dest = 'parquetDir' ,
+                         help = 'Directory of Parquet tables written by rrf_parquet.py; tables found there are read instead of the .RRF files in --input-dir (used with RxNorm and MRCONSO formats)' )
+     
     parser.add_argument( '--output-file' , default = None ,
                          dest = 'outputFile' ,
                          help = 'Output file to write to (if no file is provided, output goes to stdout)' )
@@ -148,6 +154,26 @@ def dump_lines( outputFile , line ):
             out_fp.write( '{}\n'.format( line ) )
 
 
+def read_rrf_file( rrf_file ):
+    ## RRF values are never quoted; a '"' is part of the value (as in
+    ## rrf_parquet)
+    with open( rrf_file , 'r' ) as fp:
+        csv_dict_reader = csv.reader( fp , delimiter = '|' ,
+                                      quoting = csv.QUOTE_NONE )
+        for cols in csv_dict_reader:
+            yield( cols )
+
+
+def rrf_rows( inputDir , parquetDir , table , headers , fields , filters ):
+    ## Rows of an RRF table, from its Parquet conversion when there is
+    ## one (reading just `fields`, with `filters` applied up front) and
+    ## otherwise parsed from the .RRF file.  Callers still check each
+    ## row, so the filters only have to narrow things down.
+    if( rrf_parquet.has_table( parquetDir , table ) ):
+        return( rrf_parquet.read_rows( parquetDir , table , headers , fields , filters ) )
+    return( read_rrf_file( os.path.join( inputDir , '{}.RRF'.format( table ) ) ) )
+
+
 def parse_csv( csvFile , outputFile ):
     current_id = 4
     kb_stats = { 'total_concepts' : 0 }
@@ -277,34 +303,36 @@ def parse_rxnorm( args ):
     rxcui2brand_cui = {}
     brandcui2rxcui = {}
     ##
-    rxnconso_file = os.path.join( args.inputDir , 'RXNCONSO.RRF' )
+    rxnconso_fields = [ 'RXCUI' , 'RXAUI' , 'SAB' , 'TTY' , 'CODE' , 'STRING' , 'SUPPRESS' ]
     ##################################################################
     ## Gather all concepts related to the top two levels of the ATC1-4
     ## ontology
-    with open( rxnconso_file , 'r' ) as fp:
-        csv_dict_reader = csv.reader( fp , delimiter = '|' )
-        for cols in csv_dict_reader:
-            ## Skip any suppressed rows
-            if( cols[ rxnorm_headers[ 'SUPPRESS' ] - 1 ] in [ 'O' , 'Y' , 'E' ] ):
+    for cols in rrf_rows( args.inputDir , args.parquetDir , 'RXNCONSO' ,
+                          rxnorm_headers , rxnconso_fields ,
+                          [ ( 'SAB' , '=' , 'ATC' ) ,
+                            ( 'TTY' , '=' , 'PT' ) ,
+                            ( 'SUPPRESS' , 'not in' , [ 'O' , 'Y' , 'E' ] ) ] ):
+        ## Skip any suppressed rows
+        if( cols[ rxnorm_headers[ 'SUPPRESS' ] - 1 ] in [ 'O' , 'Y' , 'E' ] ):
+            continue
+        ## Only look at preferred terms for the given source type
+        if( cols[ rxnorm_headers[ 'SAB' ] - 1 ] == 'ATC' and
+            cols[ rxnorm_headers[ 'TTY' ] - 1 ] == 'PT' ):
+            rxcui = cols[ rxnorm_headers[ 'RXCUI' ] - 1 ]
+            rxaui = cols[ rxnorm_headers[ 'RXAUI' ] - 1 ]
+            src_code = cols[ rxnorm_headers[ 'CODE' ] - 1 ]
+            ## Skip any concepts deeper in the hierarchy than two
+            ## levels down
+            if( len( src_code ) > 3 ):
                 continue
-            ## Only look at preferred terms for the given source type
-            if( cols[ rxnorm_headers[ 'SAB' ] - 1 ] == 'ATC' and
-                cols[ rxnorm_headers[ 'TTY' ] - 1 ] == 'PT' ):
-                rxcui = cols[ rxnorm_headers[ 'RXCUI' ] - 1 ]
-                rxaui = cols[ rxnorm_headers[ 'RXAUI' ] - 1 ]
-                src_code = cols[ rxnorm_headers[ 'CODE' ] - 1 ]
-                ## Skip any concepts deeper in the hierarchy than two
-                ## levels down
-                if( len( src_code ) > 3 ):
-                    continue
-                src_string = cols[ rxnorm_headers[ 'STRING' ] - 1 ]
-                rxaui2src_code_map[ rxaui ] = src_code
-                rxaui2rxcui_map[ rxaui ] = rxcui
-                rxaui2src_string_map[ rxaui ] = src_string
-                safe_string = re.sub( ' ' , '%20' , src_string )
-                this_node = 'https://mor.nlm.nih.gov/RxClass/search?query={}&searchBy=class&sourceIds=&drugSources=atc1-4'.format( safe_string )
-                node_map[ src_code ] = this_node
-                rxauis.add( rxaui )
+            src_string = cols[ rxnorm_headers[ 'STRING' ] - 1 ]
+            rxaui2src_code_map[ rxaui ] = src_code
+            rxaui2rxcui_map[ rxaui ] = rxcui
+            rxaui2src_string_map[ rxaui ] = src_string
+            safe_string = re.sub( ' ' , '%20' , src_string )
+            this_node = 'https://mor.nlm.nih.gov/RxClass/search?query={}&searchBy=class&sourceIds=&drugSources=atc1-4'.format( safe_string )
+            node_map[ src_code ] = this_node
+            rxauis.add( rxaui )
     ## Iterate through the extracted top-level concepts to write them
     ## out to both ingredients and brands files
     for rxaui in tqdm( rxaui2src_code_map ):
@@ -318,71 +346,74 @@ def parse_rxnorm( args ):
                               src_string = src_string )
     ##################################################################
     ## Collect all the brand names
-    with open( rxnconso_file , 'r' ) as fp:
-        csv_dict_reader = csv.reader( fp , delimiter = '|' )
-        for cols in csv_dict_reader:
-            ## Skip any suppressed rows
-            if( cols[ rxnorm_headers[ 'SUPPRESS' ] - 1 ] in [ 'O' , 'Y' , 'E' ] ):
-                continue
-            if( cols[ rxnorm_headers[ 'SAB' ] - 1 ] == 'RXNORM' and
-                cols[ rxnorm_headers[ 'TTY' ] - 1 ] == 'BN' ):
-                brandcui = cols[ rxnorm_headers[ 'RXCUI' ] - 1 ]
-                src_string = cols[ rxnorm_headers[ 'STRING' ] - 1 ]
-                brandcui2brand_string_map[ brandcui ] = src_string
+    for cols in rrf_rows( args.inputDir , args.parquetDir , 'RXNCONSO' ,
+                          rxnorm_headers , rxnconso_fields ,
+                          [ ( 'SAB' , '=' , 'RXNORM' ) ,
+                            ( 'TTY' , '=' , 'BN' ) ,
+                            ( 'SUPPRESS' , 'not in' , [ 'O' , 'Y' , 'E' ] ) ] ):
+        ## Skip any suppressed rows
+        if( cols[ rxnorm_headers[ 'SUPPRESS' ] - 1 ] in [ 'O' , 'Y' , 'E' ] ):
+            continue
+        if( cols[ rxnorm_headers[ 'SAB' ] - 1 ] == 'RXNORM' and
+            cols[ rxnorm_headers[ 'TTY' ] - 1 ] == 'BN' ):
+            brandcui = cols[ rxnorm_headers[ 'RXCUI' ] - 1 ]
+            src_string = cols[ rxnorm_headers[ 'STRING' ] - 1 ]
+            brandcui2brand_string_map[ brandcui ] = src_string
     ##################################################################
     ## 
-    rxnrel_file = os.path.join( args.inputDir , 'RXNREL.RRF' )
-    with open( rxnrel_file , 'r' ) as fp:
-        csv_dict_reader = csv.reader( fp , delimiter = '|' )
-        for cols in csv_dict_reader:
-            cui_or_aui = cols[ rxrel_headers[ 'STYPE1' ] - 1 ]
-            specific_relation = cols[ rxrel_headers[ 'RELA' ] - 1 ]
-            ## Figure out which entry is the brand and which is the
-            ## ingredient
-            if( specific_relation == 'has_tradename' and
-                cui_or_aui == 'CUI' ):
-                brand_rxcui = cols[ rxrel_headers[ 'RXCUI1' ] - 1 ]
-                ingr_rxcui = cols[ rxrel_headers[ 'RXCUI2' ] - 1 ]
-            elif( specific_relation == 'tradename_of' and
-                  cui_or_aui == 'CUI' ):
-                ingr_rxcui = cols[ rxrel_headers[ 'RXCUI1' ] - 1 ]
-                brand_rxcui = cols[ rxrel_headers[ 'RXCUI2' ] - 1 ]
-            else:
-                continue
-            ## Then link the two in our maps
-            if( brand_rxcui in brandcui2brand_string_map ):
-                if( ingr_rxcui not in rxcui2brand_cui ):
-                    rxcui2brand_cui[ ingr_rxcui ] = set()
-                rxcui2brand_cui[ ingr_rxcui ].add( brand_rxcui )
-                if( brand_rxcui not in brandcui2rxcui ):
-                    brandcui2rxcui[ brand_rxcui ] = set()
-                brandcui2rxcui[ brand_rxcui ].add( ingr_rxcui )
-            else:
-                ##log.warn( 'Brand not present in mapping file:  {}'.format( brand_rxcui ) )
-                kb_stats[ 'brands_skipped' ] += 1
-                continue
+    for cols in rrf_rows( args.inputDir , args.parquetDir , 'RXNREL' ,
+                          rxrel_headers , [ 'RXCUI1' , 'STYPE1' , 'RXCUI2' , 'RELA' ] ,
+                          [ ( 'STYPE1' , '=' , 'CUI' ) ,
+                            ( 'RELA' , 'in' , [ 'has_tradename' , 'tradename_of' ] ) ] ):
+        cui_or_aui = cols[ rxrel_headers[ 'STYPE1' ] - 1 ]
+        specific_relation = cols[ rxrel_headers[ 'RELA' ] - 1 ]
+        ## Figure out which entry is the brand and which is the
+        ## ingredient
+        if( specific_relation == 'has_tradename' and
+            cui_or_aui == 'CUI' ):
+            brand_rxcui = cols[ rxrel_headers[ 'RXCUI1' ] - 1 ]
+            ingr_rxcui = cols[ rxrel_headers[ 'RXCUI2' ] - 1 ]
+        elif( specific_relation == 'tradename_of' and
+              cui_or_aui == 'CUI' ):
+            ingr_rxcui = cols[ rxrel_headers[ 'RXCUI1' ] - 1 ]
+            brand_rxcui = cols[ rxrel_headers[ 'RXCUI2' ] - 1 ]
+        else:
+            continue
+        ## Then link the two in our maps
+        if( brand_rxcui in brandcui2brand_string_map ):
+            if( ingr_rxcui not in rxcui2brand_cui ):
+                rxcui2brand_cui[ ingr_rxcui ] = set()
+            rxcui2brand_cui[ ingr_rxcui ].add( brand_rxcui )
+            if( brand_rxcui not in brandcui2rxcui ):
+                brandcui2rxcui[ brand_rxcui ] = set()
+            brandcui2rxcui[ brand_rxcui ].add( ingr_rxcui )
+        else:
+            ##log.warn( 'Brand not present in mapping file:  {}'.format( brand_rxcui ) )
+            kb_stats[ 'brands_skipped' ] += 1
+            continue
     ##################################################################
-    with open( rxnconso_file , 'r' ) as fp:
-        csv_dict_reader = csv.reader( fp , delimiter = '|' )
-        for cols in csv_dict_reader:
-            if( cols[ rxnorm_headers[ 'SAB' ] - 1 ] == 'ATC' and
-                ( cols[ rxnorm_headers[ 'TTY' ] - 1 ] == 'IN' or
-                  cols[ rxnorm_headers[ 'TTY' ] - 1 ] == 'MIN' ) ):
-                rxcui = cols[ rxnorm_headers[ 'RXCUI' ] - 1 ]
-                rxaui = cols[ rxnorm_headers[ 'RXAUI' ] - 1 ]
-                src_code = cols[ rxnorm_headers[ 'CODE' ] - 1 ]
-                src_string = cols[ rxnorm_headers[ 'STRING' ] - 1 ]
-                rxaui2src_code_map[ rxaui ] = src_code
-                rxcui2src_code_map[ rxcui ] = src_code
-                kb_stats[ 'total_concepts' ] += 1
-                kb_stats[ 'ingredient_concepts' ] += 1
-                generate_ttl_for_ingr( outputFile = '{}{}{}'.format( args.outputPrefix ,
-                                                                     'Ingredients' ,
-                                                                     args.outputSuffix ) ,
-                                       rxcui = rxcui ,
-                                       src_code = src_code ,
-                                       src_string = src_string )
-                rxauis.add( rxaui )
+    for cols in rrf_rows( args.inputDir , args.parquetDir , 'RXNCONSO' ,
+                          rxnorm_headers , rxnconso_fields ,
+                          [ ( 'SAB' , '=' , 'ATC' ) ,
+                            ( 'TTY' , 'in' , [ 'IN' , 'MIN' ] ) ] ):
+        if( cols[ rxnorm_headers[ 'SAB' ] - 1 ] == 'ATC' and
+            ( cols[ rxnorm_headers[ 'TTY' ] - 1 ] == 'IN' or
+              cols[ rxnorm_headers[ 'TTY' ] - 1 ] == 'MIN' ) ):
+            rxcui = cols[ rxnorm_headers[ 'RXCUI' ] - 1 ]
+            rxaui = cols[ rxnorm_headers[ 'RXAUI' ] - 1 ]
+            src_code = cols[ rxnorm_headers[ 'CODE' ] - 1 ]
+            src_string = cols[ rxnorm_headers[ 'STRING' ] - 1 ]
+            rxaui2src_code_map[ rxaui ] = src_code
+            rxcui2src_code_map[ rxcui ] = src_code
+            kb_stats[ 'total_concepts' ] += 1
+            kb_stats[ 'ingredient_concepts' ] += 1
+            generate_ttl_for_ingr( outputFile = '{}{}{}'.format( args.outputPrefix ,
+                                                                 'Ingredients' ,
+                                                                 args.outputSuffix ) ,
+                                   rxcui = rxcui ,
+                                   src_code = src_code ,
+                                   src_string = src_string )
+            rxauis.add( rxaui )
     ##################################################################
     ## Write brand names to the kb
     for brand_cui in tqdm( sorted( brandcui2brand_string_map ) ):
@@ -436,7 +467,7 @@ def write_lab_test_concept( outputFile , cui , preferred_term , sem_type ):
     dump_lines( outputFile , '  :subClassOf <{}> .\n'.format( parent_node ) )
 
 
-def parse_mrconso( inputDir , sourceType , outputFile ):
+def parse_mrconso( inputDir , sourceType , outputFile , parquetDir = None ):
     current_id = 3
     cui2semtype_map = {}
     kb_stats = { 'total_concepts' : 0 }
@@ -448,37 +479,38 @@ def parse_mrconso( inputDir , sourceType , outputFile ):
         kb_stats[ 'total_concepts' ] += 1
         write_semtype_concept( outputFile , sem_type , tier1_semtypes[ sem_type ] )
     ##################################################################
-    mrsty_file = os.path.join( inputDir , 'MRSTY.RRF' )
-    with open( mrsty_file , 'r' ) as fp:
-        csv_dict_reader = csv.reader( fp , delimiter = '|' )
-        for cols in csv_dict_reader:
-            cui = cols[ mrsty_headers[ 'CUI' ] - 1 ]
-            sem_type = cols[ mrsty_headers[ 'TUI' ] - 1 ]
-            if( sem_type in tier1_semtypes ):
-                if( cui in cui2semtype_map ):
-                    log.warn( 'Already in map:  {} -> {} + {}'.format( cui , 
-                                                                       sem_type ,
-                                                                       cui2semtype_map ) )
-                else:
-                    cui2semtype_map[ cui ] = sem_type
+    for cols in rrf_rows( inputDir , parquetDir , 'MRSTY' ,
+                          mrsty_headers , [ 'CUI' , 'TUI' ] ,
+                          [ ( 'TUI' , 'in' , sorted( tier1_semtypes ) ) ] ):
+        cui = cols[ mrsty_headers[ 'CUI' ] - 1 ]
+        sem_type = cols[ mrsty_headers[ 'TUI' ] - 1 ]
+        if( sem_type in tier1_semtypes ):
+            if( cui in cui2semtype_map ):
+                log.warn( 'Already in map:  {} -> {} + {}'.format( cui , 
+                                                                   sem_type ,
+                                                                   cui2semtype_map ) )
+            else:
+                cui2semtype_map[ cui ] = sem_type
     ##################################################################
-    mrconso_file = os.path.join( inputDir , 'MRCONSO.RRF' )
-    with open( mrconso_file , 'r' ) as fp:
-        csv_dict_reader = csv.reader( fp , delimiter = '|' )
-        for cols in csv_dict_reader:
-            cui = cols[ mrconso_headers[ 'CUI' ] - 1 ]
-            if( cui in cui2semtype_map and
-                cols[ mrconso_headers[ 'LAT' ] - 1 ] == 'ENG' and
-                ##cols[ mrconso_headers[ 'TS' ] - 1 ] == 'P' and
-                ##cols[ mrconso_headers[ 'STT' ] - 1 ] == 'PF' and
-                cols[ mrconso_headers[ 'TTY' ] - 1 ] == 'PT' and
-                ##cols[ mrconso_headers[ 'ISPREF' ] - 1 ] == 'Y' and
-                cols[ mrconso_headers[ 'SAB' ] - 1 ] == sourceType and
-                cols[ mrconso_headers[ 'SUPPRESS' ] - 1 ] in [ 'N' , '' ] ):
-                preferred_term = cols[ mrconso_headers[ 'STR' ] - 1 ]
-                sem_type = cui2semtype_map[ cui ]
-                kb_stats[ 'total_concepts' ] += 1
-                write_lab_test_concept( outputFile , cui , preferred_term , sem_type )
+    for cols in rrf_rows( inputDir , parquetDir , 'MRCONSO' ,
+                          mrconso_headers , [ 'CUI' , 'LAT' , 'SAB' , 'TTY' , 'STR' , 'SUPPRESS' ] ,
+                          [ ( 'SAB' , '=' , sourceType ) ,
+                            ( 'LAT' , '=' , 'ENG' ) ,
+                            ( 'TTY' , '=' , 'PT' ) ,
+                            ( 'SUPPRESS' , 'in' , [ 'N' , '' ] ) ] ):
+        cui = cols[ mrconso_headers[ 'CUI' ] - 1 ]
+        if( cui in cui2semtype_map and
+            cols[ mrconso_headers[ 'LAT' ] - 1 ] == 'ENG' and
+            ##cols[ mrconso_headers[ 'TS' ] - 1 ] == 'P' and
+            ##cols[ mrconso_headers[ 'STT' ] - 1 ] == 'PF' and
+            cols[ mrconso_headers[ 'TTY' ] - 1 ] == 'PT' and
+            ##cols[ mrconso_headers[ 'ISPREF' ] - 1 ] == 'Y' and
+            cols[ mrconso_headers[ 'SAB' ] - 1 ] == sourceType and
+            cols[ mrconso_headers[ 'SUPPRESS' ] - 1 ] in [ 'N' , '' ] ):
+            preferred_term = cols[ mrconso_headers[ 'STR' ] - 1 ]
+            sem_type = cui2semtype_map[ cui ]
+            kb_stats[ 'total_concepts' ] += 1
+            write_lab_test_concept( outputFile , cui , preferred_term , sem_type )
     ##
     return( kb_stats )
 
@@ -507,7 +539,8 @@ if __name__ == "__main__":
     elif( args.inputFormat == 'RxNorm' ):
         kb_stats = parse_rxnorm( args )
     elif( args.inputFormat == 'MRCONSO' ):
-        kb_stats = parse_mrconso( args.inputDir , args.sourceType , args.outputFile )
+        kb_stats = parse_mrconso( args.inputDir , args.sourceType , args.outputFile ,
+                                  parquetDir = args.parquetDir )
     else:
         log.error( 'Unrecognized input format:  {}'.format( args.inputFormat ) )
     ##
@@ -36,10 +36,15 @@ except ImportError:
                     log.warn("Failed to import ElementTree from any known place")
 
 
+import checkpoint_utils
 import concept_mapper_utils as cm
+import concept_store
 import snomed_utils as snomed_u
+import local_umls_utils
+import rrf_offsets
 import spreadsheet_utils as csv_u
 import umls_utils as uu
+import work_queue
 
 #############################################
 ## 
@@ -56,11 +61,11 @@ def initialize_arg_parser():
                          dest = 'inputDir' ,
                          help = 'Input directory containing supplementary files' )
      
-    parser.add_argument( '--input-file' , required = True ,
+    parser.add_argument( '--input-file' , default = None ,
                          dest = 'inputFile' ,
-                         help = 'A pkl file if sourceType is \'pickle\' or an csv file specifying concepts to extract for all other sourceTypes' )
+                         help = 'A pkl file (or a partials directory with a checkpoint journal) if sourceType is \'pickle\' or an csv file specifying concepts to extract for all other sourceTypes' )
      
-    parser.add_argument( '--source-type' , required = True ,
+    parser.add_argument( '--source-type' , default = None ,
                          dest = 'sourceType' ,
                          choices = [ 'problems' , 'medications' , 'pickle' ] ,
                          help = 'The concept type to focus extraction on. \'pickle\' loads concepts from the partial pickle files' )
@@ -69,7 +74,7 @@ def initialize_arg_parser():
                          dest = 'maxDistance' ,
                          help = 'The maximum depth or distance beyond the seed concepts to extract (-1 means to extract all descendants, 0 means no descedants/parents/ROs, 2 means parents/ROs and up to grandchildren, etc.)' )
 
-    parser.add_argument( '--batch-name' , required = True ,
+    parser.add_argument( '--batch-name' , default = None ,
                          dest = 'batchName' ,
                          help = 'Batch name or ID used to identify different runs of the same configuration files (e.g., batch001, batch123, testBatch)' )
 
@@ -85,6 +90,73 @@ def initialize_arg_parser():
                          dest = 'prefixFile' ,
                          help = 'File contents to insert before any other output (Used for TTL output)' )
 
+    parser.add_argument( '--auth-mode' , default = uu.UMLS_AUTH_MODE ,
+                         dest = 'authMode' ,
+                         choices = uu.UMLS_AUTH_MODES ,
+                         help = 'How to authenticate UTS requests: \'apikey\' sends the key with every request while \'cas\' requests a service ticket per request (default from the UMLS_AUTH_MODE environment variable)' )
+
+    parser.add_argument( '--concurrency' , default = 20 ,
+                         dest = 'concurrency' ,
+                         help = 'Maximum number of UMLS look-ups to keep in flight at once while expanding concepts' )
+
+    parser.add_argument( '--workers' , default = 1 ,
+                         dest = 'workers' ,
+                         help = 'Number of processes to expand head CUIs on (their results are merged in head CUI order, as in a run with a single process).  With --queue-file, the number of worker processes to plan tasks for' )
+
+    parser.add_argument( '--queue-file' , default = None ,
+                         dest = 'queueFile' ,
+                         help = 'SQLite work queue on a filesystem shared with other machines.  This run posts its head CUIs to it as tasks, works on them alongside any --queue-worker runs, and merges their results' )
+
+    parser.add_argument( '--queue-worker' ,
+                         dest = 'queueWorker' ,
+                         action = 'store_true' ,
+                         help = 'Work on tasks from --queue-file for another run and exit, rather than extracting a lexicon (--input-file, --source-type and --batch-name are not needed)' )
+
+    parser.add_argument( '--lease-seconds' , default = work_queue.DEFAULT_LEASE_SECONDS ,
+                         dest = 'leaseSeconds' ,
+                         help = 'Seconds a queued task stays claimed by a worker that has stopped sending heartbeats (set by the run posting the tasks)' )
+
+    parser.add_argument( '--engine' , default = 'api' ,
+                         choices = [ 'api' , 'local' ] ,
+                         dest = 'engine' ,
+                         help = 'Where UMLS look-ups are answered:  the UTS REST API or local RRF tables (see --rrf-dir)' )
+
+    parser.add_argument( '--rrf-dir' , default = os.environ.get( 'UMLS_RRF_DIR' ) ,
+                         dest = 'rrfDir' ,
+                         help = 'Directory holding MRCONSO.RRF, MRREL.RRF and MRSTY.RRF for the local engine (default from the UMLS_RRF_DIR environment variable)' )
+
+    parser.add_argument( '--umls-index' , default = os.environ.get( 'UMLS_INDEX_FILE' ) ,
+                         dest = 'umlsIndex' ,
+                         help = 'SQLite index built by umls_index.py for the local engine; used instead of --rrf-dir when given (default from the UMLS_INDEX_FILE environment variable)' )
+
+    parser.add_argument( '--rrf-offsets' , default = os.environ.get( 'UMLS_RRF_OFFSETS' ) ,
+                         dest = 'rrfOffsets' ,
+                         help = 'Directory holding rrf_offsets.py indexes over the --rrf-dir tables; the local engine then reads rows straight from the memory-mapped RRF files instead of loading them (default from the UMLS_RRF_OFFSETS environment variable)' )
+
+    parser.add_argument( '--umls-graph' , default = os.environ.get( 'UMLS_GRAPH_DIR' ) ,
+                         dest = 'umlsGraph' ,
+                         help = 'Directory holding csr_graph.py arrays; the local engine then expands each BFS level over them (default from the UMLS_GRAPH_DIR environment variable)' )
+
+    parser.add_argument( '--cache-file' , default = os.environ.get( 'LEXICON_CACHE_FILE' ) ,
+                         dest = 'cacheFile' ,
+                         help = 'SQLite file used to cache UTS and RxNav responses across runs (default from the LEXICON_CACHE_FILE environment variable; no caching if unset)' )
+
+    parser.add_argument( '--crosswalk-file' , default = os.environ.get( 'LEXICON_CROSSWALK_FILE' ) ,
+                         dest = 'crosswalkFile' ,
+                         help = 'Source code to CUI crosswalk (see crosswalk.py) used to map SNOMED CT and RxNorm codes without a search each; codes searched for are added to it at the end of the run (default from the LEXICON_CROSSWALK_FILE environment variable)' )
+
+    parser.add_argument( '--cache-ttl-days' , default = 30 ,
+                         dest = 'cacheTtlDays' ,
+                         help = 'Number of days a cached response stays valid' )
+
+    parser.add_argument( '--negative-ttl-days' , default = 7 ,
+                         dest = 'negativeTtlDays' ,
+                         help = 'Number of days a cached negative result (no CUI for a code, retired CUI, no RB children) stays valid' )
+
+    parser.add_argument( '--cache-max-mb' , default = 2048 ,
+                         dest = 'cacheMaxMb' ,
+                         help = 'Approximate size bound on the response cache.  Least recently used entries are evicted beyond it' )
+
     ##
     return parser
 
@@ -94,11 +166,24 @@ def init_args( command_line_args ):
     args = parser.parse_args( command_line_args )
     ##
     bad_args_flag = False
+    ## Queue workers take their work from the queue instead
+    if( args.queueWorker ):
+        if( args.queueFile is None ):
+            bad_args_flag = True
+            log.error( '--queue-worker requires --queue-file' )
+    else:
+        for option , value in [ ( '--input-file' , args.inputFile ) ,
+                                ( '--source-type' , args.sourceType ) ,
+                                ( '--batch-name' , args.batchName ) ]:
+            if( value is None ):
+                bad_args_flag = True
+                log.error( 'The {} argument is required'.format( option ) )
     ## Make sure inputs are all available
     if( not os.path.exists( args.inputDir ) ):
         log.error( 'The input directory does not exist:  {}'.format( args.inputDir ) )
         bad_args_flag = True
-    if( not os.path.exists( args.inputFile ) ):
+    if( args.inputFile is not None and
+        not os.path.exists( args.inputFile ) ):
         log.error( 'The input file does not exist:  {}'.format( args.inputFile ) )
         bad_args_flag = True
     ## Make sure maxDistance is an integer value
@@ -107,6 +192,58 @@ def init_args( command_line_args ):
     except Exception as e:
         bad_args_flag = True
         log.error( 'Exception thrown while trying to convert --max-distance value ({}) to an int:  {}'.format( args.maxDistance , e ) )
+    ## Make sure concurrency is a positive integer value
+    try:
+        args.concurrency = int( args.concurrency )
+        if( args.concurrency < 1 ):
+            raise ValueError( 'must be at least 1' )
+    except Exception as e:
+        bad_args_flag = True
+        log.error( 'Exception thrown while trying to convert --concurrency value ({}) to a positive int:  {}'.format( args.concurrency , e ) )
+    ## Make sure workers is a positive integer value
+    try:
+        args.workers = int( args.workers )
+        if( args.workers < 1 ):
+            raise ValueError( 'must be at least 1' )
+    except Exception as e:
+        bad_args_flag = True
+        log.error( 'Exception thrown while trying to convert --workers value ({}) to a positive int:  {}'.format( args.workers , e ) )
+    ## Make sure the lease is a positive number of seconds
+    try:
+        args.leaseSeconds = float( args.leaseSeconds )
+        if( args.leaseSeconds <= 0 ):
+            raise ValueError( 'must be positive' )
+    except Exception as e:
+        bad_args_flag = True
+        log.error( 'Exception thrown while trying to convert --lease-seconds value ({}) to a positive number:  {}'.format( args.leaseSeconds , e ) )
+    ## Make sure the cache bounds are numeric
+    try:
+        args.cacheTtlDays = float( args.cacheTtlDays )
+        args.negativeTtlDays = float( args.negativeTtlDays )
+        args.cacheMaxMb = float( args.cacheMaxMb )
+    except Exception as e:
+        bad_args_flag = True
+        log.error( 'Exception thrown while trying to convert the --cache-ttl-days, --negative-ttl-days or --cache-max-mb values to numbers:  {}'.format( e ) )
+    ## The local engine needs its RRF tables
+    if( args.engine == 'local' ):
+        if( args.umlsIndex is not None ):
+            if( not os.path.exists( args.umlsIndex ) ):
+                bad_args_flag = True
+                log.error( 'The UMLS index does not exist:  {}'.format( args.umlsIndex ) )
+        elif( args.rrfDir is None ):
+            bad_args_flag = True
+            log.error( 'The local engine requires --rrf-dir or --umls-index' )
+        elif( not os.path.exists( os.path.join( args.rrfDir , 'MRCONSO.RRF' ) ) ):
+            bad_args_flag = True
+            log.error( 'The RRF directory does not contain MRCONSO.RRF:  {}'.format( args.rrfDir ) )
+        elif( args.rrfOffsets is not None and
+              not os.path.exists( os.path.join( args.rrfOffsets , rrf_offsets.MANIFEST ) ) ):
+            bad_args_flag = True
+            log.error( 'No RRF offset index found in {} (build one with rrf_offsets.py)'.format( args.rrfOffsets ) )
+        if( args.umlsGraph is not None and
+            not os.path.exists( os.path.join( args.umlsGraph , 'cuis.npy' ) ) ):
+            bad_args_flag = True
+            log.error( 'No CSR graph found in {} (build one with csr_graph.py)'.format( args.umlsGraph ) )
     ## Make sure we can access the output directory
     if( not os.path.exists( args.outputDir ) ):
         log.warning( 'Creating output folder:  {}'.format( args.outputDir ) )
@@ -182,15 +319,11 @@ def concepts_to_concept_mapper( concepts , concept_mapper_filename , cui_list =
             token.set( 'basicLevelConceptType' , 'CUI' )
             token.set( 'basicLevelConceptCode' , 
                        concepts[ cui ][ 'head_cui' ] )            
-        ## TODO - this is a simple hack so we don't have to do
-        ##        a check for SNOMEDCT entries in the next
-        ##        for loop.
-        if( 'SNOMEDCT' not in concepts[ cui ] ):
-            concepts[ cui ][ 'SNOMEDCT' ] = []
-        for cid in sorted( concepts[ cui ][ 'SNOMEDCT' ] ):
+        snomed_cids = concepts[ cui ].get( 'SNOMEDCT' , {} )
+        for cid in sorted( snomed_cids ):
             ###
             variant = etree.Element( 'variant' )
-            fully_specified_name = concepts[ cui ][ 'SNOMEDCT' ][ cid ][ 'FSN' ]
+            fully_specified_name = snomed_cids[ cid ][ 'FSN' ]
             all_fsns.add( fully_specified_name )
             variant.set( 'base' , fully_specified_name )
             variant.set( 'fsn' , fully_specified_name )
@@ -277,28 +410,28 @@ def concepts_to_ttl_kb_mapper( concepts ,
             parent_node = '{}{}'.format( node_map[ 'utsRoot' ] , head_cui )
         ##
         variant_terms = sorted( list( concepts[ cui ][ 'variant_terms' ] ) )
+        ## The same terms as a set, for membership checks
+        seen_terms = set( variant_terms )
         ## If the preferred term isn't in the variants list, then make
         ## sure to prepend it to the variants list
         if( 'preferred_term' in concepts[ cui ] ):
             preferred_term = concepts[ cui ][ 'preferred_term' ]
-            if( preferred_term not in variant_terms ):
+            if( preferred_term not in seen_terms ):
                 variant_terms.insert( 0 , preferred_term )
+                seen_terms.add( preferred_term )
         else:
             ## If we don't have a preferred term _or_ any variants,
             ## then this is a bum entry
             ## TODO - more error reporting
             if( len( variant_terms ) <= 0 ):
                 continue
-        ## TODO - this is a simple hack so we don't have to do
-        ##        a check for SNOMEDCT entries in the next
-        ##        for loop.
-        if( 'SNOMEDCT' not in concepts[ cui ] ):
-            concepts[ cui ][ 'SNOMEDCT' ] = []
-        for cid in sorted( concepts[ cui ][ 'SNOMEDCT' ] ):
+        snomed_cids = concepts[ cui ].get( 'SNOMEDCT' , {} )
+        for cid in sorted( snomed_cids ):
             ###
-            fully_specified_name = concepts[ cui ][ 'SNOMEDCT' ][ cid ][ 'FSN' ]
-            if( fully_specified_name not in variant_terms ):
+            fully_specified_name = snomed_cids[ cid ][ 'FSN' ]
+            if( fully_specified_name not in seen_terms ):
                 variant_terms.append( fully_specified_name )
+                seen_terms.add( fully_specified_name )
             #variant.set( 'snomedCid' , cid )
         with open( ttl_output_filename , 'a' ) as out_fp:
             out_fp.write( '<{}> a :Class;\n'.format( this_node ) )
@@ -425,7 +558,7 @@ def concepts_to_wide_csv( concepts , csv_filename ,
 
 
 def concepts_from_csv( csv_filename ):
-    concepts = {}
+    concepts = concept_store.ConceptStore()
     with open( csv_filename , 'r' ) as in_fp:
         in_tsv = csv.reader( in_fp , dialect=csv.excel_tab )
         for cols in in_tsv:
@@ -439,7 +572,7 @@ def concepts_from_csv( csv_filename ):
                 concepts[ cui ][ 'tui' ] = tui
                 concepts[ cui ][ 'variant_terms' ] = set()
             ##
-            concepts[ cui ][ 'variant_terms' ].add( term )
+            concept_store.add_variant_term( concepts[ cui ] , term )
     return( concepts )
 
 #############################################
@@ -459,6 +592,26 @@ if __name__ == "__main__":
     log.getLogger( 'urllib3.connectionpool' ).setLevel( log.INFO )
     ##
     args = init_args( sys.argv[ 1: ] )
+    uu.UMLS_AUTH_MODE = args.authMode
+    if( args.cacheFile is not None ):
+        uu.set_response_cache( args.cacheFile ,
+                               ttl = args.cacheTtlDays * 24 * 60 * 60 ,
+                               max_bytes = int( args.cacheMaxMb * 1024 * 1024 ) )
+    uu.set_negative_cache( args.cacheFile ,
+                           ttl = args.negativeTtlDays * 24 * 60 * 60 )
+    if( args.crosswalkFile is not None ):
+        uu.set_crosswalk( args.crosswalkFile )
+    if( args.engine == 'local' ):
+        csv_u.use_umls_engine( local_umls_utils.open_engine( rrf_dir = args.rrfDir ,
+                                                             index_file = args.umlsIndex ,
+                                                             offset_dir = args.rrfOffsets ,
+                                                             graph_dir = args.umlsGraph ) )
+    if( args.queueWorker ):
+        work_queue.serve_file( args.queueFile , csv_u.uu , csv_u.use_umls_engine )
+        uu.save_crosswalk()
+        for stat , value in uu.request_stats().items():
+            log.info( 'Requests - {}:\t{}'.format( stat , value ) )
+        exit( 0 )
     ## Compose full output filenames
     dict_output_filename = os.path.join( args.outputDir ,
                                          'conceptMapper_{}_{}.dict'.format( args.sourceType ,
@@ -485,8 +638,13 @@ if __name__ == "__main__":
     ##
     if( args.sourceType == 'medications' ):
         concepts = csv_u.parse_allergens( args.inputFile ,
+                                          concepts = concept_store.ConceptStore() ,
                                           partials_dir = args.partialsDir ,
-                                          max_distance = args.maxDistance )
+                                          max_distance = args.maxDistance  ,
+                                          concurrency = args.concurrency ,
+                                          workers = args.workers ,
+                                          queue_file = args.queueFile ,
+                                          lease_seconds = args.leaseSeconds )
     elif( args.sourceType == 'problems' ):
         ## TODO - write explanation for file contents.
         ## TODO - create function to generate a new version of this file
@@ -494,14 +652,23 @@ if __name__ == "__main__":
         if( os.path.exists( csv_input_filename ) ):
             csv_concepts = concepts_from_csv( csv_input_filename )
         else:
-            csv_concepts = {}
+            csv_concepts = concept_store.ConceptStore()
         #cui_dict , concepts = csv_u.parse_focused_problems( args.inputFile ,
         #                                                    concepts = csv_concepts ,
         #                                                    partials_dir = args.partialsDir )
         cui_dict , concepts = csv_u.parse_problems( args.inputFile ,
                                                     concepts = csv_concepts ,
+                                                    engine = args.engine ,
                                                     partials_dir = args.partialsDir ,
-                                                    max_distance = args.maxDistance )
+                                                    max_distance = args.maxDistance  ,
+                                                    concurrency = args.concurrency ,
+                                                    workers = args.workers ,
+                                                    queue_file = args.queueFile ,
+                                                    lease_seconds = args.leaseSeconds )
+    elif( args.sourceType == 'pickle' and
+          os.path.isdir( args.inputFile ) ):
+        state = checkpoint_utils.load_state( args.inputFile )
+        cui_dict , concepts = state[ 'cui_dict' ] , state[ 'concepts' ]
     elif( args.sourceType == 'pickle' ):
         with open( args.inputFile , 'rb' ) as fp:
             cui_dict , concepts = pickle.load( fp )
@@ -514,3 +681,7 @@ if __name__ == "__main__":
     concepts_to_4col_csv( concepts , csv_output_filename )
     concepts_to_wide_csv( concepts , wide_csv_output_filename ,
                           exclude_terms_flag = False )
+    ##
+    uu.save_crosswalk()
+    for stat , value in uu.request_stats().items():
+        log.info( 'Requests - {}:\t{}'.format( stat , value ) )
@@ -0,0 +1,404 @@
+import logging as log
+
+import csr_graph
+import rrf_offsets
+import rrf_utils
+import umls_index
+import umls_utils as uu
+
+########################################################################
+## Offline stand-in for umls_utils that answers the same questions from
+## the UMLS RRF tables instead of the UTS REST API.  An engine exposes
+## the umls_utils look-up functions (with the same, if unused,
+## `auth_client` and `version` arguments) so it can be dropped in
+## wherever spreadsheet_utils or async_umls_utils expect `uu`.
+##
+## Results follow what UTS returns by default:  suppressible and
+## obsolete atoms/relations are left out, concept relations are the
+## concept-level (STYPE CUI) rows, and source hierarchies come from the
+## source's own PAR/CHD relations.
+########################################################################
+
+## Mirrors of the umls_utils settings callers read off the module
+UMLS_API_TOKEN = uu.UMLS_API_TOKEN
+RXNAV_URI = uu.RXNAV_URI
+ConceptBundle = uu.ConceptBundle
+
+## TTYs get_atoms asks UTS for
+ATOM_TTYS = [ 'PT' , 'HT' ]
+
+
+class LocalUmlsEngine:
+
+    UMLS_API_TOKEN = UMLS_API_TOKEN
+    RXNAV_URI = RXNAV_URI
+    ConceptBundle = ConceptBundle
+
+    def __init__( self , store , graph = None ):
+        self.store = store
+        ## Optional csr_graph.CsrGraph for vectorized frontier expansion
+        self.graph = graph
+
+    def init_authentication( self , api_key , auth_mode = None ):
+        return( None )
+
+    def reset_after_fork( self , workers = 1 ):
+        ## Stores holding connections that cannot cross a fork reopen
+        ## them in the worker
+        reset = getattr( self.store , 'reset_after_fork' , None )
+        if( reset is not None ):
+            reset()
+
+    ####################################################################
+    ## Concepts
+    ####################################################################
+
+    def _atoms( self , cui ):
+        return( unsuppressed( self.store.conso_rows( cui ) ) )
+
+    def _preferred_name( self , cui ):
+        return( preferred_name( self.store.conso_rows( cui ) ) )
+
+    def _rows_many( self , method , cuis ):
+        ## Stores may offer batched `<method>_many` look-ups
+        many = getattr( self.store , '{}_many'.format( method ) , None )
+        if( many is not None ):
+            return( many( cuis ) )
+        single = getattr( self.store , method )
+        return( dict( ( cui , single( cui ) ) for cui in cuis ) )
+
+    def get_cuis_atom( self , auth_client , version , identifier , atom_type ):
+        if( atom_type == '/preferred' ):
+            return( self._preferred_name( identifier ) )
+        if( atom_type == '' ):
+            for row in self.store.sty_rows( identifier ):
+                return( row.tui )
+            return( None )
+        atoms = self._atoms( identifier )
+        if( atom_type == '?language=ENG' ):
+            return( eng_atoms( atoms ) )
+        return( set( row.str for row in atoms ) )
+
+    def get_cuis_preferred_atom( self , auth_client , version , identifier ):
+        return( self.get_cuis_atom( auth_client , version , identifier , atom_type = '/preferred' ) )
+
+    def get_cuis_eng_atom( self , auth_client , version , identifier ):
+        return( self.get_cuis_atom( auth_client , version , identifier , atom_type = '?language=ENG' ) )
+
+    def get_concept_bundle( self , auth_client , version , identifier ):
+        return( concept_bundle( self.store.conso_rows( identifier ) ,
+                                self.store.sty_rows( identifier ) ) )
+
+    def get_concept_bundles( self , auth_client , version , identifiers ):
+        """
+        get_concept_bundle for many CUIs at once, as a dict
+        """
+        conso = self._rows_many( 'conso_rows' , identifiers )
+        sty = self._rows_many( 'sty_rows' , identifiers )
+        return( dict( ( cui , concept_bundle( conso.get( cui , [] ) ,
+                                              sty.get( cui , [] ) ) )
+                      for cui in identifiers ) )
+
+    ####################################################################
+    ## Concept relations
+    ####################################################################
+
+    def get_typed_relation( self , auth_client , version , identifier ,
+                            target_relation_type , target_relation_label ):
+        return( self.get_typed_relations( auth_client , version , [ identifier ] ,
+                                          target_relation_label )[ identifier ] )
+
+    def get_typed_relations( self , auth_client , version , identifiers ,
+                             target_relation_label ):
+        """
+        get_typed_relation for many CUIs at once, as a dict of dicts
+        """
+        rels = self._rows_many( 'rel_rows' , identifiers )
+        related = {}
+        for cui in identifiers:
+            related[ cui ] = sorted( set( row.related_cui
+                                          for row in rels.get( cui , [] )
+                                          if( row.suppress in rrf_utils.UNSUPPRESSED and
+                                              ( target_relation_label is None or
+                                                row.rel == target_relation_label ) ) ) )
+        conso = self._rows_many( 'conso_rows' ,
+                                 set( related_cui for cuis in related.values()
+                                      for related_cui in cuis ) )
+        return( dict( ( cui , dict( ( related_cui , preferred_name( conso.get( related_cui , [] ) ) )
+                                    for related_cui in related[ cui ] ) )
+                      for cui in identifiers ) )
+
+    def get_rbs( self , auth_client , version , identifier ):
+        return( self.get_typed_relation( auth_client , version , identifier ,
+                                         target_relation_type = 'relations' ,
+                                         target_relation_label = 'RB' ) )
+
+    def get_rns( self , auth_client , version , identifier ):
+        return( self.get_typed_relation( auth_client , version , identifier ,
+                                         target_relation_type = 'relations' ,
+                                         target_relation_label = 'RN' ) )
+
+    def get_ros( self , auth_client , version , identifier ):
+        return( self.get_typed_relation( auth_client , version , identifier ,
+                                         target_relation_type = 'relations' ,
+                                         target_relation_label = 'RO' ) )
+
+    ####################################################################
+    ## Source codes
+    ####################################################################
+
+    def get_cui( self , auth_client , version , identifier , source ):
+        cuis = sorted( self.store.code_cuis( source , identifier ) )
+        if( len( cuis ) > 1 ):
+            log.debug( 'Multiple matches.  Only using the highest for {}'.format( source ) )
+        if( len( cuis ) == 0 ):
+            return( None )
+        return( cuis[ -1 ] )
+
+    def get_concept_id( self , auth_client , version , identifier , source ):
+        codes = sorted( set( row.code for row in self._atoms( identifier )
+                             if row.sab == source ) )
+        if( len( codes ) == 0 ):
+            return( None )
+        return( codes[ -1 ] )
+
+    def get_atoms( self , auth_client , version , identifier , source ):
+        return( [ row.code for row in self._atoms( identifier )
+                  if( row.sab == source and
+                      row.tty in ATOM_TTYS ) ] )
+
+    def _source_neighbors( self , root_source , code , rel ):
+        return( set( row.related_code
+                     for row in self.store.source_rel_rows( root_source , code )
+                     if( row.rel == rel and
+                         row.suppress in rrf_utils.UNSUPPRESSED ) ) )
+
+    def get_family_tree( self , auth_client , version , identifier ,
+                         relation_type , root_source = 'SNOMEDCT_US' ):
+        ## A PAR row seen from `identifier` means `identifier` is the
+        ## parent, i.e., the related code is one of its children
+        rel = { 'children' : 'PAR' , 'descendants' : 'PAR' ,
+                'parents' : 'CHD' , 'ancestors' : 'CHD' }[ relation_type ]
+        family = self._source_neighbors( root_source , identifier , rel )
+        if( relation_type in [ 'descendants' , 'ancestors' ] ):
+            queue = list( family )
+            while( len( queue ) > 0 ):
+                for relative in self._source_neighbors( root_source , queue.pop() , rel ):
+                    if( relative not in family ):
+                        family.add( relative )
+                        queue.append( relative )
+        return( family )
+
+    def get_parents( self , auth_client , version , identifier , source ,
+                     atoms = [] ):
+        if( atoms == [] ):
+            atoms = self.get_atoms( auth_client , version , identifier ,
+                                    source = source )
+        parent_atoms = set()
+        for atomic_ui in atoms:
+            parent_atoms |= self.get_family_tree( auth_client , version ,
+                                                  atomic_ui ,
+                                                  relation_type = 'parents' )
+        return( set( self.get_cui( auth_client , version , parent_aui , source )
+                     for parent_aui in parent_atoms ) )
+
+    ####################################################################
+    ## Child lists from the closure table of an indexed store
+    ####################################################################
+
+    def _closure_store( self ):
+        has_closure = getattr( self.store , 'has_closure' , None )
+        if( has_closure is None or not has_closure() ):
+            return( None )
+        return( self.store )
+
+    def get_rbs_below( self , auth_client , version , identifiers ):
+        """
+        get_typed_relations( ... , 'RB' ) for `identifiers` and every CUI
+        the closure table has below them, in one batch (None without a
+        closure).  A closure cut short (--closure-max-depth or -rows)
+        only has the levels it holds, so callers look up any other CUI
+        as usual.
+        """
+        store = self._closure_store()
+        if( store is None ):
+            return( None )
+        below = set( identifiers )
+        for descendants in store.closure( umls_index.RB_GRAPH , below ).values():
+            below |= set( descendants )
+        return( self.get_typed_relations( auth_client , version , sorted( below ) , 'RB' ) )
+
+    def get_cuis( self , auth_client , version , identifiers , source ):
+        """
+        get_cui for many codes at once, as a dict
+        """
+        codes = list( identifiers )
+        many = getattr( self.store , 'code_cuis_many' , None )
+        if( many is not None ):
+            found = many( source , codes )
+            return( dict( ( code , sorted( found[ code ] )[ -1 ] if code in found else None )
+                          for code in codes ) )
+        return( dict( ( code , self.get_cui( None , 'current' , code , source ) )
+                      for code in codes ) )
+
+    ####################################################################
+    ## Walks built on the look-ups above (as in umls_utils)
+    ####################################################################
+
+    def get_all_umls_descendants( self , auth_client , head_cui ,
+                                  concepts ,
+                                  exclude_list , already_included = None ):
+        ## With a closure, the RB child lists the walk needs come back
+        ## in one batch; the walk itself (and so the order CUIs are
+        ## included in) stays the same
+        found = self.get_rbs_below( auth_client , 'current' , [ head_cui ] ) or {}
+        children = lambda cui : ( found[ cui ] if( cui in found ) else
+                                  self.get_rbs( auth_client , 'current' , cui ) )
+        return( umls_descendants( head_cui , children , concepts ,
+                                  exclude_list , already_included ) )
+
+    def get_all_snomed_descendants( self , auth_client , head_concept_id ,
+                                    exclude_list ):
+        store = self._closure_store()
+        found_children = {}
+        found_cuis = {}
+        if( store is not None ):
+            below = [ head_concept_id ] + sorted( store.closure( 'SNOMEDCT_US' , [ head_concept_id ] )[ head_concept_id ] )
+            found_children = store.closure_children( 'SNOMEDCT_US' , below )
+            found_cuis = self.get_cuis( auth_client , 'current' , below , 'SNOMEDCT_US' )
+        children = lambda code : ( found_children[ code ] if( code in found_children ) else
+                                   self.get_family_tree( auth_client , 'current' , code ,
+                                                         relation_type = 'children' ) )
+        def code_cuis( codes ):
+            missing = [ code for code in codes if( code not in found_cuis ) ]
+            if( len( missing ) > 0 ):
+                found_cuis.update( self.get_cuis( auth_client , 'current' , missing , 'SNOMEDCT_US' ) )
+            return( dict( ( code , found_cuis[ code ] ) for code in codes ) )
+        return( snomed_descendants( head_concept_id , children , code_cuis , exclude_list ) )
+
+    def get_first_umls_children( self , auth_client , head_cui ,
+                                 exclude_list , get_grandchildren = False ):
+        include_list = []
+        for descendant_cui in self.get_rbs( auth_client , 'current' , head_cui ):
+            if( descendant_cui in exclude_list ):
+                continue
+            include_list.append( descendant_cui )
+            if( get_grandchildren ):
+                include_list += self.get_first_umls_children( auth_client , descendant_cui ,
+                                                              exclude_list , False )
+        return( include_list )
+
+    def get_first_rxnorm_ancestors( self , auth_client , head_concept_id ):
+        ancestor_concept_ids = self.get_family_tree( auth_client , 'current' ,
+                                                     head_concept_id ,
+                                                     relation_type = 'ancestors' ,
+                                                     root_source = 'RXNORM' )
+        ancestor_cuis = self.get_cuis( auth_client , 'current' , ancestor_concept_ids , 'RXNORM' )
+        return( [ ancestor_cuis[ ancestor_concept_id ]
+                  for ancestor_concept_id in ancestor_concept_ids ] )
+
+    ####################################################################
+    ## RxNorm look-ups are not part of the UMLS tables and still go
+    ## to RxNav
+    ####################################################################
+
+    def rxnav_get_json( self , content_endpoint , params = None ):
+        return( uu.rxnav_get_json( content_endpoint , params ) )
+
+    def get_rxcui_umls_cui( self , rxcui_str ):
+        return( uu.get_rxcui_umls_cui( rxcui_str ) )
+
+    def get_rxclass_members( self , rxclass_str ):
+        return( uu.get_rxclass_members( rxclass_str ) )
+
+    def request_stats( self ):
+        return( uu.request_stats() )
+
+
+########################################################################
+##
+########################################################################
+
+def unsuppressed( rows ):
+    return( [ row for row in rows
+              if row.suppress in rrf_utils.UNSUPPRESSED ] )
+
+
+def eng_atoms( rows ):
+    return( set( row.str for row in rows if row.lat == 'ENG' ) )
+
+
+def preferred_name( rows ):
+    ## The concept's preferred English atom, as UTS reports it
+    for row in rows:
+        if( row.lat == 'ENG' and
+            row.ts == 'P' and
+            row.stt == 'PF' and
+            row.ispref == 'Y' ):
+            return( row.str )
+    for row in rows:
+        if( row.lat == 'ENG' and
+            row.ts == 'P' ):
+            return( row.str )
+    return( None )
+
+
+def concept_bundle( conso_rows , sty_rows ):
+    name = preferred_name( conso_rows )
+    if( name is None ):
+        return( None )
+    return( ConceptBundle( name = name ,
+                           tuis = [ row.tui for row in sty_rows ] ,
+                           eng_atoms = eng_atoms( unsuppressed( conso_rows ) ) ) )
+
+
+def umls_descendants( head_cui , children , concepts , exclude_list ,
+                      already_included = None ):
+    ## Depth-first walk of LocalUmlsEngine.get_all_umls_descendants
+    ## over the RB children `children( cui )`
+    include_list = []
+    for descendant_cui in children( head_cui ):
+        if( descendant_cui in exclude_list or
+            descendant_cui in concepts or
+            ( already_included is not None and
+              descendant_cui in already_included ) ):
+            continue
+        include_list.append( descendant_cui )
+        include_list += umls_descendants( descendant_cui , children , concepts ,
+                                          exclude_list , include_list )
+    return( include_list )
+
+
+def snomed_descendants( head_concept_id , children , code_cuis , exclude_list ):
+    ## Depth-first walk of LocalUmlsEngine.get_all_snomed_descendants
+    descendant_concept_ids = children( head_concept_id )
+    descendant_cuis = code_cuis( descendant_concept_ids )
+    include_list = []
+    for descendant_concept_id in descendant_concept_ids:
+        descendant_cui = descendant_cuis[ descendant_concept_id ]
+        if( descendant_cui in exclude_list ):
+            continue
+        include_list.append( descendant_cui )
+        include_list += snomed_descendants( descendant_concept_id , children ,
+                                            code_cuis , exclude_list )
+    return( include_list )
+
+
+def open_engine( rrf_dir = None , index_file = None , offset_dir = None ,
+                 graph_dir = None ):
+    """
+    Engine over an indexed database from umls_index.py when
+    `index_file` is given, over the memory-mapped RRF tables in
+    `rrf_dir` when `offset_dir` holds their rrf_offsets.py indexes, and
+    otherwise over the raw RRF tables (loaded into memory).  With a
+    `graph_dir` from csr_graph.py, BFS levels are expanded over its
+    arrays.
+    """
+    graph = None
+    if( graph_dir is not None ):
+        graph = csr_graph.CsrGraph( graph_dir )
+    if( index_file is not None ):
+        return( LocalUmlsEngine( umls_index.SqliteStore( index_file ) , graph ) )
+    if( offset_dir is not None ):
+        return( LocalUmlsEngine( rrf_offsets.OffsetStore( rrf_dir , offset_dir ) , graph ) )
+    return( LocalUmlsEngine( rrf_utils.RrfStore( rrf_dir ) , graph ) )
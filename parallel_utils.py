@@ -0,0 +1,230 @@
+import logging as log
+
+import copy
+import functools
+import multiprocessing
+
+########################################################################
+## Expanding head CUIs on a pool of worker processes.  Heads are dealt
+## out to the workers, and each worker walks its share exactly as a
+## serial run would (with its own HTTP sessions, credentials and cache
+## connections), recording the answer to every UMLS look-up it makes.
+## The caller then repeats the serial walk over all of the heads with
+## look-ups answered from those recordings.  That last walk makes no
+## requests for anything a worker already saw, but it still decides
+## which head each concept goes to, in sorted head order as always, so
+## the merged result is exactly what a serial run would have produced.
+##
+## Workers are forked, so they start out with the parent's engine and
+## settings (and anything patched into them).
+########################################################################
+
+## Look-ups worth recording:  everything spreadsheet_utils and
+## async_umls_utils ask an engine for one CUI or code at a time
+LOOKUPS = frozenset( [ 'get_all_snomed_descendants' ,
+                       'get_all_umls_descendants' ,
+                       'get_concept_bundle' ,
+                       'get_cui' ,
+                       'get_cuis_atom' ,
+                       'get_cuis_eng_atom' ,
+                       'get_cuis_preferred_atom' ,
+                       'get_family_tree' ,
+                       'get_first_rxnorm_ancestors' ,
+                       'get_first_umls_children' ,
+                       'get_parents' ,
+                       'get_rbs' ,
+                       'get_rns' ,
+                       'get_ros' ,
+                       'get_rxclass_members' ,
+                       'get_rxcui_umls_cui' ,
+                       'get_typed_relation' ,
+                       'rxnav_get_json' ] )
+
+## Look-ups that take no `auth_client` first argument
+UNAUTHENTICATED_LOOKUPS = frozenset( [ 'get_rxclass_members' ,
+                                       'get_rxcui_umls_cui' ,
+                                       'rxnav_get_json' ] )
+
+## Batched look-ups, called as ( auth_client , version , identifiers ,
+## ... ) and answering with a dict keyed by identifier.  Their answers
+## are recorded one identifier at a time, so walks that batch the same
+## identifiers differently can still be matched up.
+BATCHED_LOOKUPS = frozenset( [ 'get_concept_bundles' ,
+                               'get_typed_relations' ,
+                               'get_cuis' ] )
+
+## ( engine , walk , install , workers ) for the pool being started
+pool_job = None
+## The MemoEngine recording look-ups in this worker
+worker_engine = None
+
+#############################################
+##
+#############################################
+
+def frozen( value ):
+    if( isinstance( value , ( list , tuple ) ) ):
+        return( tuple( frozen( item ) for item in value ) )
+    elif( isinstance( value , ( set , frozenset ) ) ):
+        return( frozenset( frozen( item ) for item in value ) )
+    elif( isinstance( value , dict ) ):
+        return( tuple( sorted( ( key , frozen( item ) ) for key , item in value.items() ) ) )
+    return( value )
+
+
+def lookup_key( name , args , kwargs ):
+    ## The auth client differs from process to process and never changes
+    ## the answer
+    if( name not in UNAUTHENTICATED_LOOKUPS ):
+        args = args[ 1: ]
+    return( ( name , frozen( args ) , frozen( kwargs ) ) )
+
+
+def code_and_source( auth_client , version , identifier , source ):
+    ## The arguments of get_cui that its crosswalk entry is made of
+    return( identifier , source )
+
+
+def source_of( source ):
+    ## The same for get_cuis, past its list of codes
+    return( source )
+
+
+def remember_cuis( engine , source , code_cuis ):
+    ## get_cui answers replayed from a memo never reach the engine, so
+    ## whatever it would have added to its crosswalk is added here
+    remember_cui = getattr( engine , 'remember_cui' , None )
+    if( remember_cui is None ):
+        return
+    for code , cui in code_cuis:
+        remember_cui( code , source , cui )
+
+
+class MemoEngine:
+    """
+    Stands in for `engine` (the umls_utils module or anything with the
+    same functions), answering look-ups from `memo` when it can and
+    recording the answer whenever it has to ask `engine`
+    """
+
+    def __init__( self , engine , memo = None ):
+        self.engine = engine
+        self.memo = {} if memo is None else memo
+        self.recorded = []
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__( self , name ):
+        value = getattr( self.engine , name )
+        if( name in BATCHED_LOOKUPS ):
+            return( functools.partial( self.lookup_many , name , value ) )
+        if( name not in LOOKUPS ):
+            return( value )
+        return( functools.partial( self.lookup , name , value ) )
+
+    def lookup( self , name , function , *args , **kwargs ):
+        key = lookup_key( name , args , kwargs )
+        if( key in self.memo ):
+            self.hits += 1
+            if( name == 'get_cui' ):
+                code , source = code_and_source( *args , **kwargs )
+                remember_cuis( self.engine , source , [ ( code , self.memo[ key ] ) ] )
+            ## Callers may change what they are handed, so each one
+            ## gets a copy of its own
+            return( copy.deepcopy( self.memo[ key ] ) )
+        self.misses += 1
+        result = function( *args , **kwargs )
+        self.memo.setdefault( key , copy.deepcopy( result ) )
+        self.recorded.append( key )
+        return( result )
+
+    def lookup_many( self , name , function , auth_client , version , identifiers ,
+                     *args , **kwargs ):
+        """
+        A batched look-up, with only the identifiers not in `memo` (if
+        any) asked of `engine` in a single call
+        """
+        identifiers = list( identifiers )
+        keys = dict( ( identifier , lookup_key( name , ( auth_client , version , identifier ) + args ,
+                                                kwargs ) )
+                     for identifier in identifiers )
+        missing = [ identifier for identifier in keys
+                    if( keys[ identifier ] not in self.memo ) ]
+        self.hits += len( keys ) - len( missing )
+        self.misses += len( missing )
+        if( name == 'get_cuis' ):
+            remember_cuis( self.engine , source_of( *args , **kwargs ) ,
+                           [ ( identifier , self.memo[ keys[ identifier ] ] )
+                             for identifier in keys
+                             if( identifier not in missing ) ] )
+        if( len( missing ) > 0 ):
+            found = function( auth_client , version , missing , *args , **kwargs )
+            for identifier in missing:
+                self.memo.setdefault( keys[ identifier ] , copy.deepcopy( found.get( identifier ) ) )
+                self.recorded.append( keys[ identifier ] )
+        return( dict( ( identifier , copy.deepcopy( self.memo[ keys[ identifier ] ] ) )
+                      for identifier in identifiers ) )
+
+    def take_recorded( self ):
+        """
+        The look-ups recorded since the last call, as a dict
+        """
+        keys , self.recorded = self.recorded , []
+        return( dict( ( key , self.memo[ key ] ) for key in keys ) )
+
+#############################################
+##
+#############################################
+
+def shares( heads , workers ):
+    """
+    Deal sorted `heads` out into a few shares per worker, so a share of
+    slow heads doesn't leave the other workers idle at the end
+    """
+    heads = sorted( heads )
+    count = min( len( heads ) , max( 1 , int( workers ) ) * 4 )
+    return( [ heads[ position::count ] for position in range( count ) ] )
+
+
+def start_worker():
+    global worker_engine
+    engine , walk , install , workers = pool_job
+    reset = getattr( engine , 'reset_after_fork' , None )
+    if( reset is not None ):
+        reset( workers )
+    worker_engine = MemoEngine( engine )
+    install( worker_engine )
+
+
+def walk_share( heads ):
+    walk = pool_job[ 1 ]
+    walk( heads )
+    return( worker_engine.take_recorded() )
+
+
+def prefetch( engine , heads , workers , walk , install ):
+    """
+    Run `walk( share )` for shares of `heads` on `workers` forked
+    processes, where `install( engine )` has routed look-ups through a
+    recording engine, and return a MemoEngine over `engine` holding
+    every answer they recorded
+    """
+    global pool_job
+    memo = {}
+    heads = list( heads )
+    share_list = shares( heads , workers )
+    if( len( share_list ) == 0 ):
+        return( MemoEngine( engine , memo ) )
+    workers = min( max( 1 , int( workers ) ) , len( share_list ) )
+    pool_job = ( engine , walk , install , workers )
+    try:
+        with multiprocessing.get_context( 'fork' ).Pool( workers ,
+                                                         initializer = start_worker ) as pool:
+            for recorded in pool.imap_unordered( walk_share , share_list ):
+                for key , value in recorded.items():
+                    memo.setdefault( key , value )
+    finally:
+        pool_job = None
+    log.info( 'Workers recorded {} look-ups for {} heads'.format( len( memo ) , len( heads ) ) )
+    return( MemoEngine( engine , memo ) )
+
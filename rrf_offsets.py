@@ -0,0 +1,301 @@
+import logging as log
+
+import os
+import sys
+
+import argparse
+
+import json
+import mmap
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import rrf_utils
+
+########################################################################
+## Sidecar byte-offset indexes over the raw RRF files, for when a second
+## copy of UMLS (umls_index.py) is too much.  Each index is a NumPy
+## structured array of ( key , offset , length ) runs sorted by key and
+## saved as `.npy`; OffsetStore memory-maps both the index and the RRF
+## file and slices out only the lines for a key, so a look-up is a
+## binary search with next to nothing resident.
+##
+## Indexes (files named <table>.<key>.npy):
+##   MRCONSO.CUI, MRSTY.CUI  -- rows by CUI
+##   MRCONSO.CODE            -- rows by SAB|CODE (code_cuis)
+##   MRCONSO.AUI             -- rows by AUI (source hierarchies)
+##   MRREL.CUI2              -- concept-level relations by CUI2
+##   MRREL.AUI2              -- source PAR/CHD relations by AUI2
+########################################################################
+
+MANIFEST = 'offsets.json'
+
+#############################################
+##
+#############################################
+
+def initialize_arg_parser():
+    parser = argparse.ArgumentParser( description = """
+    Build sidecar byte-offset indexes over the UMLS RRF tables used by the local engine
+    """ )
+    parser.add_argument( '-v' , '--verbose' ,
+                         help = "print more information" ,
+                         action = "store_true" )
+
+    parser.add_argument( '--rrf-dir' , required = True ,
+                         dest = 'rrfDir' ,
+                         help = 'Directory holding MRCONSO.RRF, MRREL.RRF and MRSTY.RRF' )
+
+    parser.add_argument( '--index-dir' , default = None ,
+                         dest = 'indexDir' ,
+                         help = 'Directory to write the indexes to (default:  the RRF directory)' )
+    ##
+    return parser
+
+
+def require_numpy():
+    if( np is None ):
+        raise ImportError( 'The RRF offset index requires numpy (pip install numpy)' )
+
+#############################################
+##
+#############################################
+
+def conso_keys( cols ):
+    headers = rrf_utils.mrconso_headers
+    return( { 'CUI' : cols[ headers[ 'CUI' ] - 1 ] ,
+              'CODE' : code_key( cols[ headers[ 'SAB' ] - 1 ] ,
+                                 cols[ headers[ 'CODE' ] - 1 ] ) ,
+              'AUI' : cols[ headers[ 'AUI' ] - 1 ] } )
+
+
+def sty_keys( cols ):
+    return( { 'CUI' : cols[ rrf_utils.mrsty_headers[ 'CUI' ] - 1 ] } )
+
+
+def rel_keys( cols ):
+    if( rrf_utils.is_concept_relation( cols ) ):
+        return( { 'CUI2' : cols[ rrf_utils.mrrel_headers[ 'CUI2' ] - 1 ] } )
+    if( rrf_utils.is_source_hierarchy_relation( cols ) ):
+        return( { 'AUI2' : cols[ rrf_utils.mrrel_headers[ 'AUI2' ] - 1 ] } )
+    return( {} )
+
+
+## Which keys to index in each table
+TABLE_KEYS = { 'MRCONSO' : ( [ 'CUI' , 'CODE' , 'AUI' ] , conso_keys ) ,
+               'MRSTY' : ( [ 'CUI' ] , sty_keys ) ,
+               'MRREL' : ( [ 'CUI2' , 'AUI2' ] , rel_keys ) }
+
+
+def code_key( sab , code ):
+    return( '{}|{}'.format( sab , code ) )
+
+
+def index_file( index_dir , table , key ):
+    return( os.path.join( index_dir , '{}.{}.npy'.format( table , key ) ) )
+
+
+def scan_table( filename , key_names , row_keys ):
+    """
+    One pass over an RRF file collecting, for each key, the runs of
+    consecutive lines sharing a value as [ keys , offsets , lengths ]
+    """
+    runs = dict( ( name , [ [] , [] , [] ] ) for name in key_names )
+    offset = 0
+    with open( filename , 'rb' ) as fp:
+        for line in fp:
+            keys = row_keys( line.decode( 'utf-8' ).rstrip( '\n' ).split( '|' ) )
+            for name , value in keys.items():
+                key_list , offsets , lengths = runs[ name ]
+                if( len( key_list ) > 0 and
+                    key_list[ -1 ] == value and
+                    offsets[ -1 ] + lengths[ -1 ] == offset ):
+                    lengths[ -1 ] += len( line )
+                else:
+                    key_list.append( value )
+                    offsets.append( offset )
+                    lengths.append( len( line ) )
+            offset += len( line )
+    return( runs )
+
+
+def runs_array( key_list , offsets , lengths ):
+    ## As wide as the longest key, so no two keys can collide on a
+    ## shared prefix
+    width = max( [ 1 ] + [ len( key.encode( 'utf-8' ) ) for key in key_list ] )
+    runs = np.empty( len( key_list ) , dtype = [ ( 'key' , 'S{}'.format( width ) ) ,
+                                                 ( 'offset' , '<i8' ) ,
+                                                 ( 'length' , '<i4' ) ] )
+    runs[ 'key' ] = [ key.encode( 'utf-8' ) for key in key_list ]
+    runs[ 'offset' ] = offsets
+    runs[ 'length' ] = lengths
+    ## A stable sort keeps runs for the same key in file order
+    return( runs[ np.argsort( runs[ 'key' ] , kind = 'stable' ) ] )
+
+
+def build_offsets( rrf_dir , index_dir = None ):
+    """
+    (Re)build the offset indexes for the RRF tables in `rrf_dir`,
+    writing them to `index_dir` (default:  `rrf_dir`)
+    """
+    require_numpy()
+    if( index_dir is None ):
+        index_dir = rrf_dir
+    os.makedirs( index_dir , exist_ok = True )
+    manifest = {}
+    for table in sorted( TABLE_KEYS ):
+        key_names , row_keys = TABLE_KEYS[ table ]
+        filename = rrf_utils.rrf_file( rrf_dir , table )
+        log.info( 'Indexing {}'.format( table ) )
+        runs = scan_table( filename , key_names , row_keys )
+        for name in key_names:
+            np.save( index_file( index_dir , table , name ) , runs_array( *runs[ name ] ) )
+        manifest[ table ] = os.path.getsize( filename )
+    with open( os.path.join( index_dir , MANIFEST ) , 'w' ) as fp:
+        json.dump( manifest , fp , indent = 2 , sort_keys = True )
+    return( index_dir )
+
+#############################################
+##
+#############################################
+
+class OffsetStore:
+    """
+    rrf_utils store reading rows straight out of the memory-mapped RRF
+    files via the indexes from build_offsets
+    """
+
+    def __init__( self , rrf_dir , index_dir = None ):
+        require_numpy()
+        if( index_dir is None ):
+            index_dir = rrf_dir
+        manifest_file = os.path.join( index_dir , MANIFEST )
+        if( not os.path.exists( manifest_file ) ):
+            raise IOError( 'Missing RRF offset index:  {}'.format( manifest_file ) )
+        with open( manifest_file , 'r' ) as fp:
+            manifest = json.load( fp )
+        self.rrf_dir = rrf_dir
+        self.index_dir = index_dir
+        self._lock = threading.Lock()
+        self._files = {}
+        self._maps = {}
+        self._indexes = {}
+        for table in sorted( TABLE_KEYS ):
+            filename = rrf_utils.rrf_file( rrf_dir , table )
+            if( os.path.getsize( filename ) != manifest.get( table ) ):
+                raise IOError( 'The offset index in {} is stale for {}; rebuild it with rrf_offsets.py'.format(
+                    index_dir , filename ) )
+            self._files[ table ] = open( filename , 'rb' )
+            ## mmap refuses empty files
+            if( manifest[ table ] > 0 ):
+                self._maps[ table ] = mmap.mmap( self._files[ table ].fileno() , 0 ,
+                                                 access = mmap.ACCESS_READ )
+            for name in TABLE_KEYS[ table ][ 0 ]:
+                self._indexes[ ( table , name ) ] = np.load( index_file( index_dir , table , name ) ,
+                                                             mmap_mode = 'r' )
+
+    def close( self ):
+        with self._lock:
+            for table_map in self._maps.values():
+                table_map.close()
+            for fp in self._files.values():
+                fp.close()
+            self._maps = {}
+            self._files = {}
+
+    def _rows( self , table , name , key ):
+        """
+        The column lists of every `table` row whose `name` is `key`, in
+        file order
+        """
+        runs = self._indexes[ ( table , name ) ]
+        keys = runs[ 'key' ]
+        key = key.encode( 'utf-8' )
+        ## A key wider than the column is in no row (and would otherwise
+        ## be cut down to a prefix of some other key)
+        if( len( key ) > keys.dtype.itemsize ):
+            return( [] )
+        needle = np.array( key , dtype = keys.dtype )
+        first = np.searchsorted( keys , needle , side = 'left' )
+        last = np.searchsorted( keys , needle , side = 'right' )
+        rows = []
+        for run in runs[ first:last ]:
+            offset = int( run[ 'offset' ] )
+            chunk = self._maps[ table ][ offset:offset + int( run[ 'length' ] ) ]
+            for line in chunk.decode( 'utf-8' ).split( '\n' ):
+                if( line != '' ):
+                    rows.append( line.split( '|' ) )
+        return( rows )
+
+    ####################################################################
+
+    def conso_rows( self , cui ):
+        return( [ rrf_utils.conso_row( cols )
+                  for cols in self._rows( 'MRCONSO' , 'CUI' , cui ) ] )
+
+    def sty_rows( self , cui ):
+        headers = rrf_utils.mrsty_headers
+        return( [ rrf_utils.StyRow( tui = cols[ headers[ 'TUI' ] - 1 ] ,
+                                    sty = cols[ headers[ 'STY' ] - 1 ] )
+                  for cols in self._rows( 'MRSTY' , 'CUI' , cui ) ] )
+
+    def rel_rows( self , cui ):
+        headers = rrf_utils.mrrel_headers
+        return( [ rrf_utils.RelRow( related_cui = cols[ headers[ 'CUI1' ] - 1 ] ,
+                                    rel = cols[ headers[ 'REL' ] - 1 ] ,
+                                    sab = cols[ headers[ 'SAB' ] - 1 ] ,
+                                    suppress = cols[ headers[ 'SUPPRESS' ] - 1 ] )
+                  for cols in self._rows( 'MRREL' , 'CUI2' , cui ) ] )
+
+    def code_cuis( self , sab , code ):
+        cuis = []
+        for row in self._code_atoms( sab , code ):
+            if( row.cui not in cuis ):
+                cuis.append( row.cui )
+        return( cuis )
+
+    def _code_atoms( self , sab , code ):
+        return( [ rrf_utils.conso_row( cols )
+                  for cols in self._rows( 'MRCONSO' , 'CODE' , code_key( sab , code ) ) ] )
+
+    def _aui_code( self , aui , sab ):
+        for cols in self._rows( 'MRCONSO' , 'AUI' , aui ):
+            row = rrf_utils.conso_row( cols )
+            if( row.sab == sab ):
+                return( row.code )
+        return( None )
+
+    def source_rel_rows( self , sab , code ):
+        headers = rrf_utils.mrrel_headers
+        rows = []
+        for atom in self._code_atoms( sab , code ):
+            for cols in self._rows( 'MRREL' , 'AUI2' , atom.aui ):
+                if( cols[ headers[ 'SAB' ] - 1 ] != sab ):
+                    continue
+                related_code = self._aui_code( cols[ headers[ 'AUI1' ] - 1 ] , sab )
+                if( related_code is None ):
+                    continue
+                rows.append( rrf_utils.SourceRelRow( related_code = related_code ,
+                                                     rel = cols[ headers[ 'REL' ] - 1 ] ,
+                                                     suppress = cols[ headers[ 'SUPPRESS' ] - 1 ] ) )
+        return( rows )
+
+#############################################
+##
+#############################################
+
+if __name__ == "__main__":
+    ##
+    log.basicConfig( level = log.INFO )
+    args = initialize_arg_parser().parse_args( sys.argv[ 1: ] )
+    if( args.verbose ):
+        log.getLogger().setLevel( log.DEBUG )
+    if( not os.path.exists( args.rrfDir ) ):
+        log.error( 'The RRF directory does not exist:  {}'.format( args.rrfDir ) )
+        exit( 1 )
+    index_dir = build_offsets( args.rrfDir , args.indexDir )
+    print( 'Wrote offset indexes to {}'.format( index_dir ) )
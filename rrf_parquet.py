@@ -0,0 +1,184 @@
+import logging as log
+
+import os
+import sys
+
+import argparse
+
+import shutil
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as pa_ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+########################################################################
+## One-time conversion of RRF tables into Parquet datasets, keeping only
+## the columns kb_gen and the local engine read and partitioning by SAB
+## (<parquet-dir>/<TABLE>/SAB=<sab>/...), so later runs can load a
+## single source with a filtered, columnar read instead of re-parsing
+## the text tables.
+########################################################################
+
+## Every column of each table, in RRF order (RRF lines end with a '|',
+## hence the empty trailing column)
+rrf_columns = { 'MRCONSO' : [ 'CUI' , 'LAT' , 'TS' , 'LUI' , 'STT' , 'SUI' , 'ISPREF' ,
+                              'AUI' , 'SAUI' , 'SCUI' , 'SDUI' , 'SAB' , 'TTY' , 'CODE' ,
+                              'STR' , 'SRL' , 'SUPPRESS' , 'CVF' , '' ] ,
+                'MRSTY' : [ 'CUI' , 'TUI' , 'STN' , 'STY' , 'ATUI' , 'CVF' , '' ] ,
+                'RXNCONSO' : [ 'RXCUI' , 'LAT' , 'TS' , 'LUI' , 'STT' , 'SUI' , 'ISPREF' ,
+                               'RXAUI' , 'SAUI' , 'SCUI' , 'SDUI' , 'SAB' , 'TTY' , 'CODE' ,
+                               'STR' , 'SRL' , 'SUPPRESS' , 'CVF' , '' ] ,
+                'RXNREL' : [ 'RXCUI1' , 'RXAUI1' , 'STYPE1' , 'REL' , 'RXCUI2' , 'RXAUI2' ,
+                             'STYPE2' , 'RELA' , 'RUI' , 'SRUI' , 'SAB' , 'SL' , 'DIR' ,
+                             'RG' , 'SUPPRESS' , 'CVF' , '' ] }
+
+## The columns we keep
+kept_columns = { 'MRCONSO' : [ 'CUI' , 'LAT' , 'TS' , 'STT' , 'ISPREF' , 'AUI' ,
+                               'SAB' , 'TTY' , 'CODE' , 'STR' , 'SUPPRESS' ] ,
+                 'MRSTY' : [ 'CUI' , 'TUI' , 'STY' ] ,
+                 'RXNCONSO' : [ 'RXCUI' , 'RXAUI' , 'SAB' , 'TTY' , 'CODE' , 'STR' ,
+                                'SUPPRESS' ] ,
+                 'RXNREL' : [ 'RXCUI1' , 'STYPE1' , 'RXCUI2' , 'STYPE2' , 'RELA' , 'SAB' ,
+                              'SUPPRESS' ] }
+
+## MRSTY has no SAB column and is small enough to keep whole
+partition_columns = { 'MRCONSO' : [ 'SAB' ] ,
+                      'MRSTY' : [] ,
+                      'RXNCONSO' : [ 'SAB' ] ,
+                      'RXNREL' : [ 'SAB' ] }
+
+#############################################
+##
+#############################################
+
+def initialize_arg_parser():
+    parser = argparse.ArgumentParser( description = """
+    Convert UMLS/RxNorm RRF tables into SAB-partitioned Parquet datasets for kb_gen
+    """ )
+    parser.add_argument( '-v' , '--verbose' ,
+                         help = "print more information" ,
+                         action = "store_true" )
+
+    parser.add_argument( '--input-dir' , required = True ,
+                         dest = 'inputDir' ,
+                         help = 'Directory holding the .RRF tables (MRCONSO, MRSTY, RXNCONSO, RXNREL)' )
+
+    parser.add_argument( '--parquet-dir' , required = True ,
+                         dest = 'parquetDir' ,
+                         help = 'Directory to write the Parquet datasets to' )
+
+    parser.add_argument( '--tables' , default = ','.join( sorted( rrf_columns ) ) ,
+                         dest = 'tables' ,
+                         help = 'Comma-separated tables to convert (missing ones are skipped)' )
+    ##
+    return parser
+
+
+def require_pyarrow():
+    if( pa is None ):
+        raise ImportError( 'Parquet support requires pyarrow (pip install pyarrow)' )
+
+
+def dataset_dir( parquet_dir , table ):
+    return( os.path.join( parquet_dir , table ) )
+
+
+def has_table( parquet_dir , table ):
+    return( parquet_dir is not None and
+            os.path.isdir( dataset_dir( parquet_dir , table ) ) )
+
+#############################################
+##
+#############################################
+
+def convert_table( rrf_file , parquet_dir , table ):
+    """
+    Stream one RRF file into a Parquet dataset, replacing any earlier
+    conversion of the table
+    """
+    require_pyarrow()
+    columns = rrf_columns[ table ]
+    ## RRF values are never quoted; read them as strings verbatim
+    reader = pa_csv.open_csv( rrf_file ,
+                              read_options = pa_csv.ReadOptions( column_names = columns ) ,
+                              parse_options = pa_csv.ParseOptions( delimiter = '|' ,
+                                                                   quote_char = False ,
+                                                                   escape_char = False ) ,
+                              convert_options = pa_csv.ConvertOptions(
+                                  include_columns = kept_columns[ table ] ,
+                                  column_types = dict( ( name , pa.string() )
+                                                       for name in kept_columns[ table ] ) ) )
+    out_dir = dataset_dir( parquet_dir , table )
+    if( os.path.exists( out_dir ) ):
+        shutil.rmtree( out_dir )
+    ## Single-threaded writes keep each partition in file order
+    pa_ds.write_dataset( reader , out_dir ,
+                         format = 'parquet' ,
+                         partitioning = partition_columns[ table ] or None ,
+                         partitioning_flavor = 'hive' if partition_columns[ table ] else None ,
+                         use_threads = False )
+    return( out_dir )
+
+
+def convert( input_dir , parquet_dir , tables = None ):
+    if( tables is None ):
+        tables = sorted( rrf_columns )
+    converted = []
+    for table in tables:
+        rrf_file = os.path.join( input_dir , '{}.RRF'.format( table ) )
+        if( not os.path.exists( rrf_file ) ):
+            log.debug( 'Skipping missing table:  {}'.format( rrf_file ) )
+            continue
+        log.info( 'Converting {}'.format( table ) )
+        convert_table( rrf_file , parquet_dir , table )
+        converted.append( table )
+    return( converted )
+
+#############################################
+##
+#############################################
+
+def read_rows( parquet_dir , table , headers , fields , filters = None ):
+    """
+    Yield rows of a converted table laid out like the RRF columns, so
+    `cols[ headers[ 'X' ] - 1 ]` works as it does for csv.reader rows.
+    Only the `fields` (keys of `headers`) are read, the rest are left
+    empty, and `filters` (pyarrow DNF tuples such as
+    ( 'SAB' , '=' , 'ATC' )) are applied before any row reaches Python,
+    skipping whole SAB partitions where possible.
+    """
+    require_pyarrow()
+    positions = [ headers[ field ] for field in fields ]
+    names = [ rrf_columns[ table ][ position - 1 ] for position in positions ]
+    data = pq.read_table( dataset_dir( parquet_dir , table ) ,
+                          columns = names ,
+                          filters = filters ,
+                          partitioning = 'hive' if partition_columns[ table ] else None ).to_pydict()
+    width = max( headers.values() )
+    for values in zip( *[ data[ name ] for name in names ] ):
+        cols = [ '' ] * width
+        for position , value in zip( positions , values ):
+            cols[ position - 1 ] = '' if value is None else str( value )
+        yield( cols )
+
+#############################################
+##
+#############################################
+
+if __name__ == "__main__":
+    ##
+    log.basicConfig( level = log.INFO )
+    args = initialize_arg_parser().parse_args( sys.argv[ 1: ] )
+    if( args.verbose ):
+        log.getLogger().setLevel( log.DEBUG )
+    if( not os.path.exists( args.inputDir ) ):
+        log.error( 'The input directory does not exist:  {}'.format( args.inputDir ) )
+        exit( 1 )
+    converted = convert( args.inputDir , args.parquetDir ,
+                         tables = [ table.strip() for table in args.tables.split( ',' )
+                                    if table.strip() != '' ] )
+    print( 'Converted {} into {}'.format( ', '.join( converted ) , args.parquetDir ) )
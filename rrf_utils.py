@@ -0,0 +1,188 @@
+import logging as log
+
+import os
+
+from collections import namedtuple
+
+########################################################################
+## Readers for the UMLS Rich Release Format (RRF) tables we use
+## (MRCONSO, MRREL, MRSTY) and an in-memory store answering the
+## handful of questions the local engine asks of them.  Any other
+## store (e.g., an indexed database) only has to provide the same
+## five look-up methods as RrfStore.
+########################################################################
+
+## 1-based column positions, as in kb_gen
+mrconso_headers = { 'CUI' : 1 ,
+                    'LAT' : 2 ,
+                    'TS' : 3 ,
+                    'LUI' : 4 ,
+                    'STT' : 5 ,
+                    'SUI' : 6 ,
+                    'ISPREF' : 7 ,
+                    'AUI' : 8 ,
+                    'SAUI' : 9 ,
+                    'SCUI' : 10 ,
+                    'SDUI' : 11 ,
+                    'SAB' : 12 ,
+                    'TTY' : 13 ,
+                    'CODE' : 14 ,
+                    'STR' : 15 ,
+                    'SRL' : 16 ,
+                    'SUPPRESS' : 17 ,
+                    'CVF' : 18 }
+mrrel_headers = { 'CUI1' : 1 ,
+                  'AUI1' : 2 ,
+                  'STYPE1' : 3 ,
+                  'REL' : 4 ,
+                  'CUI2' : 5 ,
+                  'AUI2' : 6 ,
+                  'STYPE2' : 7 ,
+                  'RELA' : 8 ,
+                  'RUI' : 9 ,
+                  'SRUI' : 10 ,
+                  'SAB' : 11 ,
+                  'SL' : 12 ,
+                  'RG' : 13 ,
+                  'DIR' : 14 ,
+                  'SUPPRESS' : 15 ,
+                  'CVF' : 16 }
+mrsty_headers = { 'CUI' : 1 ,
+                  'TUI' : 2 ,
+                  'STN' : 3 ,
+                  'STY' : 4 ,
+                  'ATUI' : 5 ,
+                  'CVF' : 6 }
+
+## Source-level hierarchical relations (e.g., SNOMED CT's is-a) that
+## back get_family_tree.  REL describes the second atom relative to
+## the first, so a PAR row means "AUI2 is a parent of AUI1".
+SOURCE_HIERARCHY_RELS = [ 'PAR' , 'CHD' ]
+
+## SUPPRESS values for rows UTS returns by default (O, E and Y mark
+## obsolete or suppressible content)
+UNSUPPRESSED = [ 'N' , '' ]
+
+## The parts of each table we keep
+ConsoRow = namedtuple( 'ConsoRow' , [ 'cui' , 'lat' , 'ts' , 'stt' , 'ispref' ,
+                                      'aui' , 'sab' , 'tty' , 'code' , 'str' ,
+                                      'suppress' ] )
+StyRow = namedtuple( 'StyRow' , [ 'tui' , 'sty' ] )
+## A concept-level relation as seen from CUI2:  the related CUI is
+## CUI1 and `rel` is how CUI2 relates to it (RB => CUI2 is broader)
+RelRow = namedtuple( 'RelRow' , [ 'related_cui' , 'rel' , 'sab' , 'suppress' ] )
+## A source-level hierarchy relation as seen from the code of AUI2
+SourceRelRow = namedtuple( 'SourceRelRow' , [ 'related_code' , 'rel' , 'suppress' ] )
+
+#############################################
+##
+#############################################
+
+def read_rrf( filename ):
+    """
+    Yield each row of an RRF file as a list of column values.  RRF
+    values are never quoted, so we split on '|' rather than going
+    through csv (which would mangle strings containing '"').
+    """
+    with open( filename , 'r' , encoding = 'utf-8' ) as fp:
+        for line in fp:
+            yield( line.rstrip( '\n' ).split( '|' ) )
+
+
+def conso_row( cols ):
+    return( ConsoRow( cui = cols[ mrconso_headers[ 'CUI' ] - 1 ] ,
+                      lat = cols[ mrconso_headers[ 'LAT' ] - 1 ] ,
+                      ts = cols[ mrconso_headers[ 'TS' ] - 1 ] ,
+                      stt = cols[ mrconso_headers[ 'STT' ] - 1 ] ,
+                      ispref = cols[ mrconso_headers[ 'ISPREF' ] - 1 ] ,
+                      aui = cols[ mrconso_headers[ 'AUI' ] - 1 ] ,
+                      sab = cols[ mrconso_headers[ 'SAB' ] - 1 ] ,
+                      tty = cols[ mrconso_headers[ 'TTY' ] - 1 ] ,
+                      code = cols[ mrconso_headers[ 'CODE' ] - 1 ] ,
+                      str = cols[ mrconso_headers[ 'STR' ] - 1 ] ,
+                      suppress = cols[ mrconso_headers[ 'SUPPRESS' ] - 1 ] ) )
+
+
+def is_concept_relation( cols ):
+    return( cols[ mrrel_headers[ 'STYPE1' ] - 1 ] == 'CUI' and
+            cols[ mrrel_headers[ 'STYPE2' ] - 1 ] == 'CUI' )
+
+
+def is_source_hierarchy_relation( cols ):
+    return( cols[ mrrel_headers[ 'REL' ] - 1 ] in SOURCE_HIERARCHY_RELS and
+            cols[ mrrel_headers[ 'STYPE1' ] - 1 ] != 'CUI' )
+
+
+def rrf_file( rrf_dir , table ):
+    filename = os.path.join( rrf_dir , '{}.RRF'.format( table ) )
+    if( not os.path.exists( filename ) ):
+        raise IOError( 'Missing RRF table:  {}'.format( filename ) )
+    return( filename )
+
+#############################################
+##
+#############################################
+
+class RrfStore:
+    """
+    Loads MRCONSO, MRREL and MRSTY from `rrf_dir` into dictionaries.
+    Fine for subsets; a full UMLS release needs an indexed store.
+    """
+
+    def __init__( self , rrf_dir ):
+        self.rrf_dir = rrf_dir
+        self._conso = {}
+        self._sty = {}
+        self._rel = {}
+        self._code_cuis = {}
+        self._source_rel = {}
+        aui_codes = {}
+        log.debug( 'Loading MRCONSO from {}'.format( rrf_dir ) )
+        for cols in read_rrf( rrf_file( rrf_dir , 'MRCONSO' ) ):
+            row = conso_row( cols )
+            self._conso.setdefault( row.cui , [] ).append( row )
+            cuis = self._code_cuis.setdefault( ( row.sab , row.code ) , [] )
+            if( row.cui not in cuis ):
+                cuis.append( row.cui )
+            aui_codes[ row.aui ] = ( row.sab , row.code )
+        log.debug( 'Loading MRSTY from {}'.format( rrf_dir ) )
+        for cols in read_rrf( rrf_file( rrf_dir , 'MRSTY' ) ):
+            self._sty.setdefault( cols[ mrsty_headers[ 'CUI' ] - 1 ] , [] ).append(
+                StyRow( tui = cols[ mrsty_headers[ 'TUI' ] - 1 ] ,
+                        sty = cols[ mrsty_headers[ 'STY' ] - 1 ] ) )
+        log.debug( 'Loading MRREL from {}'.format( rrf_dir ) )
+        for cols in read_rrf( rrf_file( rrf_dir , 'MRREL' ) ):
+            rel = cols[ mrrel_headers[ 'REL' ] - 1 ]
+            suppress = cols[ mrrel_headers[ 'SUPPRESS' ] - 1 ]
+            if( is_concept_relation( cols ) ):
+                self._rel.setdefault( cols[ mrrel_headers[ 'CUI2' ] - 1 ] , [] ).append(
+                    RelRow( related_cui = cols[ mrrel_headers[ 'CUI1' ] - 1 ] ,
+                            rel = rel ,
+                            sab = cols[ mrrel_headers[ 'SAB' ] - 1 ] ,
+                            suppress = suppress ) )
+            elif( is_source_hierarchy_relation( cols ) ):
+                sab = cols[ mrrel_headers[ 'SAB' ] - 1 ]
+                atom1 = aui_codes.get( cols[ mrrel_headers[ 'AUI1' ] - 1 ] )
+                atom2 = aui_codes.get( cols[ mrrel_headers[ 'AUI2' ] - 1 ] )
+                if( atom1 is None or atom2 is None or
+                    atom1[ 0 ] != sab or atom2[ 0 ] != sab ):
+                    continue
+                self._source_rel.setdefault( atom2 , [] ).append(
+                    SourceRelRow( related_code = atom1[ 1 ] ,
+                                  rel = rel ,
+                                  suppress = suppress ) )
+
+    def conso_rows( self , cui ):
+        return( self._conso.get( cui , [] ) )
+
+    def sty_rows( self , cui ):
+        return( self._sty.get( cui , [] ) )
+
+    def rel_rows( self , cui ):
+        return( self._rel.get( cui , [] ) )
+
+    def code_cuis( self , sab , code ):
+        return( self._code_cuis.get( ( sab , code ) , [] ) )
+
+    def source_rel_rows( self , sab , code ):
+        return( self._source_rel.get( ( sab , code ) , [] ) )
@@ -37,19 +37,15 @@ def parse_snomedct_core( filename ):
             concepts[ cui ][ 'variant_terms' ] = set()
             continue
             auth_client = uu.init_authentication( uu.UMLS_API_TOKEN )
-        preferred_term = uu.get_cuis_preferred_atom( auth_client ,
-                                                     'current' ,
-                                                     cui )
-        concepts[ cui ][ 'preferred_term' ] = preferred_term
-        ## TODO - make this function call less surprising
-        ## TODO - check if multiple TUIs are possible
-        tui = uu.get_cuis_atom( auth_client , 'current' ,
-                                 cui , atom_type = '' )
-        concepts[ cui ][ 'tui' ] = tui
-        variant_terms = uu.get_cuis_eng_atom( auth_client ,
-                                              'current' ,
-                                              cui )
-        concepts[ cui ][ 'variant_terms' ] = variant_terms
+        bundle = uu.get_concept_bundle( auth_client , 'current' , cui )
+        if( bundle is None ):
+            concepts[ cui ][ 'preferred_term' ] = None
+            concepts[ cui ][ 'tui' ] = None
+            concepts[ cui ][ 'variant_terms' ] = set()
+            continue
+        concepts[ cui ][ 'preferred_term' ] = bundle.name
+        concepts[ cui ][ 'tui' ] = bundle.tuis[ 0 ] if bundle.tuis else None
+        concepts[ cui ][ 'variant_terms' ] = bundle.eng_atoms
         ##print( '{}\t{}'.format( cui , preferred_term ) )
     return( concepts )
 
@@ -6,13 +6,17 @@ import csv
 
 from tqdm import tqdm
 
-import requests
+import copy
+import functools
 import json
 
-import pickle
-
+import async_umls_utils as aio
+import checkpoint_utils
 import concept_mapper_utils as cm
+import concept_store
+import parallel_utils
 import umls_utils as uu
+import work_queue
 
 try:
     from umls.umls import UMLSLookup
@@ -27,6 +31,109 @@ except ImportError:
 ##
 ########################################################################
 
+def use_umls_engine( engine ):
+    """
+    Answer every UMLS look-up in this module with `engine`:  the
+    umls_utils module (UTS REST API, the default) or anything with the
+    same functions, e.g., a local_umls_utils.LocalUmlsEngine.
+    """
+    global uu
+    uu = engine
+    return( uu )
+
+
+def with_workers( workers , heads , walk , replay , queue_file = None ,
+                  lease_seconds = work_queue.DEFAULT_LEASE_SECONDS ):
+    """
+    Run `walk( share )` for shares of `heads` on `workers` processes
+    (or, given a `queue_file`, as tasks leased for `lease_seconds` to
+    workers on other machines; see work_queue), each recording the
+    look-ups it makes, and then
+    `replay()` the serial walk with those look-ups answered from the
+    recordings (see parallel_utils).  The replay decides every head
+    attribution, so the result is the same as running it alone.
+    """
+    engine = uu
+    if( queue_file is not None ):
+        use_umls_engine( work_queue.distribute( engine , heads , workers ,
+                                                walk = walk ,
+                                                install = use_umls_engine ,
+                                                queue_file = queue_file ,
+                                                lease_seconds = lease_seconds ) )
+    else:
+        use_umls_engine( parallel_utils.prefetch( engine , heads , workers ,
+                                                  walk = walk ,
+                                                  install = use_umls_engine ) )
+    try:
+        return( replay() )
+    finally:
+        log.debug( 'Replayed look-ups:  {} recorded , {} new'.format( uu.hits , uu.misses ) )
+        use_umls_engine( engine )
+
+
+def open_checkpoint( partials_dir , cui_dict , concepts ):
+    """
+    ( journal , cui_dict , concepts , resume ) for a run checkpointed
+    in `partials_dir`, picking up the state an earlier run left there
+    if any (see checkpoint_utils.ResumeManager).  Without a partials
+    directory there is no journal and nothing is done yet.
+    """
+    if( partials_dir is None ):
+        return( None , cui_dict , concepts , checkpoint_utils.ResumeManager( None ) )
+    journal = checkpoint_utils.CheckpointJournal( partials_dir )
+    state , resume = journal.open( { 'cui_dict' : cui_dict ,
+                                     'concepts' : concepts ,
+                                     'queue' : {} ,
+                                     'snomed' : {} } )
+    ## Checkpoints from before the walk queues were journaled
+    state.setdefault( 'queue' , {} )
+    state.setdefault( 'snomed' , {} )
+    return( journal , state[ 'cui_dict' ] , state[ 'concepts' ] , resume )
+
+
+def checkpoint( journal , stage , key , cui_dict , concepts ,
+                heads = () , cuis = () , queued = () ):
+    ## Journal what one step changed:  the cui_dict entries of `heads`
+    ## and the concepts entries of `cuis`.  A head's related_cuis only
+    ## ever grows by the CUIs seeded under it, so those are logged one
+    ## link at a time rather than as whole (ever larger) sets.  The
+    ## `queued` ops (from queue_ops) are applied to the journaled state
+    ## here, as the walk queues are not kept anywhere else.
+    if( journal is None ):
+        return
+    checkpoint_utils.apply_ops( journal.state , queued )
+    ops = [ ( 'set' , 'cui_dict' , head_cui , cui_dict[ head_cui ] )
+            for head_cui in heads
+            if( head_cui in cui_dict ) ]
+    for cui in cuis:
+        if( cui not in concepts ):
+            continue
+        ops.append( ( 'update' , 'concepts' , cui ,
+                      dict( ( field , value ) for field , value in concepts[ cui ].items()
+                            if( field != 'related_cuis' ) ) ) )
+        head_cui = concepts[ cui ].get( 'head_cui' )
+        if( head_cui in concepts and
+            cui in concepts[ head_cui ].get( 'related_cuis' , () ) ):
+            ops.append( ( 'add' , 'concepts' , head_cui , 'related_cuis' , cui ) )
+    journal.record( stage , key , ops + list( queued ) )
+
+
+def queue_ops( walk , distance , cuis = () , snomed_pairs = () ):
+    """
+    Checkpoint ops putting `cuis` (and SNOMED CT ( concept id , head
+    CUI ) `snomed_pairs`) on the queue of parse_problems_queue walk
+    `walk` at `distance`
+    """
+    ops = []
+    if( len( cuis ) > 0 ):
+        ops.append( ( 'update' , 'queue' , walk ,
+                      dict( ( cui , distance ) for cui in cuis ) ) )
+    if( len( snomed_pairs ) > 0 ):
+        ops.append( ( 'update' , 'snomed' , walk ,
+                      dict( ( tuple( pair ) , distance ) for pair in snomed_pairs ) ) )
+    return( ops )
+
+
 def add_variant_term( auth_client , concepts , cui , variant , head = None ):
     log.debug( 'Adding variant term {} ~ {}'.format( cui , variant ) )
     ## Make sure we have a CUI entry to hang this variant on
@@ -37,8 +144,7 @@ def add_variant_term( auth_client , concepts , cui , variant , head = None ):
         concepts[ cui ][ 'preferred_term' ] = ''
         concepts[ cui ][ 'tui' ] = ''
         concepts[ cui ][ 'variant_terms' ] = set()
-    if( variant not in concepts[ cui ][ 'variant_terms' ] ):
-        concepts[ cui ][ 'variant_terms' ].add( variant )
+    concept_store.add_variant_term( concepts[ cui ] , variant )
     return( concepts )
 
 
@@ -61,7 +167,16 @@ def seed_concept( concepts , cui , head = None ):
     return( concepts )
 
 
-def flesh_out_seed_concept( auth_client , concepts , cui ):
+def get_concept_details( auth_client , cui ):
+    ## Returns ( preferred term , TUI , ENG atoms ).  Only the first
+    ## TUI is kept for the concept.
+    bundle = uu.get_concept_bundle( auth_client , 'current' , cui )
+    return( aio.concept_details( bundle ) )
+
+
+def flesh_out_seed_concept( auth_client , concepts , cui , details = None ):
+    ## `details` may hold the result of an earlier (e.g., concurrent)
+    ## call to get_concept_details for this CUI
     log.debug( 'Fleshing out {} ( total concepts = {} )'.format( cui , len( concepts ) ) )
     if( cui not in concepts ):
         log.warn( 'CUI \'{}\' was never seeded. Skipping'.format( cui ) )
@@ -73,21 +188,14 @@ def flesh_out_seed_concept( auth_client , concepts , cui ):
         concepts[ cui ][ 'tui' ] = ''
         concepts[ cui ][ 'variant_terms' ] = set()
         ##
-        preferred_term = uu.get_cuis_preferred_atom( auth_client ,
-                                                     'current' ,
-                                                     cui )
+        if( details is None ):
+            details = get_concept_details( auth_client , cui )
+        preferred_term , tui , variant_terms = details
         if( preferred_term is None ):
             return( concepts )
         concepts[ cui ][ 'preferred_term' ] = preferred_term
-        ## TODO - make this function call less surprising
-        ## TODO - check if multiple TUIs are possible
-        tui = uu.get_cuis_atom( auth_client , 'current' ,
-                                cui , atom_type = '' )
         concepts[ cui ][ 'tui' ] = tui
         ##
-        variant_terms = uu.get_cuis_eng_atom( auth_client ,
-                                              'current' ,
-                                              cui )
         log.debug( '\tVariant Terms:  {}'.format( variant_terms ) )
         concepts[ cui ][ 'variant_terms' ] = variant_terms
     ##
@@ -176,13 +284,9 @@ def flesh_out_concept_via_py_umls( concepts , cui , head = None ):
 ########################################################################
 
 def get_related_rxnorm_concepts( auth_client , concepts , rxcui_str , relation , head = None ):
-    base_uri = 'https://rxnav.nlm.nih.gov/REST/'
     content_endpoint = "rxcui/" + rxcui_str + "/related.json?tty=" + relation
-    ##log( base_uri , content_endpoint )
-    r = requests.get( base_uri + content_endpoint )
-    r.encoding = 'utf-8'
-    ##log( r )
-    items  = json.loads(r.text)
+    ##log( uu.RXNAV_URI , content_endpoint )
+    items  = uu.rxnav_get_json( content_endpoint )
     all_cuis = set()
     groupData = items[ "relatedGroup" ][ "conceptGroup" ]
     ##log( items , groupData )
@@ -221,6 +325,7 @@ def parse_focused_allergens( input_filename ,
     ##
     cui_dict = {}
     synonym_dict = {}
+    journal , cui_dict , concepts , resume = open_checkpoint( partials_dir , cui_dict , concepts )
     ##
     with open( input_filename , 'r' ) as in_fp:
         in_tsv = csv.DictReader( in_fp , dialect=csv.excel_tab )
@@ -248,20 +353,18 @@ def parse_focused_allergens( input_filename ,
             include_parents_str = cols[ 8 ]
             ## Children to be excluded
             exclude_children_str = cols[ 9 ] ## Children to be excluded
-            ## Do we need to process this line or can we just update our
-            ## model with a partial already saved in a pickle?
-            pickle_file = os.path.join( partials_dir , 'processed_{}.pkl'.format( head_cui ) )
-            if( partials_dir is not None and
-                os.path.exists( pickle_file ) ):
-                log.debug( 'Pickle file already exists for CUI {}. Loading and continuing to next.'.format( head_cui ) )
-                with open( pickle_file , 'rb' ) as fp:
-                    cui_dict , synonym_dict , concepts = pickle.load( fp )
+            ## Do we need to process this line or was it checkpointed
+            ## by an earlier run?
+            if( resume.is_done( 'heads' , head_cui ) ):
+                log.debug( 'CUI {} was already checkpointed. Continuing to next.'.format( head_cui ) )
                 continue
             ## Re-up the authentication token for every row
             auth_client = uu.init_authentication( uu.UMLS_API_TOKEN )
             ##
             cui_dict[ head_cui ] = {}
             synonym_dict = set()
+            ## Everything this row may change in concepts
+            touched = [ head_cui ]
             log.debug( 'Old CUI:\t{}'.format( head_cui ) )
             ##
             cui_dict[ head_cui ][ 'include_umls_parents_flag' ] = None
@@ -334,6 +437,7 @@ def parse_focused_allergens( input_filename ,
             if( rxcui_str.isdigit() ):
                 log.debug( '\tRx: {}'.format( rxcui_str ) )
                 concepts , brand_cuis = get_rxcui_brands( auth_client , concepts , rxcui_str , head = head_cui )
+                touched += brand_cuis
                 for brand_cui in tqdm( brand_cuis , desc = 'Finding Brands' ,
                                        leave = False ,
                                        file = sys.stdout ):
@@ -342,6 +446,7 @@ def parse_focused_allergens( input_filename ,
                     log.debug( '\t\tD:  {}'.format( brand_cui ) )
                     synonym_dict.add( brand_cui )
                 concepts , ingredient_cuis = get_rxcui_ingredients( auth_client , concepts , rxcui_str , head = head_cui )
+                touched += ingredient_cuis
                 for ingredient_cui in tqdm( ingredient_cuis , desc = 'Finding Ingredients' ,
                                             leave = False ,
                                             file = sys.stdout ):
@@ -363,12 +468,14 @@ def parse_focused_allergens( input_filename ,
                         for umls_cui in rxcuis_umls_cui:
                             synonym_dict.add( umls_cui )
                         concepts , brand_cuis = get_rxcui_brands( auth_client , concepts , this_rxcui , head = head_cui )
+                        touched += brand_cuis
                         for brand_cui in brand_cuis:
                             if( brand_cui in cui_dict[ head_cui ][ 'descendants_exclude_list' ] ):
                                 continue
                             log.debug( '\t\t\tD:  {}'.format( brand_cui ) )
                             synonym_dict.add( brand_cui )
                         concepts , ingredient_cuis = get_rxcui_ingredients( auth_client , concepts , this_rxcui , head = head_cui )
+                        touched += ingredient_cuis
                         for ingredient_cui in ingredient_cuis:
                             if( ingredient_cui in cui_dict[ head_cui ][ 'descendants_exclude_list' ] ):
                                 continue
@@ -380,23 +487,70 @@ def parse_focused_allergens( input_filename ,
             #all_eng_atoms.add( head_atom )
             for cui in synonym_dict:
                 concepts = flesh_out_concept( auth_client , concepts , cui , head = head_cui )
-            ## At the end of every loop, we want to update our partial file
-            ## with the latest datastructures (in pickle form)
-            if( partials_dir is not None ):
-                with open( os.path.join( partials_dir , 'processed_{}.pkl'.format( head_cui ) ) , 'wb' ) as fp:
-                    pickle.dump( [ cui_dict , synonym_dict , concepts ] , fp )
+            ## At the end of every loop, we journal what the row changed
+            checkpoint( journal , 'heads' , head_cui , cui_dict , concepts ,
+                        heads = [ head_cui ] ,
+                        cuis = touched + sorted( synonym_dict ) )
+    if( journal is not None ):
+        journal.close()
     ####
     return( concepts )
 
 
+def allergen_heads( input_filename ):
+    heads = []
+    with open( input_filename , 'r' ) as in_fp:
+        in_tsv = csv.DictReader( in_fp , dialect = 'excel-tab' )
+        for cols in in_tsv:
+            if( len( next( iter( cols ) ) ) > 0 and
+                cols[ 'CUI' ] is not None and
+                cols[ 'CUI' ] != '' ):
+                heads.append( cols[ 'CUI' ] )
+    return( heads )
+
+
+def walk_allergen_share( input_filename , concepts , max_distance , concurrency , share ):
+    ## Module level (not a lambda) so it can be pickled into a work queue
+    parse_allergens( input_filename ,
+                     concepts = copy.deepcopy( concepts ) ,
+                     max_distance = max_distance ,
+                     concurrency = concurrency ,
+                     heads = set( share ) )
+    concept_store.TERMS.clear()
+
+
 def parse_allergens( input_filename ,
                      concepts = {} ,
                      partials_dir = None ,
-                     max_distance = -1 ):
+                     max_distance = -1 ,
+                     concurrency = aio.DEFAULT_CONCURRENCY ,
+                     workers = 1 ,
+                     heads = None ,
+                     queue_file = None ,
+                     lease_seconds = work_queue.DEFAULT_LEASE_SECONDS ):
+    ## `heads`, if given, limits the run to the rows for those CUIs
+    if( workers > 1 or
+        queue_file is not None ):
+        ## Workers on other machines read the sheet from the same
+        ## (shared) path
+        return( with_workers( workers , allergen_heads( input_filename ) ,
+                              walk = functools.partial( walk_allergen_share ,
+                                                        os.path.abspath( input_filename ) ,
+                                                        concepts ,
+                                                        max_distance ,
+                                                        concurrency ) ,
+                              replay = lambda : parse_allergens( input_filename ,
+                                                                 concepts = concepts ,
+                                                                 partials_dir = partials_dir ,
+                                                                 max_distance = max_distance ,
+                                                                 concurrency = concurrency ) ,
+                              queue_file = queue_file ,
+                              lease_seconds = lease_seconds ) )
     ##
     cui_dict = {}
     standalone_queue = []
     mth_queue = []
+    journal , cui_dict , concepts , resume = open_checkpoint( partials_dir , cui_dict , concepts )
     ##
     expected_count = 0
     with open( input_filename , 'r' ) as in_fp:
@@ -430,20 +584,23 @@ def parse_allergens( input_filename ,
             rxcui_str = cols[ 'RxNORM (RxCUI)' ]
             include_parents_str = cols[ 'Include parents (RxNORM ancestors)?' ]
             exclude_children_str = cols[ 'Children to be excluded' ]
-            ## Do we need to process this line or can we just update our
-            ## model with a partial already saved in a pickle?
-            pickle_file = os.path.join( partials_dir , 'processed_{}.pkl'.format( head_cui ) )
-            if( partials_dir is not None and
-                os.path.exists( pickle_file ) ):
-                log.debug( 'Pickle file already exists for CUI {}. Loading and continuing to next.'.format( head_cui ) )
-                with open( pickle_file , 'rb' ) as fp:
-                    cui_dict , concepts = pickle.load( fp )
+            if( heads is not None and
+                head_cui not in heads ):
+                continue
+            ## Do we need to process this line or was it checkpointed
+            ## by an earlier run?
+            if( resume.is_done( 'heads' , head_cui ) ):
+                log.debug( 'CUI {} was already checkpointed. Continuing to next.'.format( head_cui ) )
                 continue
             ## Re-up the authentication token for every row
             auth_client = uu.init_authentication( uu.UMLS_API_TOKEN )
             ##
             cui_dict[ head_cui ] = {}
             concepts = seed_concept( concepts , cui = head_cui , head = None )
+            ## Everything this row may change in concepts, besides what
+            ## it queues up
+            touched = [ head_cui ]
+            queued = ( len( standalone_queue ) , len( mth_queue ) )
             log.debug( 'Old CUI:\t{}'.format( head_cui ) )
             ##
             cui_dict[ head_cui ][ 'include_umls_parents_flag' ] = None
@@ -538,6 +695,7 @@ def parse_allergens( input_filename ,
                 max_distance != 0 ):
                 log.debug( '\tRx: {}'.format( rxcui_str ) )
                 concepts , brand_cuis = get_rxcui_brands( auth_client , concepts , rxcui_str , head = head_cui )
+                touched += brand_cuis
                 for brand_cui in tqdm( brand_cuis ,
                                        desc = 'Seeding Brands' ,
                                        leave = False ,
@@ -548,6 +706,7 @@ def parse_allergens( input_filename ,
                     concepts = seed_concept( concepts , brand_cui , head_cui )
                     mth_queue.append( brand_cui )
                 concepts , ingredient_cuis = get_rxcui_ingredients( auth_client , concepts , rxcui_str , head = head_cui )
+                touched += ingredient_cuis
                 for ingredient_cui in tqdm( ingredient_cuis ,
                                             desc = 'Seeding Ingredients' ,
                                             leave = False ,
@@ -576,6 +735,7 @@ def parse_allergens( input_filename ,
                             concepts = seed_concept( concepts , umls_cui , head_cui )
                             mth_queue.append( umls_cui )
                         concepts , brand_cuis = get_rxcui_brands( auth_client , concepts , this_rxcui , head = head_cui )
+                        touched += brand_cuis
                         for brand_cui in tqdm( brand_cuis ,
                                                desc = 'Seeding Brands' ,
                                                leave = False ,
@@ -586,6 +746,7 @@ def parse_allergens( input_filename ,
                             concepts = seed_concept( concepts , brand_cui , head_cui )
                             mth_queue.append( brand_cui )
                         concepts , ingredient_cuis = get_rxcui_ingredients( auth_client , concepts , this_rxcui , head = head_cui )
+                        touched += ingredient_cuis
                         for ingredient_cui in tqdm( ingredient_cuis ,
                                                     desc = 'Seeding Ingredients' ,
                                                     leave = False ,
@@ -597,26 +758,39 @@ def parse_allergens( input_filename ,
                             mth_queue.append( ingredient_cui )
             ### Write out a uniq'd list of synonymous CUIs
             concepts = flesh_out_seed_concept( auth_client , concepts , head_cui )
-            ## At the end of every loop, we want to update our partial file
-            ## with the latest datastructures (in pickle form)
-            if( partials_dir is not None ):
-                with open( os.path.join( partials_dir , 'processed_{}.pkl'.format( head_cui ) ) , 'wb' ) as fp:
-                    pickle.dump( [ cui_dict , concepts ] , fp )
-    ####
+            ## At the end of every loop, we journal what the row changed
+            checkpoint( journal , 'heads' , head_cui , cui_dict , concepts ,
+                        heads = [ head_cui ] ,
+                        cuis = ( touched +
+                                 standalone_queue[ queued[ 0 ]: ] +
+                                 mth_queue[ queued[ 1 ]: ] ) ,
+                        queued = ( queue_ops( 'standalone' , 1 , standalone_queue[ queued[ 0 ]: ] ) +
+                                   queue_ops( 'mth' , 1 , mth_queue[ queued[ 1 ]: ] ) ) )
+    ## As for problems, whatever the standalone queue reaches is
+    ## claimed before the MTH queue is walked, so the two are not merged
+    ## (see parse_problems_via_api)
     concepts = parse_problems_queue( cui_dict ,
                                      concepts,
                                      partials_dir ,
                                      standalone_queue ,
                                      [] ,
                                      distance = 1 ,
-                                     max_distance = max_distance )
+                                     max_distance = max_distance  ,
+                                     concurrency = concurrency ,
+                                     journal = journal ,
+                                     walk = 'standalone' )
     concepts = parse_problems_queue( cui_dict ,
                                      concepts,
                                      partials_dir ,
                                      mth_queue ,
                                      [] ,
                                      distance = 1 ,
-                                     max_distance = max_distance )
+                                     max_distance = max_distance  ,
+                                     concurrency = concurrency ,
+                                     journal = journal ,
+                                     walk = 'mth' )
+    if( journal is not None ):
+        journal.close()
     ####
     return( concepts )
 
@@ -628,17 +802,14 @@ def parse_allergens( input_filename ,
 
 def parse_focused_problems_via_api( cui_dict , concepts = {} , partials_dir = None ):
     #######################################################################
-    dict_keys = sorted( cui_dict.keys() )
+    journal , cui_dict , concepts , resume = open_checkpoint( partials_dir , cui_dict , concepts )
+    ## Only the heads no earlier run got through
+    dict_keys = resume.remaining( 'heads' , sorted( cui_dict.keys() ) )
     for head_cui in tqdm( dict_keys , desc = 'Extracting Terms' ,
                           file = sys.stdout ):
-        pickle_file = os.path.join( partials_dir , 'processed_{}.pkl'.format( head_cui ) )
-        if( partials_dir is not None and
-            os.path.exists( pickle_file ) ):
-            log.debug( 'Pickle file already exists for CUI {}. Loading and continuing to next.'.format( head_cui ) )
-            with open( pickle_file , 'rb' ) as fp:
-                cui_dict , concepts = pickle.load( fp )
-            continue
         auth_client = uu.init_authentication( uu.UMLS_API_TOKEN )
+        ## Everything this head may change in concepts
+        touched = [ head_cui ]
         if( 'preferred_term' not in concepts[ head_cui ] or
             concepts[ head_cui ][ 'preferred_term' ] == '' ):
             preferred_term = uu.get_cuis_preferred_atom( auth_client ,
@@ -673,6 +844,7 @@ def parse_focused_problems_via_api( cui_dict , concepts = {} , partials_dir = No
                                     file = sys.stdout ):
                 log.debug( '\tP:  {}'.format( parent_cui ) )
                 concepts = flesh_out_concept( auth_client , concepts , parent_cui , head = head_cui )
+                touched.append( parent_cui )
         log.debug( 'Done with parents' )
         ##
         if( cui_dict[ head_cui ][ 'include_ro_flag' ] == True ):
@@ -686,6 +858,7 @@ def parse_focused_problems_via_api( cui_dict , concepts = {} , partials_dir = No
                                 file = sys.stdout ):
                 log.debug( '\tR:  {}'.format( ro_cui ) )
                 concepts = flesh_out_concept( auth_client , concepts , ro_cui , head = head_cui )
+                touched.append( ro_cui )
         log.debug( 'Done with ROs' )
         ##
         descendant_cuis = uu.get_all_umls_descendants( auth_client , head_cui ,
@@ -696,6 +869,7 @@ def parse_focused_problems_via_api( cui_dict , concepts = {} , partials_dir = No
                                     file = sys.stdout ):
             log.debug( '\tD:  {}'.format( descendant_cui ) )
             concepts = flesh_out_concept( auth_client , concepts , descendant_cui , head = head_cui )
+            touched.append( descendant_cui )
         log.debug( 'Done with descendants' )
         ##
         for snomed_cui in tqdm( cui_dict[ head_cui ][ 'snomed_parent_list' ] , desc = 'Finding SNOMED Parents' ,
@@ -703,6 +877,7 @@ def parse_focused_problems_via_api( cui_dict , concepts = {} , partials_dir = No
                                 file = sys.stdout ):
             log.debug( '\tR:  {}'.format( ro_cui ) )
             concepts = flesh_out_concept( auth_client , concepts , snomed_cui , head = head_cui )
+            touched.append( snomed_cui )
         ##
         for snomed_cui in tqdm( cui_dict[ head_cui ][ 'snomed_include_list' ] , desc = 'Finding SNOMED Concepts' ,
                                 leave = False ,
@@ -712,13 +887,15 @@ def parse_focused_problems_via_api( cui_dict , concepts = {} , partials_dir = No
             for descendant_cui in descendant_cuis:
                 log.debug( '\t\tD:  {}'.format( descendant_cui ) )
                 concepts = flesh_out_concept( auth_client , concepts , descendant_cui , head = head_cui )
+                touched.append( descendant_cui )
         log.debug( 'Done with SNOMED' )
-        ## At the end of every loop, we want to update our partial file
-        ## with the latest datastructures (in pickle form)
-        if( partials_dir is not None ):
-            with open( os.path.join( partials_dir , 'processed_{}.pkl'.format( head_cui ) ) , 'wb' ) as fp:
-                pickle.dump( [ cui_dict , concepts ] , fp )
+        ## At the end of every loop, we journal what the head changed
+        checkpoint( journal , 'heads' , head_cui , cui_dict , concepts ,
+                    heads = [ head_cui ] ,
+                    cuis = touched )
         ##print( '{}\t{}'.format( cui , preferred_term ) )
+    if( journal is not None ):
+        journal.close()
     return( cui_dict , concepts )
 
 
@@ -1041,14 +1218,20 @@ def parse_problems( input_filename ,
                     concepts = {} ,
                     engine = 'api' ,
                     partials_dir = None ,
-                    max_distance = -1 ):
+                    max_distance = -1 ,
+                    concurrency = aio.DEFAULT_CONCURRENCY ,
+                    workers = 1 ,
+                    queue_file = None ,
+                    lease_seconds = work_queue.DEFAULT_LEASE_SECONDS ):
     ## If no patials directory was provided, then initialized these
-    ## datastructures as empty
-    if( partials_dir is not None and
-        os.path.exists( os.path.join( partials_dir , 'parsed_tsv.pkl' ) ) ):
-        log.debug( 'Loading parsed_tsv.pkl' )
-        with open( os.path.join( partials_dir , 'parsed_tsv.pkl' ) , 'rb' ) as fp:
-            cui_dict , concepts = pickle.load( fp )
+    ## datastructures as empty.  A parsed_tsv.pkl cut short (or from an
+    ## older version, without a checksum) is ignored and re-parsed.
+    parsed_tsv = None
+    if( partials_dir is not None ):
+        parsed_tsv = checkpoint_utils.read_snapshot( os.path.join( partials_dir , 'parsed_tsv.pkl' ) )
+    if( parsed_tsv is not None ):
+        log.debug( 'Loaded parsed_tsv.pkl' )
+        cui_dict , concepts = parsed_tsv
     else:
         cui_dict , concepts = parse_focused_problems_tsv( input_filename = input_filename ,
                                                           concepts = concepts ,
@@ -1057,15 +1240,22 @@ def parse_problems( input_filename ,
         ## with the latest datastructures (in pickle form)
         if( partials_dir is not None ):
             log.debug( '\tSaving partials file for parsed tsv' )
-            with open( os.path.join( partials_dir , 'parsed_tsv.pkl' ) , 'wb' ) as fp:
-                pickle.dump( [ cui_dict , concepts ] , fp )
+            checkpoint_utils.save_snapshot( os.path.join( partials_dir , 'parsed_tsv.pkl' ) ,
+                                            [ cui_dict , concepts ] )
     ##
-    if( engine == 'api' and
-        uu.UMLS_API_TOKEN is not None ):
+    ## The 'local' engine walks the same path as the API but with
+    ## look-ups answered from RRF tables (see use_umls_engine)
+    if( ( engine == 'api' and
+          uu.UMLS_API_TOKEN is not None ) or
+        engine == 'local' ):
         cui_dict , concepts = parse_problems_via_api( cui_dict ,
                                                       concepts ,
                                                       partials_dir = partials_dir ,
-                                                      max_distance = max_distance )
+                                                      max_distance = max_distance ,
+                                                      concurrency = concurrency ,
+                                                      workers = workers ,
+                                                      queue_file = queue_file ,
+                                                      lease_seconds = lease_seconds )
     elif( engine == 'py-umls' and
           umls_lu is not None ):
         cui_dict , concepts = parse_focused_problems_via_py_umls( input_filename ,
@@ -1074,48 +1264,74 @@ def parse_problems( input_filename ,
     return( cui_dict , concepts )
 
 
+def walk_problem_share( cui_dict , concepts , max_distance , concurrency , share ):
+    ## Module level (not a lambda) so it can be pickled into a work queue
+    parse_problems_via_api( copy.deepcopy( dict( ( head_cui , cui_dict[ head_cui ] )
+                                                 for head_cui in share ) ) ,
+                            copy.deepcopy( concepts ) ,
+                            max_distance = max_distance ,
+                            concurrency = concurrency )
+    ## Only the look-ups are kept, so the terms pooled for this share
+    ## can go (workers serve many shares)
+    concept_store.TERMS.clear()
+
+
 def parse_problems_via_api( cui_dict ,
                             concepts = {} ,
                             partials_dir = None ,
-                            max_distance = -1 ):
+                            max_distance = -1 ,
+                            concurrency = aio.DEFAULT_CONCURRENCY ,
+                            workers = 1 ,
+                            queue_file = None ,
+                            lease_seconds = work_queue.DEFAULT_LEASE_SECONDS ):
+    if( workers > 1 or
+        queue_file is not None ):
+        return( with_workers( workers , cui_dict.keys() ,
+                              walk = functools.partial( walk_problem_share ,
+                                                        cui_dict ,
+                                                        concepts ,
+                                                        max_distance ,
+                                                        concurrency ) ,
+                              replay = lambda : parse_problems_via_api( cui_dict ,
+                                                                        concepts ,
+                                                                        partials_dir = partials_dir ,
+                                                                        max_distance = max_distance ,
+                                                                        concurrency = concurrency ) ,
+                              queue_file = queue_file ,
+                              lease_seconds = lease_seconds ) )
     #######################################################################
-    dict_keys = sorted( cui_dict.keys() )
+    journal , cui_dict , concepts , resume = open_checkpoint( partials_dir , cui_dict , concepts )
+    ## Only the heads no earlier run got through
+    dict_keys = resume.remaining( 'heads' , sorted( cui_dict.keys() ) )
     standalone_queue = []
     mth_queue = []
     snomed_queue = []
+    ## SNOMED CT concepts already queued (under the first head reaching
+    ## them)
+    snomed_seen = set()
     for head_cui in tqdm( dict_keys , desc = 'Extracting Terms' ,
                           file = sys.stdout ):
-        pickle_file = os.path.join( partials_dir , 'processed_{}.pkl'.format( head_cui ) )
-        if( partials_dir is not None and
-            os.path.exists( pickle_file ) ):
-            log.debug( 'Pickle file already exists for CUI {}. Loading and continuing to next.'.format( head_cui ) )
-            with open( pickle_file , 'rb' ) as fp:
-                cui_dict , concepts = pickle.load( fp )
-            continue
         auth_client = uu.init_authentication( uu.UMLS_API_TOKEN )
-        if( 'preferred_term' not in concepts[ head_cui ] or
-            concepts[ head_cui ][ 'preferred_term' ] == '' ):
-            preferred_term = uu.get_cuis_preferred_atom( auth_client ,
-                                                         'current' ,
-                                                         head_cui )
-            concepts[ head_cui ][ 'preferred_term' ] = preferred_term
-        ##
-        if( 'tui' not in concepts[ head_cui ] or
-            concepts[ head_cui ][ 'tui' ] == '' ):
-            ## TODO - make this function call less surprising
-            ## TODO - check if multiple TUIs are possible
-            tui = uu.get_cuis_atom( auth_client , 'current' ,
-                                    head_cui , atom_type = '' )
-            concepts[ head_cui ][ 'tui' ] = tui
+        ## Whatever this head seeds lands on one of the queues
+        queued = ( len( standalone_queue ) , len( mth_queue ) , len( snomed_queue ) )
+        missing_preferred_term = ( 'preferred_term' not in concepts[ head_cui ] or
+                                   concepts[ head_cui ][ 'preferred_term' ] == '' )
+        missing_tui = ( 'tui' not in concepts[ head_cui ] or
+                        concepts[ head_cui ][ 'tui' ] == '' )
+        missing_variant_terms = ( 'variant_terms' not in concepts[ head_cui ] or
+                                  not bool( concepts[ head_cui ][ 'variant_terms' ] ) )
+        if( missing_preferred_term or missing_tui or missing_variant_terms ):
+            ## One bundled look-up fills in whichever of the three are
+            ## still missing
+            preferred_term , tui , variant_terms = get_concept_details( auth_client , head_cui )
+            if( missing_preferred_term ):
+                concepts[ head_cui ][ 'preferred_term' ] = preferred_term
+            if( missing_tui ):
+                concepts[ head_cui ][ 'tui' ] = None if preferred_term is None else tui
+            if( missing_variant_terms ):
+                log.debug( '\tVariant Terms:  {}'.format( variant_terms ) )
+                concepts[ head_cui ][ 'variant_terms' ] = variant_terms
         ##
-        if( 'variant_terms' not in concepts[ head_cui ] or
-            not bool( concepts[ head_cui ][ 'variant_terms' ] ) ):
-            variant_terms = uu.get_cuis_eng_atom( auth_client ,
-                                                  'current' ,
-                                                  head_cui )
-            log.debug( '\tVariant Terms:  {}'.format( variant_terms ) )
-            concepts[ head_cui ][ 'variant_terms' ] = variant_terms
-            ##
         if( cui_dict[ head_cui ][ 'include_parents_flag' ] == True ):
             if( cui_dict[ head_cui ][ 'parents_include_list' ] == [] ):
                 parent_cuis = uu.get_rns( auth_client , 'current' , head_cui )
@@ -1159,46 +1375,67 @@ def parse_problems_via_api( cui_dict ,
             concepts = seed_concept( concepts , snomed_cui , head_cui )
         ##
         if( max_distance != 0 ):
-            for snomed_cui in tqdm( cui_dict[ head_cui ][ 'snomed_include_list' ] ,
-                                    desc = 'Finding SNOMED Concepts' ,
-                                    leave = False ,
-                                    file = sys.stdout ):
-                ## TODO NEXT - walk SNOMED in parallel to MTH
-                descendant_concept_ids = uu.get_family_tree( auth_client , 'current' ,
-                                                             snomed_cui ,
-                                                             relation_type = 'children' )
-                for descendant_concept_id in tqdm( descendant_concept_ids ,
-                                                   desc = 'Seeding SNOMED descendant concepts' ,
-                                                   leave = False ,
-                                                   file = sys.stdout ):
-                    descendant_cui = uu.get_cui( auth_client , 'current' ,
-                                                 descendant_concept_id , 'SNOMEDCT_US' )
-                    if( descendant_cui in exclude_list or
-                        descendant_cui in concepts ):
-                        continue
-                    concepts = seed_concept( concepts , descendant_cui , head_cui )
-                    mth_queue.append( descendant_cui )
+            ## The children of the SNOMED include list are seeded here,
+            ## in head order like the RB descendants, with their CUIs
+            ## resolved in one batch.  parse_problems_queue walks the
+            ## levels below them alongside the MTH walk.
+            child_ids = []
+            for concept_id in cui_dict[ head_cui ][ 'snomed_include_list' ]:
+                child_ids += sorted( uu.get_family_tree( auth_client , 'current' ,
+                                                         concept_id ,
+                                                         relation_type = 'children' ) )
+            child_cuis = {}
+            if( len( child_ids ) > 0 ):
+                child_cuis = uu.get_cuis( auth_client , 'current' , child_ids , 'SNOMEDCT_US' )
+            for child_id in child_ids:
+                descendant_cui = child_cuis.get( child_id )
+                if( child_id in snomed_seen or
+                    descendant_cui is None or
+                    descendant_cui in exclude_list ):
+                    continue
+                snomed_seen.add( child_id )
+                snomed_queue.append( ( child_id , head_cui ) )
+                if( descendant_cui in concepts ):
+                    continue
+                concepts = seed_concept( concepts , descendant_cui , head_cui )
+                mth_queue.append( descendant_cui )
         log.debug( 'Done with SNOMED' )
-        ## At the end of every loop, we want to update our partial file
-        ## with the latest datastructures (in pickle form)
-        if( partials_dir is not None ):
-            with open( os.path.join( partials_dir , 'processed_{}.pkl'.format( head_cui ) ) , 'wb' ) as fp:
-                pickle.dump( [ cui_dict , concepts ] , fp )
-    ##
+        ## At the end of every loop, we journal what the head changed
+        checkpoint( journal , 'heads' , head_cui , cui_dict , concepts ,
+                    heads = [ head_cui ] ,
+                    cuis = ( [ head_cui ] +
+                             standalone_queue[ queued[ 0 ]: ] +
+                             mth_queue[ queued[ 1 ]: ] ) ,
+                    queued = ( queue_ops( 'standalone' , 1 , standalone_queue[ queued[ 0 ]: ] ) +
+                               queue_ops( 'mth' , 1 , mth_queue[ queued[ 1 ]: ] ,
+                                          snomed_queue[ queued[ 2 ]: ] ) ) )
+    ## Everything below the parents, ROs and SNOMED parents (the
+    ## standalone queue) is claimed before anything below the RB
+    ## descendants (the MTH queue), however deep, so the two queues
+    ## are walked one after the other rather than merged.  Each walk
+    ## still goes a whole level at a time.
     concepts = parse_problems_queue( cui_dict ,
                                      concepts,
                                      partials_dir ,
                                      standalone_queue ,
-                                     snomed_queue ,
+                                     [] ,
                                      distance = 1 ,
-                                     max_distance = max_distance )
+                                     max_distance = max_distance  ,
+                                     concurrency = concurrency ,
+                                     journal = journal ,
+                                     walk = 'standalone' )
     concepts = parse_problems_queue( cui_dict ,
                                      concepts,
                                      partials_dir ,
                                      mth_queue ,
                                      snomed_queue ,
                                      distance = 1 ,
-                                     max_distance = max_distance )
+                                     max_distance = max_distance  ,
+                                     concurrency = concurrency ,
+                                     journal = journal ,
+                                     walk = 'mth' )
+    if( journal is not None ):
+        journal.close()
     return( cui_dict , concepts )
 
 
@@ -1208,48 +1445,201 @@ def parse_problems_queue( cui_dict ,
                           mth_queue ,
                           snomed_queue ,
                           distance = 1 ,
-                          max_distance = -1 ):
-    ## Re-up the authentication token for every new depth
+                          max_distance = -1 ,
+                          concurrency = aio.DEFAULT_CONCURRENCY ,
+                          distances = None ,
+                          journal = None ,
+                          walk = 'queue' ):
+    """
+    Walk down the RB hierarchy from `mth_queue` (CUIs `distance` away
+    from their heads) one level at a time.  Each level is deduplicated,
+    resolved concurrently (up to `concurrency` look-ups in flight) and
+    then applied in sorted order, so a new concept goes to the head of
+    the first parent reaching it and each head's
+    `descendants_exclude_list` is honored.  `distances`, if given, is
+    filled in with the level at which each CUI was processed.
+
+    `snomed_queue` holds ( SNOMED CT concept id , head CUI ) pairs,
+    also `distance` away.  They are walked down the SNOMED hierarchy in
+    step with the RB walk:  each level's SNOMED children are resolved in
+    the same batch of look-ups as its RB children and seeded after
+    them, and the CUIs they map to join the RB walk at the next level.
+
+    An exhaustive walk (`max_distance` of -1) on an engine with a
+    closure table (umls_index --closure) gets every RB child list below
+    the queue in one batch up front (see get_rbs_below), and then walks
+    the levels over those lists as usual, so heads are attributed the
+    same way.
+
+    Progress goes to `journal` when given, or else to a journal of its
+    own in `partials_dir` (if any), under the stage `walk`.  Everything
+    queued is journaled along with the step that queued it, so a
+    resumed walk picks up every CUI (and SNOMED CT concept) still
+    queued, including those queued before this call (see queue_ops),
+    and skips the parents it already got through.
+    """
+    if( distances is None ):
+        distances = {}
+    own_journal = ( journal is None and partials_dir is not None )
+    if( own_journal ):
+        journal , cui_dict , concepts , resume = open_checkpoint( partials_dir , cui_dict , concepts )
+    ## CUIs seeded since the last checkpoint
+    touched = []
+    ## A single authentication serves the whole walk (tickets and
+    ## TGTs are refreshed by the auth client itself)
     auth_client = uu.init_authentication( uu.UMLS_API_TOKEN )
-    ## Placeholders for any next-round processing we'll need to do
-    next_mth_queue = []
-    next_snomed_queue = []
-    for parent_cui in tqdm( sorted( mth_queue ) ,
-                            desc = 'Filling out concepts at distance of {} from seeds'.format( distance ) ,
-                            leave = True ,
-                            file = sys.stdout ):
-        concepts = flesh_out_seed_concept( auth_client , concepts , parent_cui )
-        if( max_distance == -1 or
-            distance < max_distance ):
-            ## get descendants and add to queue
-            descendant_cuis = uu.get_rbs( auth_client , 'current' , parent_cui )
-            log.debug( 'Grabbed RBs. descendant cui n = {}'.format( len( descendant_cuis ) ) )
-            head_cui = concepts[ parent_cui ][ 'head_cui' ]
-            exclude_list = cui_dict[ head_cui ][ 'descendants_exclude_list' ]
-            for descendant_cui in descendant_cuis:
-                if( descendant_cui in exclude_list or
-                    descendant_cui in concepts ):
-                    continue
+    ## Engines with a CSR graph expand the whole level with array
+    ## operations instead of per-CUI RB look-ups
+    graph = getattr( uu , 'graph' , None )
+    if( graph is not None ):
+        ## Kept up to date with every CUI seeded below rather than
+        ## re-encoding the whole concepts dict at each level
+        visited = graph.visited( list( concepts ) )
+    snomed_stage = '{}-snomed'.format( walk )
+    ## CUIs and SNOMED CT concepts queued for later levels, by distance
+    pending = {}
+    snomed_pending = {}
+    if( journal is None ):
+        frontier = list( mth_queue )
+        snomed_frontier = list( snomed_queue )
+        snomed_seen = set( concept_id for concept_id , head_cui in snomed_frontier )
+    else:
+        ## Whatever the caller queued that isn't journaled yet
+        queued = journal.state[ 'queue' ].get( walk , {} )
+        snomed_queued = journal.state[ 'snomed' ].get( walk , {} )
+        ops = queue_ops( walk , distance ,
+                         [ cui for cui in mth_queue
+                           if( cui not in queued ) ] ,
+                         [ pair for pair in snomed_queue
+                           if( tuple( pair ) not in snomed_queued ) ] )
+        if( len( ops ) > 0 ):
+            checkpoint( journal , 'queued' , walk , cui_dict , concepts ,
+                        queued = ops )
+        queued = journal.state[ 'queue' ].get( walk , {} )
+        snomed_queued = journal.state[ 'snomed' ].get( walk , {} )
+        for cui , cui_distance in queued.items():
+            if( not journal.resume.is_done( walk , cui ) ):
+                pending.setdefault( cui_distance , [] ).append( cui )
+        ## A level's SNOMED children are seeded (and journaled) together
+        for pair , snomed_distance in snomed_queued.items():
+            if( not journal.resume.is_done( snomed_stage , snomed_distance ) ):
+                snomed_pending.setdefault( snomed_distance , [] ).append( pair )
+        snomed_seen = set( concept_id for concept_id , head_cui in snomed_queued )
+        ## Start from the first level with anything left to do
+        levels = list( pending ) + list( snomed_pending )
+        frontier = []
+        snomed_frontier = []
+        if( len( levels ) > 0 ):
+            distance = min( levels )
+            frontier = pending.pop( distance , [] )
+            snomed_frontier = snomed_pending.pop( distance , [] )
+    ## RB child lists fetched ahead of their level
+    rb_lists = {}
+    get_rbs_below = getattr( uu , 'get_rbs_below' , None )
+    if( max_distance == -1 and
+        graph is None and
+        get_rbs_below is not None ):
+        rb_lists = get_rbs_below( auth_client , 'current' ,
+                                  sorted( set( frontier ).union( *pending.values() ) ) ) or {}
+    while( len( frontier ) > 0 or len( snomed_frontier ) > 0 ):
+        expand_flag = ( max_distance == -1 or
+                        distance < max_distance )
+        level = sorted( set( frontier ) )
+        for cui in level:
+            distances.setdefault( cui , distance )
+        next_frontier = []
+        ## Resolve the whole level (and its SNOMED children) concurrently
+        ## up front.  The loops below then only update our
+        ## datastructures, in sorted order, so the head CUI attribution
+        ## is the same as a sequential walk.
+        details , rbs , snomed_children = aio.fetch_level( auth_client ,
+                                                           [ cui for cui in level
+                                                             if( cui in concepts and
+                                                                 'preferred_term' not in concepts[ cui ] ) ] ,
+                                                           [ cui for cui in level
+                                                             if( expand_flag and
+                                                                 graph is None and
+                                                                 cui not in rb_lists ) ] ,
+                                                           unique_concept_ids( snomed_frontier ) if( expand_flag ) else [] ,
+                                                           concurrency = concurrency ,
+                                                           backend = uu )
+        if( expand_flag and graph is not None ):
+            heads = [ concepts[ parent_cui ][ 'head_cui' ] for parent_cui in level ]
+            seeds = graph.expand( level , heads ,
+                                  dict( ( head_cui , cui_dict[ head_cui ][ 'descendants_exclude_list' ] )
+                                        for head_cui in set( heads ) ) ,
+                                  visited )
+            log.debug( 'Expanded frontier of {} into {} concepts'.format( len( level ) , len( seeds ) ) )
+            for descendant_cui , head_cui in seeds:
                 concepts = seed_concept( concepts , descendant_cui , head_cui )
-                next_mth_queue.append( descendant_cui )
-        if( partials_dir is not None ):
-            with open( os.path.join( partials_dir ,
-                                     'processed_{}.pkl'.format( parent_cui ) ) ,
-                       'wb' ) as fp:
-                pickle.dump( [ cui_dict , concepts ] , fp )
-    ## If either queue has some work left to do, then go another level
-    ## deeper.
-    if( len( next_mth_queue ) > 0 or
-        len( next_snomed_queue ) > 0 ):
-        concepts = parse_problems_queue( cui_dict ,
-                                         concepts,
-                                         partials_dir ,
-                                         next_mth_queue ,
-                                         next_snomed_queue ,
-                                         distance = distance + 1 ,
-                                         max_distance = max_distance )
+                next_frontier.append( descendant_cui )
+                touched.append( descendant_cui )
+        for parent_cui in tqdm( level ,
+                                desc = 'Filling out concepts at distance of {} from seeds'.format( distance ) ,
+                                leave = True ,
+                                file = sys.stdout ):
+            concepts = flesh_out_seed_concept( auth_client , concepts , parent_cui ,
+                                               details = details.get( parent_cui ) )
+            if( expand_flag and graph is None ):
+                ## get descendants and add to queue
+                descendant_cuis = ( rb_lists.pop( parent_cui ) if( parent_cui in rb_lists ) else
+                                    rbs[ parent_cui ] )
+                log.debug( 'Grabbed RBs. descendant cui n = {}'.format( len( descendant_cuis ) ) )
+                head_cui = concepts[ parent_cui ][ 'head_cui' ]
+                exclude_list = cui_dict[ head_cui ][ 'descendants_exclude_list' ]
+                for descendant_cui in descendant_cuis:
+                    if( descendant_cui in exclude_list or
+                        descendant_cui in concepts ):
+                        continue
+                    concepts = seed_concept( concepts , descendant_cui , head_cui )
+                    next_frontier.append( descendant_cui )
+                    touched.append( descendant_cui )
+            checkpoint( journal , walk , parent_cui , cui_dict , concepts ,
+                        cuis = [ parent_cui ] + touched ,
+                        queued = queue_ops( walk , distance + 1 , touched ) )
+            touched = []
+        ## The SNOMED children go to the next level after the RB ones
+        next_snomed = []
+        if( len( snomed_frontier ) > 0 ):
+            for concept_id , head_cui in snomed_frontier:
+                exclude_list = cui_dict[ head_cui ][ 'descendants_exclude_list' ]
+                for child_id , descendant_cui in snomed_children.get( concept_id , [] ):
+                    if( child_id in snomed_seen or
+                        descendant_cui is None or
+                        descendant_cui in exclude_list ):
+                        continue
+                    snomed_seen.add( child_id )
+                    next_snomed.append( ( child_id , head_cui ) )
+                    if( descendant_cui in concepts ):
+                        continue
+                    concepts = seed_concept( concepts , descendant_cui , head_cui )
+                    next_frontier.append( descendant_cui )
+                    touched.append( descendant_cui )
+                    if( graph is not None ):
+                        graph.mark( visited , [ descendant_cui ] )
+            checkpoint( journal , snomed_stage , distance , cui_dict , concepts ,
+                        cuis = touched ,
+                        queued = queue_ops( walk , distance + 1 , touched , next_snomed ) )
+            touched = []
+        ## Whatever was seeded at this level (or queued for the next
+        ## one before a resume) is the next one
+        frontier = next_frontier + pending.pop( distance + 1 , [] )
+        snomed_frontier = next_snomed + snomed_pending.pop( distance + 1 , [] )
+        distance += 1
+    if( own_journal ):
+        journal.close()
     return( concepts )
 
+
+def unique_concept_ids( snomed_queue ):
+    concept_ids = []
+    seen = set()
+    for concept_id , head_cui in snomed_queue:
+        if( concept_id not in seen ):
+            seen.add( concept_id )
+            concept_ids.append( concept_id )
+    return( concept_ids )
+
 if __name__ == "__main__":
     input_filename = '/tmp/Book3.txt'
     cui_dict , concepts = parse_focused_problems_tsv( input_filename , concepts = {} )
@@ -0,0 +1,73 @@
+import os
+import sys
+
+import threading
+import time
+
+import async_umls_utils as aio
+import umls_utils as uu
+
+#############################################
+## Bounded concurrency
+#############################################
+
+class FakeBackend:
+
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+
+    def get_rbs( self , auth_client , version , identifier ):
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max( self.peak , self.in_flight )
+        time.sleep( 0.02 )
+        with self.lock:
+            self.in_flight -= 1
+        return( { '{}-child'.format( identifier ) : 'Child' } )
+
+    def get_concept_bundle( self , auth_client , version , identifier ):
+        if( identifier == 'C9999999' ):
+            return( None )
+        return( uu.ConceptBundle( name = 'Term {}'.format( identifier ) ,
+                                  tuis = [ 'T047' , 'T191' ] ,
+                                  eng_atoms = set( [ 'Term {}'.format( identifier ) ] ) ) )
+
+
+def test_frontier_is_fetched_with_bounded_concurrency():
+    backend = FakeBackend()
+    cuis = [ 'C{:07d}'.format( i ) for i in range( 12 ) ]
+    details , rbs = aio.fetch_frontier( None , [] , cuis ,
+                                        concurrency = 4 ,
+                                        backend = backend )
+    assert sorted( rbs ) == cuis
+    assert rbs[ 'C0000003' ] == { 'C0000003-child' : 'Child' }
+    assert 1 < backend.peak <= 4
+
+
+def test_frontier_details_skip_missing_concepts():
+    details , rbs = aio.fetch_frontier( None , [ 'C0000001' , 'C9999999' ] , [] ,
+                                        backend = FakeBackend() )
+    assert details[ 'C0000001' ] == ( 'Term C0000001' , 'T047' , set( [ 'Term C0000001' ] ) )
+    assert details[ 'C9999999' ] == ( None , '' , set() )
+    assert rbs == {}
+
+
+class FakeSnomedBackend( FakeBackend ):
+
+    def get_family_tree( self , auth_client , version , identifier ,
+                         relation_type , root_source = 'SNOMEDCT_US' ):
+        return( set( [ '{}1'.format( identifier ) , '{}0'.format( identifier ) ] ) )
+
+    def get_cui( self , auth_client , version , identifier , source ):
+        return( 'C{}'.format( identifier ) )
+
+
+def test_level_resolves_snomed_children_with_the_frontier():
+    details , rbs , snomed = aio.fetch_level( None , [ 'C0000001' ] , [ 'C0000002' ] , [ '10' , '20' ] ,
+                                              backend = FakeSnomedBackend() )
+    assert sorted( details ) == [ 'C0000001' ]
+    assert sorted( rbs ) == [ 'C0000002' ]
+    assert snomed == { '10' : [ ( '100' , 'C100' ) , ( '101' , 'C101' ) ] ,
+                       '20' : [ ( '200' , 'C200' ) , ( '201' , 'C201' ) ] }
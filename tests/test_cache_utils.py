@@ -0,0 +1,229 @@
+import os
+import sys
+
+from mock import Mock
+from mock import patch
+
+import tempfile
+import threading
+import time
+
+import cache_utils
+import umls_utils as uu
+
+#############################################
+## Cache keys
+#############################################
+
+def test_cache_key_ignores_auth_and_param_order():
+    key_a = cache_utils.cache_key( 'https://uts-ws.nlm.nih.gov/rest/content/current/CUI/C0000737/atoms?language=ENG' ,
+                                   { 'pageNumber' : 1 , 'apiKey' : 'abc' } )
+    key_b = cache_utils.cache_key( 'https://uts-ws.nlm.nih.gov/rest/content/current/CUI/C0000737/atoms' ,
+                                   { 'ticket' : 'ST-1' , 'pageNumber' : '1' , 'language' : 'ENG' } )
+    assert key_a == key_b
+    assert 'abc' not in key_a
+
+#############################################
+## Storage
+#############################################
+
+def test_put_get_and_namespaces():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = cache_utils.ResponseCache( os.path.join( tmpdir , 'cache.db' ) )
+        cache.put( 'UMLS-2023AB' , 'k' , '{"result":1}' )
+        assert cache.get( 'UMLS-2023AB' , 'k' ) == '{"result":1}'
+        assert cache.get( 'UMLS-2024AA' , 'k' ) is None
+        assert cache.clear( 'UMLS-2023AB' ) == 1
+        assert cache.get( 'UMLS-2023AB' , 'k' ) is None
+        cache.close()
+
+
+def test_expired_entries_are_ignored_and_pruned():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = cache_utils.ResponseCache( os.path.join( tmpdir , 'cache.db' ) ,
+                                           ttl = 60 )
+        cache.put( 'ns' , 'old' , 'x' )
+        cache.put( 'ns' , 'new' , 'y' )
+        cache.conn.execute( 'UPDATE responses SET created = created - 120 WHERE key = ?' , ( 'old' , ) )
+        assert cache.prune() == 1
+        assert cache.get( 'ns' , 'old' ) is None
+        assert cache.get( 'ns' , 'new' ) == 'y'
+        cache.close()
+
+
+def test_size_bound_evicts_least_recently_used():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = cache_utils.ResponseCache( os.path.join( tmpdir , 'cache.db' ) ,
+                                           max_bytes = 250 )
+        for i in range( 5 ):
+            cache.put( 'ns' , 'key{}'.format( i ) , 'x' * 96 )
+            cache.conn.execute( 'UPDATE responses SET accessed = ? WHERE key = ?' ,
+                                ( i , 'key{}'.format( i ) ) )
+        cache.prune()
+        assert cache.total_bytes() <= 250
+        assert cache.get( 'ns' , 'key0' ) is None
+        assert cache.get( 'ns' , 'key4' ) is not None
+        cache.close()
+
+def test_hits_write_access_times_in_batches():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = cache_utils.ResponseCache( os.path.join( tmpdir , 'cache.db' ) )
+        cache.put( 'ns' , 'k' , 'x' )
+        cache.conn.execute( 'UPDATE responses SET accessed = 0' )
+        cache.conn.commit()
+        with patch.object( cache_utils , 'ACCESS_FLUSH_INTERVAL' , 3 ):
+            for i in range( 2 ):
+                assert cache.get( 'ns' , 'k' ) == 'x'
+                assert cache.get( 'ns' , 'missing' ) is None
+            assert cache.conn.execute( 'SELECT accessed FROM responses' ).fetchone()[ 0 ] == 0
+            cache.put( 'ns' , 'k2' , 'y' )
+            cache.put( 'ns' , 'k3' , 'z' )
+            cache.get( 'ns' , 'k2' )
+            cache.get( 'ns' , 'k3' )
+        assert cache.conn.execute( 'SELECT MIN( accessed ) FROM responses' ).fetchone()[ 0 ] > 0
+        cache.close()
+
+
+def test_prune_is_limited_to_a_namespace():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = cache_utils.ResponseCache( os.path.join( tmpdir , 'cache.db' ) ,
+                                           ttl = 60 )
+        cache.put( 'UMLS-2023AB' , 'k' , 'x' )
+        cache.put( 'UMLS-2024AA' , 'k' , 'y' )
+        cache.conn.execute( 'UPDATE responses SET created = created - 120' )
+        assert cache.prune( 'UMLS-2023AB' ) == 1
+        assert cache.stats()[ 0 ][ 0 ] == 'UMLS-2024AA'
+        cache.close()
+
+#############################################
+## In-memory layers
+#############################################
+
+def test_lru_drops_least_recently_used():
+    lru = cache_utils.LRUCache( max_entries = 2 )
+    lru.put( 'a' , 1 )
+    lru.put( 'b' , 2 )
+    assert lru.get( 'a' ) == 1
+    lru.put( 'c' , 3 )
+    assert lru.get( 'b' ) is None
+    assert lru.get( 'a' ) == 1
+    assert lru.get( 'c' ) == 3
+    assert ( lru.hits , lru.misses ) == ( 3 , 1 )
+
+
+def test_single_flight_shares_one_call():
+    flights = cache_utils.SingleFlight()
+    calls = []
+    release = threading.Event()
+    def slow_fetch():
+        calls.append( 1 )
+        release.wait( 5 )
+        return( 'body' )
+    results = []
+    threads = [ threading.Thread( target = lambda: results.append( flights.do( 'k' , slow_fetch ) ) )
+                for i in range( 5 ) ]
+    for thread in threads:
+        thread.start()
+    while( flights.shared < 4 ):
+        time.sleep( 0.01 )
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len( calls ) == 1
+    assert results == [ 'body' ] * 5
+
+#############################################
+## Request layer
+#############################################
+
+def test_uts_get_is_served_from_cache():
+    manager = uu.CredentialManager( 'fake-key' , auth_mode = 'apikey' )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        uu.set_response_cache( os.path.join( tmpdir , 'cache.db' ) )
+        try:
+            with patch.dict( uu.release_namespaces , { 'UMLS' : 'UMLS-2023AB' } ):
+                with patch.object( uu.http_utils , 'get' ) as get:
+                    get.return_value.text = '{"result":[]}'
+                    get.return_value.status_code = 200
+                    for i in range( 3 ):
+                        assert uu.uts_get( manager , '/rest/content/current/CUI/C0000737' ) == '{"result":[]}'
+                    assert get.call_count == 1
+        finally:
+            uu.set_response_cache( None )
+
+
+def test_repeated_requests_are_served_from_memory():
+    uu.memory_cache.clear()
+    with patch.object( uu.http_utils , 'get' ) as get:
+        get.return_value.text = '{"result":[]}'
+        get.return_value.status_code = 200
+        for i in range( 3 ):
+            assert uu.rxnav_get( 'rxcui/1/property.json' ) == '{"result":[]}'
+        assert get.call_count == 1
+    uu.memory_cache.clear()
+
+def response( status_code , text ):
+    r = Mock()
+    r.status_code = status_code
+    r.text = text
+    return( r )
+
+
+def test_incomplete_bodies_are_not_cached():
+    uu.memory_cache.clear()
+    manager = uu.CredentialManager( 'fake-key' , auth_mode = 'apikey' )
+    with patch.object( uu.http_utils , 'get' ,
+                       side_effect = [ response( 200 , '{"pageCount":1}' ) ,
+                                       response( 200 , '{"result":{"name":"Fever"}}' ) ] ) as get:
+        with patch.object( uu.time , 'sleep' ):
+            assert uu.uts_get_json( manager , '/rest/content/current/CUI/C0015967' ) == { 'result' : { 'name' : 'Fever' } }
+        assert get.call_count == 2
+    uu.memory_cache.clear()
+
+
+def test_failed_requests_are_not_retried_twice():
+    uu.memory_cache.clear()
+    manager = uu.CredentialManager( 'fake-key' , auth_mode = 'apikey' )
+    with patch.object( uu.http_utils , 'get' ,
+                       return_value = response( 503 , '<html>Unavailable</html>' ) ) as get:
+        try:
+            uu.uts_get_json( manager , '/rest/content/current/CUI/C0015967' )
+            assert False
+        except uu.UmlsRequestError:
+            pass
+        ## http_utils.get did its own retries; nothing was layered on top
+        assert get.call_count == 1
+    uu.memory_cache.clear()
+
+#############################################
+## Negative results
+#############################################
+
+def test_negative_results_persist_across_runs():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_file = os.path.join( tmpdir , 'cache.db' )
+        negatives = cache_utils.NegativeCache( cache_file )
+        negatives.add( 'UMLS-2023AB' , 'no-cui' , 'SNOMEDCT_US|1234' )
+        negatives.close()
+        negatives = cache_utils.NegativeCache( cache_file )
+        assert negatives.contains( 'UMLS-2023AB' , 'no-cui' , 'SNOMEDCT_US|1234' )
+        assert not negatives.contains( 'UMLS-2024AA' , 'no-cui' , 'SNOMEDCT_US|1234' )
+        assert negatives.hits == { 'no-cui' : 1 }
+        negatives.close()
+
+
+def test_negative_results_expire():
+    negatives = cache_utils.NegativeCache( ttl = 60 )
+    negatives.add( 'UMLS' , 'cui-not-found' , 'C0000001' )
+    negatives._entries[ ( 'UMLS' , 'cui-not-found' , 'C0000001' ) ] -= 120
+    assert not negatives.contains( 'UMLS' , 'cui-not-found' , 'C0000001' )
+
+
+def test_retired_cuis_are_only_looked_up_once():
+    uu.set_negative_cache( None )
+    with patch.object( uu , 'get_cuis_atom' , return_value = None ) as get_cuis_atom:
+        for i in range( 3 ):
+            assert uu.get_cuis_preferred_atom( None , 'current' , 'C0000001' ) is None
+        assert get_cuis_atom.call_count == 1
+    assert uu.request_stats()[ 'negative hits (cui-not-found)' ] == 2
+    uu.set_negative_cache( None )
@@ -0,0 +1,99 @@
+import os
+import sys
+
+import tempfile
+
+import pickle
+
+import checkpoint_utils
+
+#############################################
+## Journal and snapshots
+#############################################
+
+def fresh_state():
+    return( { 'cui_dict' : { 'C0' : { 'descendants_exclude_list' : [] } } ,
+              'concepts' : { 'C0' : {} } } )
+
+
+def seed( journal , state , cui ):
+    state[ 'concepts' ][ cui ] = { 'head_cui' : 'C0' }
+    state[ 'concepts' ][ 'C0' ].setdefault( 'related_cuis' , set() ).add( cui )
+    journal.record( 'queue' , cui , [ ( 'update' , 'concepts' , cui , { 'head_cui' : 'C0' } ) ,
+                                      ( 'add' , 'concepts' , 'C0' , 'related_cuis' , cui ) ] )
+
+
+def test_resume_replays_the_journal_tail():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal = checkpoint_utils.CheckpointJournal( tmp_dir )
+        state , resume = journal.open( fresh_state() )
+        for cui in [ 'C1' , 'C2' , 'C3' ]:
+            seed( journal , state , cui )
+        ## No close():  as if the run had died here
+        journal.sync()
+        resumed , resume = checkpoint_utils.CheckpointJournal( tmp_dir ).open( fresh_state() )
+        assert resumed == state
+        assert resume.done == set( [ ( 'queue' , 'C1' ) , ( 'queue' , 'C2' ) , ( 'queue' , 'C3' ) ] )
+        assert checkpoint_utils.load_state( tmp_dir ) == state
+
+
+def test_torn_tail_is_dropped():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal = checkpoint_utils.CheckpointJournal( tmp_dir )
+        state , resume = journal.open( fresh_state() )
+        seed( journal , state , 'C1' )
+        journal.sync()
+        with open( journal.journal_file , 'ab' ) as fp:
+            fp.write( b'\x80\x04\x95garbage' )
+        resumed_journal = checkpoint_utils.CheckpointJournal( tmp_dir )
+        resumed , resume = resumed_journal.open( fresh_state() )
+        assert sorted( resumed[ 'concepts' ] ) == [ 'C0' , 'C1' ]
+        ## New records go right after the last good one
+        seed( resumed_journal , resumed , 'C2' )
+        resumed_journal.sync()
+        assert sorted( checkpoint_utils.load_state( tmp_dir )[ 'concepts' ] ) == [ 'C0' , 'C1' , 'C2' ]
+
+
+def test_snapshots_compact_the_journal():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal = checkpoint_utils.CheckpointJournal( tmp_dir , snapshot_every = 2 )
+        state , resume = journal.open( fresh_state() )
+        for cui in [ 'C1' , 'C2' , 'C3' , 'C4' ]:
+            seed( journal , state , cui )
+        assert os.path.getsize( journal.journal_file ) == 0
+        journal.close()
+        assert checkpoint_utils.load_state( tmp_dir ) == state
+
+
+def test_corrupt_snapshot_falls_back_to_the_previous_one():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal = checkpoint_utils.CheckpointJournal( tmp_dir , snapshot_every = 2 )
+        state , resume = journal.open( fresh_state() )
+        for cui in [ 'C1' , 'C2' , 'C3' ]:
+            seed( journal , state , cui )
+        journal.sync()
+        ## Cut the newest snapshot short, as a killed run might
+        with open( journal.snapshot_file , 'r+b' ) as fp:
+            fp.truncate( os.path.getsize( journal.snapshot_file ) // 2 )
+        resume = checkpoint_utils.ResumeManager( tmp_dir )
+        assert resume.load()
+        assert resume.source.endswith( 'checkpoint.snapshot.prev.pkl' )
+        assert resume.state == state
+        assert resume.remaining( 'queue' , [ 'C1' , 'C2' , 'C3' , 'C4' ] ) == [ 'C4' ]
+
+
+def test_legacy_partials_resume_from_the_newest_readable_pickle():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for position , cui in enumerate( [ 'C1' , 'C2' , 'C3' ] ):
+            filename = os.path.join( tmp_dir , 'processed_{}.pkl'.format( cui ) )
+            with open( filename , 'wb' ) as fp:
+                pickle.dump( [ { cui : {} } , { cui : { 'head_cui' : cui } } ] , fp )
+            os.utime( filename , ( position , position ) )
+        ## The newest one was cut off mid-write
+        with open( os.path.join( tmp_dir , 'processed_C3.pkl' ) , 'r+b' ) as fp:
+            fp.truncate( 10 )
+        resume = checkpoint_utils.ResumeManager( tmp_dir )
+        assert resume.load()
+        assert resume.state == { 'cui_dict' : { 'C2' : {} } ,
+                                 'concepts' : { 'C2' : { 'head_cui' : 'C2' } } }
+        assert resume.remaining( 'heads' , [ 'C1' , 'C2' , 'C3' ] ) == [ 'C3' ]
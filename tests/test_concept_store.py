@@ -0,0 +1,118 @@
+import os
+import sys
+
+import pickle
+import tempfile
+
+import checkpoint_utils
+import concept_store
+import lex_gen
+
+#############################################
+## Concept records
+#############################################
+
+def test_concepts_read_and_write_like_dicts():
+    concepts = concept_store.ConceptStore()
+    concepts[ 'C1' ] = {}
+    concepts[ 'C1' ][ 'preferred_term' ] = 'Fever'
+    concepts[ 'C1' ][ 'variant_terms' ] = set( [ 'pyrexia' , 'Fever' ] )
+    concepts[ 'C2' ] = { 'head_cui' : 'C1' }
+    concepts[ 'C1' ].setdefault( 'related_cuis' , set() ).add( 'C2' )
+    concept_store.add_variant_term( concepts[ 'C1' ] , 'febrile' )
+    assert isinstance( concepts[ 'C1' ] , concept_store.Concept )
+    assert 'tui' not in concepts[ 'C1' ]
+    assert concepts[ 'C1' ].get( 'tui' , '' ) == ''
+    assert sorted( concepts[ 'C1' ][ 'variant_terms' ] ) == [ 'Fever' , 'febrile' , 'pyrexia' ]
+    assert concepts[ 'C2' ] == { 'head_cui' : 'C1' }
+    assert concepts[ 'C1' ][ 'related_cuis' ] == set( [ 'C2' ] )
+    try:
+        concepts[ 'C1' ][ 'not_a_field' ] = 1
+        assert False
+    except KeyError:
+        pass
+
+
+def test_concept_store_pickles_compactly():
+    concepts = concept_store.ConceptStore()
+    plain = {}
+    for position in range( 200 ):
+        cui = 'C{:07d}'.format( position )
+        entry = { 'preferred_term' : 'term {}'.format( position ) ,
+                  'tui' : 'T047' ,
+                  'variant_terms' : set( [ 'term {}'.format( position ) ] ) ,
+                  'head_cui' : 'C0000000' }
+        plain[ cui ] = dict( entry )
+        concepts[ cui ] = entry
+    pickled = pickle.dumps( concepts , protocol = pickle.HIGHEST_PROTOCOL )
+    assert len( pickled ) < len( pickle.dumps( plain , protocol = pickle.HIGHEST_PROTOCOL ) )
+    restored = pickle.loads( pickled )
+    assert isinstance( restored , concept_store.ConceptStore )
+    assert restored == concepts
+
+
+def test_checkpoint_replays_into_a_concept_store():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal = checkpoint_utils.CheckpointJournal( tmp_dir )
+        state , resume = journal.open( { 'cui_dict' : {} ,
+                                         'concepts' : concept_store.ConceptStore() } )
+        journal.record( 'queue' , 'C2' , [ ( 'update' , 'concepts' , 'C2' , { 'head_cui' : 'C1' } ) ,
+                                           ( 'add' , 'concepts' , 'C1' , 'related_cuis' , 'C2' ) ] )
+        journal.sync()
+        resumed = checkpoint_utils.load_state( tmp_dir )[ 'concepts' ]
+    assert isinstance( resumed[ 'C2' ] , concept_store.Concept )
+    assert resumed[ 'C1' ][ 'related_cuis' ] == set( [ 'C2' ] )
+
+#############################################
+## Term table
+#############################################
+
+def test_recurring_terms_are_stored_once():
+    concepts = concept_store.ConceptStore()
+    for cui in [ 'C1' , 'C2' , 'C3' ]:
+        concepts[ cui ] = { 'preferred_term' : ''.join( [ 'Pa' , 'in' ] ) ,
+                            'variant_terms' : set( [ ''.join( [ 'Pa' , 'in' ] ) , cui ] ) }
+    concept_store.add_variant_term( concepts[ 'C3' ] , ''.join( [ 'Ach' , 'e' ] ) )
+    assert concepts[ 'C1' ][ 'variant_terms' ] == ( 'C1' , 'Pain' )
+    assert concepts[ 'C3' ][ 'variant_terms' ] == ( 'Ache' , 'C3' , 'Pain' )
+    assert concepts[ 'C1' ][ 'variant_terms' ][ 1 ] is concepts[ 'C2' ][ 'variant_terms' ][ 1 ]
+    assert concepts[ 'C1' ][ 'preferred_term' ] is concepts[ 'C3' ][ 'variant_terms' ][ 2 ]
+
+
+def test_terms_added_one_at_a_time_are_frozen_when_read():
+    concepts = concept_store.ConceptStore( { 'C1' : { 'variant_terms' : set( [ 'b' ] ) } } )
+    for term in [ 'd' , 'a' , 'c' , 'a' ]:
+        concept_store.add_variant_term( concepts[ 'C1' ] , term )
+    ## Gathered in a set while being added to
+    assert type( concepts[ 'C1' ].variant_terms ) is set
+    assert concepts[ 'C1' ][ 'variant_terms' ] == ( 'a' , 'b' , 'c' , 'd' )
+    concept_store.add_variant_term( concepts[ 'C1' ] , 'e' )
+    restored = pickle.loads( pickle.dumps( concepts , protocol = pickle.HIGHEST_PROTOCOL ) )
+    assert restored[ 'C1' ][ 'variant_terms' ] == ( 'a' , 'b' , 'c' , 'd' , 'e' )
+    assert concepts[ 'C1' ] == restored[ 'C1' ]
+
+
+def test_pickled_store_lists_each_term_once():
+    concepts = concept_store.ConceptStore()
+    for position in range( 50 ):
+        concepts[ 'C{}'.format( position ) ] = { 'variant_terms' : [ 'a shared term' ,
+                                                                     'term {}'.format( position ) ] }
+    pickled = pickle.dumps( concepts , protocol = pickle.HIGHEST_PROTOCOL )
+    assert pickled.count( b'a shared term' ) == 1
+    restored = pickle.loads( pickled )
+    assert restored == concepts
+    assert restored[ 'C7' ][ 'variant_terms' ][ 0 ] is concepts[ 'C7' ][ 'variant_terms' ][ 0 ]
+
+#############################################
+## Writers
+#############################################
+
+def test_writers_leave_concepts_untouched():
+    concepts = concept_store.ConceptStore( { 'C1' : { 'preferred_term' : 'Fever' ,
+                                                      'tui' : 'T184' ,
+                                                      'variant_terms' : set( [ 'Fever' ] ) } } )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        lex_gen.concepts_to_ttl_kb_mapper( concepts ,
+                                           os.path.join( tmp_dir , 'kb.ttl' ) ,
+                                           prefix_file = None )
+    assert 'SNOMEDCT' not in concepts[ 'C1' ]
@@ -0,0 +1,92 @@
+import os
+import sys
+
+from mock import patch
+
+import tempfile
+
+import crosswalk as cw
+import umls_utils as uu
+
+#############################################
+## Building and saving
+#############################################
+
+def test_crosswalk_from_mrconso():
+    crosswalk = cw.build_crosswalk( 'in/tiny_rrf' , sabs = [ 'SNOMEDCT_US' , 'MSH' ] )
+    assert crosswalk.get_cui( 'SNOMEDCT_US' , '22298006' ) == 'C0000002'
+    assert crosswalk.get_cui( 'LNC' , '2157-5' ) is None
+    assert crosswalk.get_cuis( 'SNOMEDCT_US' , [ '56265001' , '1755008' , '0' ] ) == { '56265001' : 'C0000001' ,
+                                                                                       '1755008' : 'C0000004' }
+    assert crosswalk.get_codes( 'MSH' , [ 'C0000001' , 'C0000003' , 'C0000002' ] ) == { 'C0000001' : [ 'D006331' ] ,
+                                                                                        'C0000003' : [ 'D000787' ] }
+
+
+def test_crosswalk_skips_suppressed_atoms():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open( os.path.join( 'in/tiny_rrf' , 'MRCONSO.RRF' ) , 'r' ) as in_fp:
+            lines = in_fp.read()
+        with open( os.path.join( tmp_dir , 'MRCONSO.RRF' ) , 'w' ) as out_fp:
+            out_fp.write( lines )
+            out_fp.write( 'C0000009|ENG|P|L0000090|PF|S0000090|Y|A0000090||99999009||SNOMEDCT_US|PT|99999009|Retired disorder|9|O|256|\n' )
+        crosswalk = cw.build_crosswalk( tmp_dir )
+    assert not crosswalk.has_code( 'SNOMEDCT_US' , '99999009' )
+    assert crosswalk.get_cui( 'SNOMEDCT_US' , '22298006' ) == 'C0000002'
+
+
+def test_crosswalk_round_trip():
+    crosswalk = cw.build_crosswalk( 'in/tiny_rrf' )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        crosswalk_file = crosswalk.save( os.path.join( tmp_dir , 'crosswalk.tsv' ) )
+        loaded = cw.load_crosswalk( crosswalk_file )
+    assert len( loaded ) == len( crosswalk ) == 5
+    assert loaded.get_codes( 'SNOMEDCT_US' , [ 'C0000005' ] ) == { 'C0000005' : [ '29857009' ] }
+
+#############################################
+## get_cui and get_cuis
+#############################################
+
+def test_get_cui_answers_from_and_fills_the_crosswalk():
+    uu.set_negative_cache( None )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        crosswalk_file = os.path.join( tmp_dir , 'crosswalk.tsv' )
+        crosswalk = uu.set_crosswalk( crosswalk_file )
+        try:
+            crosswalk.add( 'SNOMEDCT_US' , '22298006' , 'C0027051' )
+            with patch.object( uu , 'search_umls' , return_value = 'C0018787' ) as search_umls:
+                assert uu.get_cui( None , 'current' , '22298006' , 'SNOMEDCT_US' ) == 'C0027051'
+                assert search_umls.call_count == 0
+                assert uu.get_cuis( None , 'current' , [ '22298006' , '80891009' ] ,
+                                    'SNOMEDCT_US' ) == { '22298006' : 'C0027051' ,
+                                                         '80891009' : 'C0018787' }
+                assert search_umls.call_count == 1
+            uu.save_crosswalk()
+            assert cw.load_crosswalk( crosswalk_file ).get_cui( 'SNOMEDCT_US' , '80891009' ) == 'C0018787'
+        finally:
+            uu.set_crosswalk( None )
+
+
+def test_code_with_two_cuis_maps_the_same_with_or_without_the_crosswalk():
+    uu.set_negative_cache( None )
+    ## UTS lists the higher CUI first
+    body = { 'result' : { 'classType' : 'searchResults' ,
+                          'results' : [ { 'ui' : 'C0000009' , 'name' : 'Later' } ,
+                                        { 'ui' : 'C0000002' , 'name' : 'Earlier' } ] } }
+    with patch.object( uu , 'uts_get_json' , return_value = body ):
+        searched = uu.get_cui( None , 'current' , '22298006' , 'SNOMEDCT_US' )
+    crosswalk = cw.Crosswalk()
+    crosswalk.add( 'SNOMEDCT_US' , '22298006' , 'C0000002' )
+    crosswalk.add( 'SNOMEDCT_US' , '22298006' , 'C0000009' )
+    assert searched == crosswalk.get_cui( 'SNOMEDCT_US' , '22298006' ) == 'C0000009'
+
+
+def test_crosswalk_hits_skip_the_release_look_up():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        crosswalk = uu.set_crosswalk( os.path.join( tmp_dir , 'crosswalk.tsv' ) )
+        try:
+            crosswalk.add( 'SNOMEDCT_US' , '22298006' , 'C0027051' )
+            with patch.object( uu , 'negative_namespace' ) as negative_namespace:
+                assert uu.get_cui( None , 'current' , '22298006' , 'SNOMEDCT_US' ) == 'C0027051'
+                assert negative_namespace.call_count == 0
+        finally:
+            uu.set_crosswalk( None )
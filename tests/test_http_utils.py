@@ -0,0 +1,86 @@
+import os
+import sys
+
+from mock import patch
+
+import time
+
+import requests
+
+import http_utils
+
+#############################################
+## Connection pooling
+#############################################
+
+def test_sessions_are_shared_per_host():
+    http_utils.close_sessions()
+    uts_session = http_utils.get_session( 'https://uts-ws.nlm.nih.gov/rest/content/current/CUI/C0000737' )
+    assert uts_session is http_utils.get_session( 'https://uts-ws.nlm.nih.gov/rest/search/current' )
+    rxnav_session = http_utils.get_session( 'https://rxnav.nlm.nih.gov/REST/rxcui/1/property.json' )
+    assert rxnav_session is not uts_session
+    http_utils.close_sessions()
+
+
+def test_configured_pool_size_is_used_for_new_sessions():
+    with patch.dict( http_utils.host_pool_sizes , { 'example.org' : 3 } ):
+        http_utils.configure_pools()
+        session = http_utils.get_session( 'https://example.org/a' )
+        adapter = session.get_adapter( 'https://example.org/a' )
+        assert adapter._pool_maxsize == 3
+    http_utils.close_sessions()
+
+#############################################
+## Throttling and retries
+#############################################
+
+def fake_response( status_code , headers = {} ):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update( headers )
+    return( response )
+
+
+def test_token_bucket_spaces_out_requests():
+    bucket = http_utils.TokenBucket( rate = 100 , capacity = 1 )
+    start = time.monotonic()
+    for i in range( 6 ):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.04
+
+
+def test_retry_after_header_is_honored():
+    policy = http_utils.RetryPolicy( max_delay = 30 )
+    assert policy.delay( 0 , fake_response( 429 , { 'Retry-After' : '7' } ) ) == 7
+    assert policy.delay( 0 , fake_response( 429 , { 'Retry-After' : '600' } ) ) == 30
+    assert 0 <= policy.delay( 3 , fake_response( 503 ) ) <= policy.base_delay * 8
+
+
+def test_throttled_and_failed_requests_are_retried():
+    session = http_utils.get_session( 'https://example.org/a' )
+    responses = [ fake_response( 429 , { 'Retry-After' : '1' } ) ,
+                  requests.ConnectionError( 'reset' ) ,
+                  fake_response( 503 ) ,
+                  fake_response( 200 ) ]
+    with patch.object( session , 'request' , side_effect = responses ) as request:
+        with patch.object( http_utils.time , 'sleep' ) as sleep:
+            with patch.object( http_utils.TokenBucket , 'pause' ) as pause:
+                assert http_utils.get( 'https://example.org/a' ).status_code == 200
+    assert request.call_count == 4
+    pause.assert_called_once_with( 1 )
+    assert sleep.call_args_list[ 0 ][ 0 ][ 0 ] == 1
+    http_utils.close_sessions()
+
+
+def test_last_response_is_returned_once_retries_run_out():
+    http_utils.configure_host( 'example.org' ,
+                               retry_policy = http_utils.RetryPolicy( max_retries = 2 ) )
+    session = http_utils.get_session( 'https://example.org/a' )
+    try:
+        with patch.object( session , 'request' , return_value = fake_response( 500 ) ) as request:
+            with patch.object( http_utils.time , 'sleep' ):
+                assert http_utils.get( 'https://example.org/a' ).status_code == 500
+        assert request.call_count == 3
+    finally:
+        http_utils.host_retry_policies.pop( 'example.org' )
+        http_utils.close_sessions()
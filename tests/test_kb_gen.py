@@ -0,0 +1,76 @@
+import os
+import sys
+
+import pytest
+import shutil
+import tempfile
+
+import kb_gen
+import rrf_parquet
+
+#############################################
+## Parquet tables read the same as the RRF files
+#############################################
+
+def read_file( filename ):
+    with open( filename , 'r' ) as fp:
+        return( fp.read() )
+
+
+def test_mrconso_kb_from_parquet_matches_rrf():
+    pytest.importorskip( 'pyarrow' )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        parquet_dir = os.path.join( tmpdir , 'parquet' )
+        assert rrf_parquet.convert( 'in/tiny_rrf' , parquet_dir ) == [ 'MRCONSO' , 'MRSTY' ]
+        rrf_ttl = os.path.join( tmpdir , 'rrf.ttl' )
+        parquet_ttl = os.path.join( tmpdir , 'parquet.ttl' )
+        rrf_stats = kb_gen.parse_mrconso( 'in/tiny_rrf' , 'LNC' , rrf_ttl )
+        parquet_stats = kb_gen.parse_mrconso( 'in/tiny_rrf' , 'LNC' , parquet_ttl ,
+                                              parquetDir = parquet_dir )
+        assert rrf_stats == parquet_stats == { 'total_concepts' : 3 }
+        assert read_file( rrf_ttl ) == read_file( parquet_ttl )
+        assert 'Creatine kinase (retired)' not in read_file( parquet_ttl )
+
+
+def test_rxnorm_kb_from_parquet_matches_rrf():
+    pytest.importorskip( 'pyarrow' )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        parquet_dir = os.path.join( tmpdir , 'parquet' )
+        assert rrf_parquet.convert( 'in/tiny_rxnorm' , parquet_dir ) == [ 'RXNCONSO' , 'RXNREL' ]
+        stats = {}
+        for name , parquet in [ ( 'rrf' , None ) , ( 'parquet' , parquet_dir ) ]:
+            command_line = [ '--input-format' , 'RxNorm' ,
+                             '--input-dir' , 'in/tiny_rxnorm' ,
+                             '--output-prefix' , os.path.join( tmpdir , '{}_'.format( name ) ) ,
+                             '--output-suffix' , '.ttl' ]
+            if( parquet is not None ):
+                command_line += [ '--parquet-dir' , parquet ]
+            stats[ name ] = kb_gen.parse_rxnorm( kb_gen.init_args( command_line ) )
+        assert stats[ 'rrf' ] == stats[ 'parquet' ] == { 'total_concepts' : 5 ,
+                                                         'brand_concepts' : 2 ,
+                                                         'brands_skipped' : 0 ,
+                                                         'ingredient_concepts' : 1 }
+        for infix in [ 'Ingredients' , 'Brands' ]:
+            assert read_file( os.path.join( tmpdir , 'rrf_{}.ttl'.format( infix ) ) ) == \
+                read_file( os.path.join( tmpdir , 'parquet_{}.ttl'.format( infix ) ) )
+
+
+def test_quoted_values_are_read_verbatim():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rrf_dir = os.path.join( tmpdir , 'rrf' )
+        shutil.copytree( 'in/tiny_rrf' , rrf_dir )
+        with open( os.path.join( rrf_dir , 'MRCONSO.RRF' ) , 'r' ) as fp:
+            mrconso = fp.read()
+        with open( os.path.join( rrf_dir , 'MRCONSO.RRF' ) , 'w' ) as fp:
+            fp.write( mrconso.replace( '|Troponin I measurement|' , '|"Troponin" I measurement|' ) )
+        terms = [ cols[ 14 ] for cols in kb_gen.read_rrf_file( os.path.join( rrf_dir , 'MRCONSO.RRF' ) ) ]
+        assert '"Troponin" I measurement' in terms
+        rrf_ttl = os.path.join( tmpdir , 'rrf.ttl' )
+        kb_gen.parse_mrconso( rrf_dir , 'LNC' , rrf_ttl )
+        if( rrf_parquet.pa is not None ):
+            parquet_dir = os.path.join( tmpdir , 'parquet' )
+            rrf_parquet.convert( rrf_dir , parquet_dir )
+            parquet_ttl = os.path.join( tmpdir , 'parquet.ttl' )
+            kb_gen.parse_mrconso( rrf_dir , 'LNC' , parquet_ttl ,
+                                  parquetDir = parquet_dir )
+            assert read_file( rrf_ttl ) == read_file( parquet_ttl )
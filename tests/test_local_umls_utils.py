@@ -0,0 +1,258 @@
+import os
+import sys
+
+import pytest
+import tempfile
+
+import csr_graph
+import local_umls_utils
+import rrf_offsets
+import spreadsheet_utils as csv_u
+import umls_index
+import umls_utils as uu
+
+#############################################
+## Look-ups against a tiny RRF subset
+#############################################
+
+engine = local_umls_utils.open_engine( 'in/tiny_rrf' )
+
+def test_concept_details_skip_suppressed_atoms():
+    assert engine.get_cuis_preferred_atom( None , 'current' , 'C0000001' ) == 'Heart disease'
+    assert engine.get_cuis_atom( None , 'current' , 'C0000002' , '' ) == 'T047'
+    assert engine.get_cuis_eng_atom( None , 'current' , 'C0000001' ) == set( [ 'Heart disease' ,
+                                                                               'Heart Diseases' ,
+                                                                               'Cardiac disease' ] )
+    bundle = engine.get_concept_bundle( None , 'current' , 'C0000002' )
+    assert bundle == uu.ConceptBundle( name = 'Myocardial infarction' ,
+                                       tuis = [ 'T047' , 'T046' ] ,
+                                       eng_atoms = set( [ 'Myocardial infarction' , 'Heart attack' ] ) )
+    assert engine.get_concept_bundle( None , 'current' , 'C9999999' ) is None
+
+
+def test_quoted_strings_are_read_verbatim():
+    assert 'Angina, "stable"' in engine.get_cuis_eng_atom( None , 'current' , 'C0000003' )
+
+
+def test_concept_relations():
+    assert engine.get_rbs( None , 'current' , 'C0000001' ) == { 'C0000002' : 'Myocardial infarction' ,
+                                                                'C0000003' : 'Angina pectoris' }
+    assert engine.get_rns( None , 'current' , 'C0000004' ) == { 'C0000002' : 'Myocardial infarction' }
+    assert engine.get_ros( None , 'current' , 'C0000005' ) == { 'C0000003' : 'Angina pectoris' }
+
+
+def test_source_codes_and_hierarchy():
+    assert engine.get_cui( None , 'current' , '22298006' , 'SNOMEDCT_US' ) == 'C0000002'
+    assert engine.get_cui( None , 'current' , '0' , 'SNOMEDCT_US' ) is None
+    assert engine.get_atoms( None , 'current' , 'C0000001' , 'SNOMEDCT_US' ) == [ '56265001' ]
+    assert engine.get_family_tree( None , 'current' , '56265001' ,
+                                   relation_type = 'children' ) == set( [ '22298006' , '194828000' ] )
+    assert engine.get_family_tree( None , 'current' , '1755008' ,
+                                   relation_type = 'ancestors' ) == set( [ '22298006' , '56265001' ] )
+    assert engine.get_parents( None , 'current' , 'C0000004' , 'SNOMEDCT_US' ) == set( [ 'C0000002' ] )
+    assert sorted( engine.get_all_snomed_descendants( None , '56265001' , [] ) ) == [ 'C0000002' ,
+                                                                                    'C0000003' ,
+                                                                                    'C0000004' ]
+
+#############################################
+## Expansion
+#############################################
+
+def test_queue_expansion_with_local_engine():
+    csv_u.use_umls_engine( engine )
+    try:
+        concepts = csv_u.seed_concept( {} , 'C0000001' )
+        for cui in engine.get_rbs( None , 'current' , 'C0000001' ):
+            concepts = csv_u.seed_concept( concepts , cui , 'C0000001' )
+        cui_dict = { 'C0000001' : { 'descendants_exclude_list' : [ 'C0000003' ] } }
+        concepts = csv_u.parse_problems_queue( cui_dict , concepts , None ,
+                                               [ 'C0000002' ] , [] )
+    finally:
+        csv_u.use_umls_engine( uu )
+    assert concepts[ 'C0000004' ][ 'head_cui' ] == 'C0000001'
+    assert concepts[ 'C0000004' ][ 'preferred_term' ] == 'Old myocardial infarction'
+    assert concepts[ 'C0000002' ][ 'variant_terms' ] == set( [ 'Myocardial infarction' , 'Heart attack' ] )
+
+#############################################
+## Indexed store
+#############################################
+
+def test_indexed_store_matches_rrf_store():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index_file = umls_index.build_index( 'in/tiny_rrf' ,
+                                             os.path.join( tmpdir , 'umls.db' ) ,
+                                             languages = [] )
+        indexed = local_umls_utils.open_engine( index_file = index_file )
+        cuis = [ 'C0000001' , 'C0000002' , 'C0000003' , 'C0000004' , 'C0000005' , 'C9999999' ]
+        for cui in cuis:
+            assert indexed.store.conso_rows( cui ) == engine.store.conso_rows( cui )
+            assert indexed.store.rel_rows( cui ) == engine.store.rel_rows( cui )
+            assert indexed.get_concept_bundle( None , 'current' , cui ) == engine.get_concept_bundle( None , 'current' , cui )
+        assert indexed.get_concept_bundles( None , 'current' , cuis ) == engine.get_concept_bundles( None , 'current' , cuis )
+        assert indexed.get_typed_relations( None , 'current' , cuis , 'RB' ) == engine.get_typed_relations( None , 'current' , cuis , 'RB' )
+        assert indexed.get_cui( None , 'current' , '22298006' , 'SNOMEDCT_US' ) == 'C0000002'
+        assert indexed.get_family_tree( None , 'current' , '56265001' ,
+                                        relation_type = 'descendants' ) == set( [ '22298006' , '194828000' , '1755008' ] )
+        indexed.store.close()
+
+
+def test_offset_store_matches_rrf_store():
+    pytest.importorskip( 'numpy' )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rrf_offsets.build_offsets( 'in/tiny_rrf' , tmpdir )
+        mapped = local_umls_utils.open_engine( 'in/tiny_rrf' , offset_dir = tmpdir )
+        for cui in [ 'C0000001' , 'C0000002' , 'C0000003' , 'C0000004' , 'C0000005' , 'C9999999' ]:
+            assert mapped.store.conso_rows( cui ) == engine.store.conso_rows( cui )
+            assert mapped.store.sty_rows( cui ) == engine.store.sty_rows( cui )
+            assert mapped.store.rel_rows( cui ) == engine.store.rel_rows( cui )
+            assert mapped.get_concept_bundle( None , 'current' , cui ) == engine.get_concept_bundle( None , 'current' , cui )
+        assert mapped.get_cui( None , 'current' , '22298006' , 'SNOMEDCT_US' ) == 'C0000002'
+        for code in [ '56265001' , '22298006' , '194828000' , '1755008' ]:
+            for relation_type in [ 'children' , 'descendants' , 'parents' , 'ancestors' ]:
+                assert mapped.get_family_tree( None , 'current' , code ,
+                                               relation_type = relation_type ) == \
+                    engine.get_family_tree( None , 'current' , code ,
+                                            relation_type = relation_type )
+        mapped.store.close()
+
+def test_long_offset_keys_are_kept_whole():
+    pytest.importorskip( 'numpy' )
+    prefix = 'SAB|' + 'X' * 80
+    runs = rrf_offsets.runs_array( [ prefix + '2' , prefix + '1' ] , [ 10 , 0 ] , [ 5 , 10 ] )
+    assert [ key.decode( 'utf-8' ) for key in runs[ 'key' ] ] == [ prefix + '1' , prefix + '2' ]
+    assert list( runs[ 'offset' ] ) == [ 0 , 10 ]
+
+#############################################
+## Closure index
+#############################################
+
+def test_closure_matches_walk():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index_file = umls_index.build_index( 'in/tiny_rrf' ,
+                                             os.path.join( tmpdir , 'umls.db' ) ,
+                                             closure = True )
+        indexed = local_umls_utils.open_engine( index_file = index_file )
+        assert indexed.store.has_closure()
+        assert engine.get_rbs_below( None , 'current' , [ 'C0000001' ] ) is None
+        below = indexed.get_rbs_below( None , 'current' , [ 'C0000001' ] )
+        assert sorted( below ) == [ 'C0000001' , 'C0000002' , 'C0000003' , 'C0000004' ]
+        assert below == engine.get_typed_relations( None , 'current' , sorted( below ) , 'RB' )
+        for exclude_list in [ [] , [ 'C0000002' ] , [ 'C0000003' , 'C0000004' ] ]:
+            concepts = { 'C0000001' : {} }
+            assert indexed.get_all_umls_descendants( None , 'C0000001' , concepts , exclude_list ) == \
+                engine.get_all_umls_descendants( None , 'C0000001' , concepts , exclude_list )
+            assert indexed.get_all_snomed_descendants( None , '56265001' , exclude_list ) == \
+                engine.get_all_snomed_descendants( None , '56265001' , exclude_list )
+        indexed.store.close()
+
+
+def test_closure_cut_short_falls_back_to_look_ups():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index_file = umls_index.build_index( 'in/tiny_rrf' ,
+                                             os.path.join( tmpdir , 'umls.db' ) ,
+                                             closure = True ,
+                                             closure_max_rows = 0 )
+        indexed = local_umls_utils.open_engine( index_file = index_file )
+        ## Only the direct children are in the closure
+        assert sorted( indexed.get_rbs_below( None , 'current' , [ 'C0000001' ] ) ) == [ 'C0000001' ,
+                                                                                       'C0000002' ,
+                                                                                       'C0000003' ]
+        concepts = { 'C0000001' : {} }
+        assert indexed.get_all_umls_descendants( None , 'C0000001' , concepts , [] ) == \
+            engine.get_all_umls_descendants( None , 'C0000001' , concepts , [] )
+        assert indexed.get_all_snomed_descendants( None , '56265001' , [] ) == \
+            engine.get_all_snomed_descendants( None , '56265001' , [] )
+        indexed.store.close()
+
+
+class RelationCountingEngine( local_umls_utils.LocalUmlsEngine ):
+
+    def __init__( self , store ):
+        super().__init__( store )
+        self.batches = []
+
+    def get_typed_relations( self , auth_client , version , identifiers ,
+                             target_relation_label ):
+        if( len( identifiers ) > 0 ):
+            self.batches.append( list( identifiers ) )
+        return( super().get_typed_relations( auth_client , version , identifiers ,
+                                             target_relation_label ) )
+
+
+def test_exhaustive_queue_expansion_reads_the_closure_once():
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index_file = umls_index.build_index( 'in/tiny_rrf' ,
+                                             os.path.join( tmpdir , 'umls.db' ) ,
+                                             closure = True )
+        for walk_engine in [ RelationCountingEngine( engine.store ) ,
+                             RelationCountingEngine( umls_index.SqliteStore( index_file ) ) ]:
+            csv_u.use_umls_engine( walk_engine )
+            try:
+                concepts = csv_u.seed_concept( {} , 'C0000001' )
+                concepts = csv_u.seed_concept( concepts , 'C0000002' , 'C0000001' )
+                concepts = csv_u.seed_concept( concepts , 'C0000003' , 'C0000001' )
+                cui_dict = { 'C0000001' : { 'descendants_exclude_list' : [] } }
+                results.append( ( csv_u.parse_problems_queue( cui_dict , concepts , None ,
+                                                              [ 'C0000002' , 'C0000003' ] , [] ) ,
+                                  walk_engine.batches ) )
+            finally:
+                csv_u.use_umls_engine( uu )
+        walk_engine.store.close()
+    ( walked , walked_batches ) , ( closed , closed_batches ) = results
+    assert closed == walked
+    assert closed[ 'C0000004' ][ 'head_cui' ] == 'C0000001'
+    ## One batch per level without the closure, one in all with it
+    assert walked_batches == [ [ 'C0000002' , 'C0000003' ] , [ 'C0000004' ] ]
+    assert closed_batches == [ [ 'C0000002' , 'C0000003' , 'C0000004' ] ]
+
+#############################################
+## CSR graph
+#############################################
+
+def test_csr_graph_rows_match_relations():
+    pytest.importorskip( 'numpy' )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        graph = csr_graph.CsrGraph( csr_graph.build_graph( 'in/tiny_rrf' , tmpdir ) )
+        for cui in [ 'C0000001' , 'C0000002' , 'C0000003' , 'C0000004' , 'C0000005' ]:
+            owners , neighbors = graph.neighbors( 'RB' , graph.encode( [ cui ] ) )
+            assert graph.decode( neighbors ) == sorted( engine.get_rbs( None , 'current' , cui ) )
+            owners , neighbors = graph.neighbors( 'RO' , graph.encode( [ cui ] ) )
+            assert graph.decode( neighbors ) == sorted( engine.get_ros( None , 'current' , cui ) )
+        assert list( graph.encode( [ 'C0000002' , 'C9999999' ] ) >= 0 ) == [ True , False ]
+
+
+def test_csr_graph_expansion():
+    pytest.importorskip( 'numpy' )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        graph = csr_graph.CsrGraph( csr_graph.build_graph( 'in/tiny_rrf' , tmpdir ) )
+        parents = [ 'C0000001' , 'C0000002' , 'C9999999' ]
+        heads = [ 'A' , 'B' , 'C' ]
+        visited = graph.visited()
+        assert graph.expand( parents , heads , {} , visited ) == [ ( 'C0000002' , 'A' ) ,
+                                                                   ( 'C0000003' , 'A' ) ,
+                                                                   ( 'C0000004' , 'B' ) ]
+        ## The children seeded above are now visited
+        assert graph.expand( parents , heads , {} , visited ) == []
+        assert graph.expand( parents , heads , { 'A' : [ 'C0000002' ] } ,
+                             graph.visited( [ 'C0000003' ] ) ) == [ ( 'C0000004' , 'B' ) ]
+
+
+def test_queue_expansion_over_csr_graph_matches_look_ups():
+    pytest.importorskip( 'numpy' )
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        csr_graph.build_graph( 'in/tiny_rrf' , tmpdir )
+        for graph_dir in [ None , tmpdir ]:
+            csv_u.use_umls_engine( local_umls_utils.open_engine( 'in/tiny_rrf' ,
+                                                                 graph_dir = graph_dir ) )
+            try:
+                concepts = csv_u.seed_concept( {} , 'C0000001' )
+                concepts = csv_u.seed_concept( concepts , 'C0000002' , 'C0000001' )
+                cui_dict = { 'C0000001' : { 'descendants_exclude_list' : [ 'C0000003' ] } }
+                results.append( csv_u.parse_problems_queue( cui_dict , concepts , None ,
+                                                            [ 'C0000002' ] , [] ) )
+            finally:
+                csv_u.use_umls_engine( uu )
+    assert results[ 0 ] == results[ 1 ]
+    assert results[ 1 ][ 'C0000004' ][ 'head_cui' ] == 'C0000001'
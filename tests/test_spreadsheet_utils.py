@@ -6,9 +6,14 @@ from mock import patch
 import tempfile
 
 import json
+import multiprocessing
 
+import checkpoint_utils
 import lex_gen
+import parallel_utils
 import spreadsheet_utils as csv_u
+import umls_utils as uu
+import work_queue
 
 #############################################
 ## Extracting concepts
@@ -32,3 +37,433 @@ def test_extract_concepts_from_tiny_problems_with_gaps():
     assert len( concepts ) == 2
 
 
+
+#############################################
+## Walking the RB hierarchy
+#############################################
+
+class ChainEngine:
+    ## C0 -> C1 -> ... -> C<depth>, plus C0 -> X -> C2 as a shortcut
+
+    UMLS_API_TOKEN = None
+
+    def __init__( self , depth ):
+        self.depth = depth
+
+    def init_authentication( self , api_key , auth_mode = None ):
+        return( None )
+
+    def children( self , cui ):
+        if( cui == 'C0' ):
+            return( [ 'C1' , 'X' ] )
+        if( cui == 'X' ):
+            return( [ 'C2' ] )
+        position = int( cui[ 1: ] )
+        if( position < self.depth ):
+            return( [ 'C{}'.format( position + 1 ) ] )
+        return( [] )
+
+    def get_concept_bundles( self , auth_client , version , cuis ):
+        return( dict( ( cui , None ) for cui in cuis ) )
+
+    def get_typed_relations( self , auth_client , version , cuis , label ):
+        return( dict( ( cui , dict( ( child , child ) for child in self.children( cui ) ) )
+                      for cui in cuis ) )
+
+
+def walk_chain( depth , exclude_list = [] , max_distance = -1 ):
+    csv_u.use_umls_engine( ChainEngine( depth ) )
+    try:
+        concepts = csv_u.seed_concept( {} , 'C0' )
+        concepts = csv_u.seed_concept( concepts , 'C1' , 'C0' )
+        concepts = csv_u.seed_concept( concepts , 'X' , 'C0' )
+        distances = {}
+        concepts = csv_u.parse_problems_queue( { 'C0' : { 'descendants_exclude_list' : exclude_list } } ,
+                                               concepts , None , [ 'X' , 'C1' , 'X' ] , [] ,
+                                               max_distance = max_distance ,
+                                               distances = distances )
+    finally:
+        csv_u.use_umls_engine( uu )
+    return( concepts , distances )
+
+
+def test_deep_hierarchies_are_walked_without_recursion():
+    depth = sys.getrecursionlimit() + 100
+    concepts , distances = walk_chain( depth )
+    assert len( concepts ) == depth + 2
+    assert distances[ 'C{}'.format( depth ) ] == depth
+    assert concepts[ 'C{}'.format( depth ) ][ 'head_cui' ] == 'C0'
+
+
+def test_walk_tracks_distances_and_exclusions():
+    concepts , distances = walk_chain( 4 , exclude_list = [ 'C3' ] )
+    assert distances == { 'C1' : 1 , 'X' : 1 , 'C2' : 2 }
+    assert 'C3' not in concepts
+    concepts , distances = walk_chain( 4 , max_distance = 2 )
+    assert sorted( distances ) == [ 'C1' , 'C2' , 'X' ]
+    assert 'C3' not in concepts
+
+
+class OverlapEngine:
+    ## H0 -> M -> D -> E , and H1's parent P -> Q -> R -> D:  D is two
+    ## steps below H0 but walked first from H1's parent
+
+    UMLS_API_TOKEN = None
+
+    tree = { 'H0' : [ 'M' ] , 'M' : [ 'D' ] , 'D' : [ 'E' ] ,
+             'P' : [ 'Q' ] , 'Q' : [ 'R' ] , 'R' : [ 'D' ] }
+    parents = { 'H1' : [ 'P' ] }
+
+    def init_authentication( self , api_key , auth_mode = None ):
+        return( None )
+
+    def get_rbs( self , auth_client , version , identifier ):
+        return( dict( ( child , child ) for child in self.tree.get( identifier , [] ) ) )
+
+    def get_rns( self , auth_client , version , identifier ):
+        return( dict( ( parent , parent ) for parent in self.parents.get( identifier , [] ) ) )
+
+    def get_concept_bundle( self , auth_client , version , identifier ):
+        return( uu.ConceptBundle( 'Term {}'.format( identifier ) , [ 'T047' ] ,
+                                  set( [ identifier.lower() ] ) ) )
+
+
+def overlap_heads( snomed_include_list = [] ):
+    cui_dict = {}
+    concepts = {}
+    for head_cui in [ 'H0' , 'H1' ]:
+        cui_dict[ head_cui ] = { 'include_parents_flag' : ( head_cui == 'H1' ) ,
+                                 'parents_include_list' : [] ,
+                                 'include_ro_flag' : False ,
+                                 'ro_include_list' : [] ,
+                                 'ro_exclude_list' : [] ,
+                                 'descendants_exclude_list' : [] ,
+                                 'snomed_parent_list' : [] ,
+                                 'snomed_include_list' : ( snomed_include_list
+                                                           if( head_cui == 'H0' ) else [] ) }
+        concepts = csv_u.seed_concept( concepts , head_cui )
+    return( cui_dict , concepts )
+
+
+def test_standalone_queue_is_claimed_before_the_mth_queue():
+    csv_u.use_umls_engine( OverlapEngine() )
+    try:
+        cui_dict , concepts = overlap_heads()
+        cui_dict , concepts = csv_u.parse_problems_via_api( cui_dict , concepts )
+    finally:
+        csv_u.use_umls_engine( uu )
+    ## As before the walk went level by level:  everything the parents
+    ## reach goes to H1, even D which is closer to H0
+    assert dict( ( cui , concepts[ cui ].get( 'head_cui' ) )
+                 for cui in concepts ) == { 'H0' : None , 'H1' : None ,
+                                            'M' : 'H0' ,
+                                            'P' : 'H1' , 'Q' : 'H1' , 'R' : 'H1' ,
+                                            'D' : 'H1' , 'E' : 'H1' }
+
+#############################################
+## Walking SNOMED alongside the RB hierarchy
+#############################################
+
+class SnomedOverlapEngine( OverlapEngine ):
+    ## SNOMED 100 -> 101 -> 102 , mapped to S and T , with S also an RB
+    ## child of H1
+
+    tree = dict( OverlapEngine.tree , H1 = [ 'S' ] )
+    snomed_tree = { '100' : [ '101' ] , '101' : [ '102' ] }
+    snomed_cuis = { '101' : 'S' , '102' : 'T' }
+
+    def get_family_tree( self , auth_client , version , identifier ,
+                         relation_type , root_source = 'SNOMEDCT_US' ):
+        return( set( self.snomed_tree.get( identifier , [] ) ) )
+
+    def get_cuis( self , auth_client , version , identifiers , source ):
+        return( dict( ( identifier , self.snomed_cuis.get( identifier ) )
+                      for identifier in identifiers ) )
+
+    def get_cui( self , auth_client , version , identifier , source ):
+        return( self.snomed_cuis.get( identifier ) )
+
+
+def test_first_snomed_level_is_claimed_in_head_order():
+    csv_u.use_umls_engine( SnomedOverlapEngine() )
+    try:
+        cui_dict , concepts = overlap_heads( snomed_include_list = [ '100' ] )
+        cui_dict , concepts = csv_u.parse_problems_via_api( cui_dict , concepts )
+    finally:
+        csv_u.use_umls_engine( uu )
+    ## H0's SNOMED list reaches S before H1's RB children are seeded,
+    ## and the level below it is walked too
+    assert concepts[ 'S' ][ 'head_cui' ] == 'H0'
+    assert concepts[ 'T' ][ 'head_cui' ] == 'H0'
+    assert concepts[ 'D' ][ 'head_cui' ] == 'H1'
+
+class SnomedEngine( ChainEngine ):
+    ## SNOMED 100 -> 101 -> 102 -> 103, mapped to S1, S2 and S3, with
+    ## 102 also an RB child of C1
+
+    snomed_tree = { '100' : [ '101' ] , '101' : [ '102' ] , '102' : [ '103' ] }
+    snomed_cuis = { '101' : 'S1' , '102' : 'S2' , '103' : 'S3' }
+
+    def children( self , cui ):
+        if( cui == 'C1' ):
+            return( [ 'S2' ] )
+        return( [] )
+
+    def get_family_tree( self , auth_client , version , identifier ,
+                         relation_type , root_source = 'SNOMEDCT_US' ):
+        return( set( self.snomed_tree.get( identifier , [] ) ) )
+
+    def get_cui( self , auth_client , version , identifier , source ):
+        return( self.snomed_cuis.get( identifier ) )
+
+    def get_cuis( self , auth_client , version , identifiers , source ):
+        return( dict( ( identifier , self.snomed_cuis.get( identifier ) )
+                      for identifier in identifiers ) )
+
+
+def walk_snomed( exclude_list = [] , max_distance = -1 , partials_dir = None ):
+    ## C0's RB child C1 and the first SNOMED level below 100 (101 as
+    ## S1), as parse_problems_via_api seeds them
+    csv_u.use_umls_engine( SnomedEngine( 0 ) )
+    try:
+        concepts = csv_u.seed_concept( {} , 'C0' )
+        concepts = csv_u.seed_concept( concepts , 'C1' , 'C0' )
+        concepts = csv_u.seed_concept( concepts , 'S1' , 'C0' )
+        distances = {}
+        concepts = csv_u.parse_problems_queue( { 'C0' : { 'descendants_exclude_list' : exclude_list } } ,
+                                               concepts , partials_dir , [ 'C1' , 'S1' ] , [ ( '101' , 'C0' ) ] ,
+                                               max_distance = max_distance ,
+                                               distances = distances )
+    finally:
+        csv_u.use_umls_engine( uu )
+    return( concepts , distances )
+
+
+def test_snomed_walk_runs_alongside_the_rb_walk():
+    concepts , distances = walk_snomed()
+    assert distances == { 'C1' : 1 , 'S1' : 1 , 'S2' : 2 , 'S3' : 3 }
+    assert concepts[ 'S3' ][ 'head_cui' ] == 'C0'
+
+
+def test_snomed_walk_honors_distance_and_exclusions():
+    concepts , distances = walk_snomed( max_distance = 1 )
+    assert sorted( distances ) == [ 'C1' , 'S1' ]
+    concepts , distances = walk_snomed( exclude_list = [ 'S2' ] )
+    ## Neither C1 nor 101 reaches S2, and nothing below it is walked as
+    ## SNOMED
+    assert sorted( distances ) == [ 'C1' , 'S1' ]
+
+
+class Interrupted( Exception ):
+    pass
+
+
+def test_interrupted_snomed_walk_resumes_to_the_same_result():
+    expected , expected_distances = walk_snomed()
+    fetch_level = csv_u.aio.fetch_level
+    ## Stop before each level's batch of look-ups
+    for interrupt in range( 3 ):
+        fetched = []
+        def fetch_then_stop( *args , **kwargs ):
+            if( len( fetched ) == interrupt ):
+                raise Interrupted()
+            fetched.append( interrupt )
+            return( fetch_level( *args , **kwargs ) )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch.object( csv_u.aio , 'fetch_level' , side_effect = fetch_then_stop ):
+                try:
+                    walk_snomed( partials_dir = tmp_dir )
+                    assert False
+                except Interrupted:
+                    pass
+            concepts , distances = walk_snomed( partials_dir = tmp_dir )
+        assert concepts == expected
+        ## Whatever is left is walked at its original distance
+        for cui , distance in distances.items():
+            assert expected_distances[ cui ] == distance
+
+
+def test_walk_checkpoints_match_the_final_state():
+    csv_u.use_umls_engine( ChainEngine( 6 ) )
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            concepts = csv_u.seed_concept( {} , 'C0' )
+            concepts = csv_u.seed_concept( concepts , 'C1' , 'C0' )
+            concepts = csv_u.seed_concept( concepts , 'X' , 'C0' )
+            concepts = csv_u.parse_problems_queue( { 'C0' : { 'descendants_exclude_list' : [] } } ,
+                                                   concepts , tmp_dir , [ 'C1' , 'X' ] , [] )
+            assert sorted( concepts[ 'C0' ][ 'related_cuis' ] ) == [ 'C1' , 'C2' , 'C3' , 'C4' ,
+                                                                    'C5' , 'C6' , 'X' ]
+            assert checkpoint_utils.load_state( tmp_dir )[ 'concepts' ] == concepts
+    finally:
+        csv_u.use_umls_engine( uu )
+
+
+#############################################
+## Expanding heads on worker processes
+#############################################
+
+class ForestEngine:
+    ## H1 -> A -> B -> Z , H2 -> Z and H3 -> A:  heads whose subtrees
+    ## overlap, answered one look-up at a time
+
+    UMLS_API_TOKEN = None
+
+    tree = { 'H1' : [ 'A' ] , 'A' : [ 'B' ] , 'B' : [ 'Z' ] ,
+             'H2' : [ 'Z' ] , 'H3' : [ 'A' ] }
+
+    def __init__( self ):
+        self.calls = []
+
+    def init_authentication( self , api_key , auth_mode = None ):
+        return( None )
+
+    def get_rbs( self , auth_client , version , identifier ):
+        self.calls.append( identifier )
+        return( dict( ( child , child ) for child in self.tree.get( identifier , [] ) ) )
+
+    def get_concept_bundle( self , auth_client , version , identifier ):
+        self.calls.append( identifier )
+        return( uu.ConceptBundle( 'Term {}'.format( identifier ) , [ 'T047' ] ,
+                                  set( [ 'Term {}'.format( identifier ) , identifier.lower() ] ) ) )
+
+
+def forest_heads():
+    cui_dict = {}
+    concepts = {}
+    for head_cui in [ 'H3' , 'H1' , 'H2' ]:
+        cui_dict[ head_cui ] = { 'include_parents_flag' : False ,
+                                 'parents_include_list' : [] ,
+                                 'include_ro_flag' : False ,
+                                 'ro_include_list' : [] ,
+                                 'ro_exclude_list' : [] ,
+                                 'descendants_exclude_list' : [] ,
+                                 'snomed_parent_list' : [] ,
+                                 'snomed_include_list' : [] }
+        concepts = csv_u.seed_concept( concepts , head_cui )
+    return( cui_dict , concepts )
+
+
+def expand_forest( workers , queue_file = None , partials_dir = None ):
+    engine = ForestEngine()
+    csv_u.use_umls_engine( engine )
+    try:
+        cui_dict , concepts = forest_heads()
+        cui_dict , concepts = csv_u.parse_problems_via_api( cui_dict , concepts ,
+                                                            partials_dir = partials_dir ,
+                                                            workers = workers ,
+                                                            queue_file = queue_file )
+    finally:
+        csv_u.use_umls_engine( uu )
+    return( cui_dict , concepts , engine.calls )
+
+
+def test_interrupted_walk_resumes_to_the_same_result():
+    serial_dict , serial_concepts , serial_calls = expand_forest( workers = 1 )
+    flesh_out_seed_concept = csv_u.flesh_out_seed_concept
+    ## The walk fills out A and Z and then B:  stop it before each
+    for interrupt in range( 3 ):
+        filled = []
+        def flesh_out_then_stop( *args , **kwargs ):
+            if( len( filled ) == interrupt ):
+                raise Interrupted()
+            filled.append( args[ 2 ] )
+            return( flesh_out_seed_concept( *args , **kwargs ) )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch.object( csv_u , 'flesh_out_seed_concept' , side_effect = flesh_out_then_stop ):
+                try:
+                    expand_forest( workers = 1 , partials_dir = tmp_dir )
+                    assert False
+                except Interrupted:
+                    pass
+            cui_dict , concepts , calls = expand_forest( workers = 1 , partials_dir = tmp_dir )
+        assert cui_dict == serial_dict
+        assert concepts == serial_concepts
+        ## Neither the heads nor the parents filled out before the
+        ## interruption are looked up again
+        assert 'H1' not in calls
+        for cui in filled:
+            assert cui not in calls
+
+
+def test_workers_merge_to_the_serial_result():
+    serial_dict , serial_concepts , serial_calls = expand_forest( workers = 1 )
+    assert serial_concepts[ 'A' ][ 'head_cui' ] == 'H1'
+    assert serial_concepts[ 'Z' ][ 'head_cui' ] == 'H2'
+    cui_dict , concepts , calls = expand_forest( workers = 2 )
+    assert cui_dict == serial_dict
+    assert concepts == serial_concepts
+    ## Every look-up was made by a worker and replayed from its answer
+    assert len( serial_calls ) > 0
+    assert calls == []
+
+
+class BatchCountingEngine( ChainEngine ):
+
+    def __init__( self , depth ):
+        super().__init__( depth )
+        self.batches = []
+
+    def get_typed_relations( self , auth_client , version , cuis , label ):
+        self.batches.append( list( cuis ) )
+        return( super().get_typed_relations( auth_client , version , cuis , label ) )
+
+
+def test_batched_look_ups_are_replayed_one_identifier_at_a_time():
+    worker = parallel_utils.MemoEngine( BatchCountingEngine( 3 ) )
+    worker.get_typed_relations( None , 'current' , [ 'C0' , 'C1' ] , 'RB' )
+    engine = BatchCountingEngine( 3 )
+    replay = parallel_utils.MemoEngine( engine , worker.take_recorded() )
+    assert replay.get_typed_relations( None , 'current' , [ 'C1' , 'C2' , 'C1' ] , 'RB' ) == \
+        { 'C1' : { 'C2' : 'C2' } , 'C2' : { 'C3' : 'C3' } }
+    ## Only what the worker didn't see is asked for, in one batch
+    assert engine.batches == [ [ 'C2' ] ]
+    assert ( replay.hits , replay.misses ) == ( 1 , 1 )
+
+
+def test_replayed_code_look_ups_reach_the_crosswalk():
+    uu.set_negative_cache( None )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        crosswalk = uu.set_crosswalk( os.path.join( tmp_dir , 'crosswalk.tsv' ) )
+        try:
+            replay = parallel_utils.MemoEngine( uu , { parallel_utils.lookup_key( 'get_cui' ,
+                                                                                  ( None , 'current' , '80891009' , 'SNOMEDCT_US' ) ,
+                                                                                  {} ) : 'C0018787' ,
+                                                       parallel_utils.lookup_key( 'get_cuis' ,
+                                                                                  ( None , 'current' , '22298006' , 'SNOMEDCT_US' ) ,
+                                                                                  {} ) : 'C0027051' } )
+            assert replay.get_cui( None , 'current' , '80891009' , 'SNOMEDCT_US' ) == 'C0018787'
+            assert replay.get_cuis( None , 'current' , [ '22298006' ] ,
+                                    'SNOMEDCT_US' ) == { '22298006' : 'C0027051' }
+            assert crosswalk.get_cuis( 'SNOMEDCT_US' , [ '80891009' , '22298006' ] ) == { '80891009' : 'C0018787' ,
+                                                                                         '22298006' : 'C0027051' }
+        finally:
+            uu.set_crosswalk( None )
+
+
+def serve_forest( queue_file ):
+    work_queue.serve_file( queue_file , ForestEngine() , csv_u.use_umls_engine )
+
+
+def test_queue_workers_merge_to_the_serial_result():
+    serial_dict , serial_concepts , serial_calls = expand_forest( workers = 1 )
+    context = multiprocessing.get_context( 'fork' )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue_file = os.path.join( tmp_dir , 'queue.db' )
+        with patch.object( work_queue , 'DEFAULT_POLL_SECONDS' , 0.05 ):
+            ## Workers started first wait for the coordinator's tasks
+            work_queue.WorkQueue( queue_file ).close()
+            workers = [ context.Process( target = serve_forest , args = ( queue_file , ) )
+                        for position in range( 2 ) ]
+            for worker in workers:
+                worker.start()
+            cui_dict , concepts , calls = expand_forest( workers = 2 ,
+                                                         queue_file = queue_file )
+            for worker in workers:
+                worker.join( 30 )
+                assert worker.exitcode == 0
+    assert cui_dict == serial_dict
+    assert concepts == serial_concepts
+    ## Whatever the coordinator walked itself was not looked up again
+    ## in the replay
+    assert len( calls ) <= len( serial_calls )
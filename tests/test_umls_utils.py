@@ -0,0 +1,199 @@
+import os
+import sys
+
+from mock import patch
+
+import json
+import threading
+
+import umls_utils as uu
+
+#############################################
+## Authentication
+#############################################
+
+def test_tgt_is_cached_between_calls():
+    manager = uu.CredentialManager( 'fake-key' , auth_mode = 'cas' )
+    with patch.object( manager.auth_client , 'gettgt' ,
+                       return_value = 'TGT-1' ) as gettgt:
+        with patch.object( manager.auth_client , 'getst' ,
+                           return_value = 'ST-1' ):
+            for i in range( 5 ):
+                assert manager.getst( manager.gettgt() ) == 'ST-1'
+        assert gettgt.call_count == 1
+
+
+def test_tgt_is_refreshed_before_it_expires():
+    manager = uu.CredentialManager( 'fake-key' ,
+                                    auth_mode = 'cas' ,
+                                    tgt_lifetime = 100 ,
+                                    refresh_margin = 10 )
+    with patch.object( manager.auth_client , 'gettgt' ,
+                       side_effect = [ 'TGT-1' , 'TGT-2' ] ):
+        assert manager.gettgt() == 'TGT-1'
+        manager.tgt_time -= 95
+        assert manager.gettgt() == 'TGT-2'
+
+
+def test_rejected_service_ticket_forces_new_tgt():
+    manager = uu.CredentialManager( 'fake-key' , auth_mode = 'cas' )
+    with patch.object( manager.auth_client , 'gettgt' ,
+                       side_effect = [ 'TGT-1' , 'TGT-2' ] ):
+        with patch.object( manager.auth_client , 'getst' ,
+                           side_effect = [ '<html>Not Found</html>' , 'ST-2' ] ) as getst:
+            assert manager.getst() == 'ST-2'
+            getst.assert_called_with( 'TGT-2' )
+
+
+def test_tgt_is_shared_across_threads():
+    manager = uu.CredentialManager( 'fake-key' , auth_mode = 'cas' )
+    with patch.object( manager.auth_client , 'gettgt' ,
+                       return_value = 'TGT-1' ) as gettgt:
+        threads = [ threading.Thread( target = manager.gettgt ) for i in range( 8 ) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert gettgt.call_count == 1
+
+
+def test_init_authentication_returns_shared_manager():
+    assert uu.init_authentication( 'fake-key' ) is uu.init_authentication( 'fake-key' )
+
+
+def test_manager_defaults_to_the_module_auth_mode():
+    with patch.object( uu , 'UMLS_AUTH_MODE' , 'apikey' ):
+        assert uu.CredentialManager( 'fake-key' ).auth_mode == 'apikey'
+    with patch.object( uu , 'UMLS_AUTH_MODE' , 'cas' ):
+        assert uu.CredentialManager( 'fake-key' ).auth_mode == 'cas'
+
+
+def test_apikey_mode_skips_service_tickets():
+    manager = uu.CredentialManager( 'fake-key' , auth_mode = 'apikey' )
+    with patch.object( manager.auth_client , 'gettgt' ) as gettgt:
+        with patch.object( manager.auth_client , 'getst' ) as getst:
+            assert manager.query_params() == { 'apiKey' : 'fake-key' }
+            assert gettgt.call_count == 0
+            assert getst.call_count == 0
+
+
+def test_uts_get_carries_the_api_key():
+    manager = uu.CredentialManager( 'fake-key' , auth_mode = 'apikey' )
+    with patch.object( uu.http_utils , 'get' ) as get:
+        get.return_value.text = '{}'
+        get.return_value.status_code = 200
+        assert uu.uts_get( manager , '/rest/content/current/CUI/C0000737' ,
+                           { 'pageNumber' : 2 } ) == '{}'
+        get.assert_called_once_with( uu.UTS_URI + '/rest/content/current/CUI/C0000737' ,
+                                     params = { 'apiKey' : 'fake-key' ,
+                                                'pageNumber' : 2 } )
+
+#############################################
+## Paging
+#############################################
+
+def fake_relation_pages( auth_client , content_endpoint , params = None ):
+    page_number = params[ 'pageNumber' ]
+    assert params[ 'pageSize' ] == uu.UTS_PAGE_SIZE
+    return( json.dumps( { 'pageCount' : 3 ,
+                          'pageNumber' : page_number ,
+                          'result' : [ { 'relationLabel' : 'RB' ,
+                                         'relatedIdName' : 'Child {}'.format( page_number ) ,
+                                         'relatedId' : 'https://uts-ws.nlm.nih.gov/rest/content/2023AB/CUI/C000000{}'.format( page_number ) } ,
+                                       { 'relationLabel' : 'RN' ,
+                                         'relatedIdName' : 'Parent' ,
+                                         'relatedId' : 'https://uts-ws.nlm.nih.gov/rest/content/2023AB/CUI/C0000009' } ] } ) )
+
+
+def test_all_pages_are_merged_in_page_order():
+    with patch.object( uu , 'uts_get' , side_effect = fake_relation_pages ) as uts_get:
+        rbs = uu.get_rbs( None , 'current' , 'C0000737' )
+        assert uts_get.call_count == 3
+    assert list( rbs ) == [ 'C0000001' , 'C0000002' , 'C0000003' ]
+    assert rbs[ 'C0000002' ] == 'Child 2'
+
+
+def test_error_page_fails_the_result_set():
+    ## A later page failing must not pass for a shorter result set
+    pages = [ { 'pageCount' : 3 , 'result' : [ 1 ] } ,
+              { 'error' : 'boom' } ,
+              { 'result' : [ 3 ] } ]
+    try:
+        list( uu.page_results( pages ) )
+        assert False
+    except uu.UmlsRequestError:
+        pass
+    assert list( uu.page_results( [ { 'status' : 404 , 'error' : 'Not Found' } ] ) ) == []
+
+
+def test_failed_requests_are_not_remembered_as_empty():
+    uu.set_negative_cache( None )
+    unauthorized = json.dumps( { 'status' : 401 , 'error' : 'Unauthorized' } )
+    with patch.object( uu , 'uts_get' , return_value = unauthorized ):
+        for lookup in [ lambda : uu.get_rbs( None , 'current' , 'C0000737' ) ,
+                        lambda : uu.get_cuis_preferred_atom( None , 'current' , 'C0000737' ) ,
+                        lambda : uu.get_concept_bundle( None , 'current' , 'C0000737' ) ]:
+            try:
+                lookup()
+                assert False
+            except uu.UmlsRequestError:
+                pass
+    assert uu.request_stats().get( 'negative stores (no-rb-children)' , 0 ) == 0
+    assert uu.request_stats().get( 'negative stores (cui-not-found)' , 0 ) == 0
+    not_found = json.dumps( { 'status' : 404 , 'error' : 'Not Found' } )
+    with patch.object( uu , 'uts_get' , return_value = not_found ):
+        assert uu.get_rbs( None , 'current' , 'C0000737' ) == {}
+    assert uu.request_stats()[ 'negative stores (no-rb-children)' ] == 1
+    uu.set_negative_cache( None )
+
+
+def test_undecodable_pages_are_retried_not_dropped():
+    bodies = [ '<html>Too Many Requests</html>' ,
+               '{"pageCount":1}' ,
+               '{"pageCount":1,"result":[{"relationLabel":"RB","relatedIdName":"Child","relatedId":"https://uts-ws.nlm.nih.gov/rest/content/2023AB/CUI/C0000001"}]}' ]
+    with patch.object( uu , 'uts_get' , side_effect = bodies ) as uts_get:
+        with patch.object( uu.time , 'sleep' ):
+            assert uu.get_rbs( None , 'current' , 'C0000737' ) == { 'C0000001' : 'Child' }
+        assert uts_get.call_count == 3
+
+
+def test_exhausted_retries_raise():
+    with patch.object( uu , 'uts_get' , return_value = '<html></html>' ):
+        with patch.object( uu.time , 'sleep' ):
+            try:
+                uu.uts_get_json( None , '/rest/content/current/CUI/C0000737' )
+                assert False
+            except uu.UmlsRequestError:
+                pass
+
+#############################################
+## Concept bundles
+#############################################
+
+def fake_concept_endpoints( auth_client , content_endpoint , params = None ):
+    if( content_endpoint.endswith( '/atoms?language=ENG' ) ):
+        return( json.dumps( { 'pageCount' : 1 ,
+                              'result' : [ { 'name' : 'Heart attack' } ,
+                                           { 'name' : 'Myocardial infarction' } ] } ) )
+    if( content_endpoint.endswith( 'C0027051' ) ):
+        return( json.dumps( { 'result' : { 'name' : 'Myocardial Infarction' ,
+                                           'semanticTypes' : [ { 'uri' : 'https://uts-ws.nlm.nih.gov/rest/semantic-network/2023AB/TUI/T047' } ,
+                                                               { 'uri' : 'https://uts-ws.nlm.nih.gov/rest/semantic-network/2023AB/TUI/T046' } ] } } ) )
+    return( json.dumps( { 'error' : 'No results containing all your search terms were found.' } ) )
+
+
+def test_concept_bundle_uses_two_requests():
+    uu.set_negative_cache( None )
+    with patch.object( uu , 'uts_get' , side_effect = fake_concept_endpoints ) as uts_get:
+        bundle = uu.get_concept_bundle( None , 'current' , 'C0027051' )
+        assert uts_get.call_count == 2
+    assert bundle.name == 'Myocardial Infarction'
+    assert bundle.tuis == [ 'T047' , 'T046' ]
+    assert bundle.eng_atoms == set( [ 'Heart attack' , 'Myocardial infarction' ] )
+
+
+def test_concept_bundle_for_unknown_cui():
+    uu.set_negative_cache( None )
+    with patch.object( uu , 'uts_get' , side_effect = fake_concept_endpoints ):
+        assert uu.get_concept_bundle( None , 'current' , 'C9999999' ) is None
+    uu.set_negative_cache( None )
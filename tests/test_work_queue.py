@@ -0,0 +1,134 @@
+import os
+import sys
+
+import multiprocessing
+import tempfile
+import time
+
+from mock import patch
+
+import work_queue
+
+#############################################
+## Leases
+#############################################
+
+## The engine look-ups are routed through in this process
+engine = None
+
+
+def install( new_engine ):
+    global engine
+    engine = new_engine
+
+
+class CountingEngine:
+
+    def get_rxclass_members( self , class_id ):
+        return( [ '{}-member'.format( class_id ) ] )
+
+
+def walk_classes( share ):
+    for class_id in share:
+        engine.get_rxclass_members( class_id )
+
+
+def test_expired_lease_is_claimed_again():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue = work_queue.WorkQueue( os.path.join( tmp_dir , 'queue.db' ) )
+        queue.post( walk_classes , [ [ 'A' ] ] , lease_seconds = 0.2 )
+        task_id , lease , job_id , share = queue.claim( 'first' )
+        assert share == [ 'A' ]
+        assert queue.claim( 'second' ) is None
+        time.sleep( 0.3 )
+        second_id , second_lease , _ , _ = queue.claim( 'second' )
+        assert second_id == task_id
+        ## The first worker finishing late doesn't overwrite the second
+        assert not queue.heartbeat( task_id , lease )
+        assert not queue.complete( task_id , lease , { 'late' : True } )
+        assert queue.complete( task_id , second_lease , { 'on time' : True } )
+        assert list( queue.results() ) == [ { 'on time' : True } ]
+        assert queue.settled()
+        queue.close()
+
+
+def test_heartbeat_keeps_a_lease():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue = work_queue.WorkQueue( os.path.join( tmp_dir , 'queue.db' ) )
+        queue.post( walk_classes , [ [ 'A' ] ] , lease_seconds = 0.3 )
+        task_id , lease , _ , _ = queue.claim( 'first' )
+        heartbeat = work_queue.Heartbeat( queue , task_id , lease )
+        heartbeat.start()
+        time.sleep( 0.6 )
+        assert queue.claim( 'second' ) is None
+        heartbeat.stop()
+        assert not heartbeat.lost
+        queue.close()
+
+
+def test_task_is_given_up_after_its_attempts():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue = work_queue.WorkQueue( os.path.join( tmp_dir , 'queue.db' ) )
+        queue.post( walk_classes , [ [ 'A' ] ] , max_attempts = 2 )
+        for attempt in range( 2 ):
+            task_id , lease , _ , _ = queue.claim( 'worker' )
+            queue.release( task_id , lease , 'broken' )
+        assert queue.claim( 'worker' ) is None
+        assert queue.counts() == { 'failed' : 1 }
+        assert queue.settled()
+        queue.close()
+
+#############################################
+## Workers
+#############################################
+
+def die_holding_a_lease( queue_file ):
+    queue = work_queue.WorkQueue( queue_file )
+    queue.claim( 'doomed' )
+    os._exit( 1 )
+
+
+def serve_queue( queue_file ):
+    work_queue.serve_file( queue_file , CountingEngine() , install )
+
+
+def test_workers_recover_from_a_worker_dying_mid_lease():
+    context = multiprocessing.get_context( 'fork' )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue_file = os.path.join( tmp_dir , 'queue.db' )
+        queue = work_queue.WorkQueue( queue_file )
+        queue.post( walk_classes , [ [ 'A' , 'B' ] , [ 'C' ] , [ 'D' ] ] ,
+                    lease_seconds = 0.5 )
+        doomed = context.Process( target = die_holding_a_lease , args = ( queue_file , ) )
+        doomed.start()
+        doomed.join()
+        assert queue.counts() == { 'leased' : 1 , 'pending' : 2 }
+        with patch.object( work_queue , 'DEFAULT_POLL_SECONDS' , 0.05 ):
+            workers = [ context.Process( target = serve_queue , args = ( queue_file , ) )
+                        for position in range( 2 ) ]
+            for worker in workers:
+                worker.start()
+            serve_queue( queue_file )
+            for worker in workers:
+                worker.join( 30 )
+                assert worker.exitcode == 0
+        assert queue.counts() == { 'done' : 3 }
+        recorded = {}
+        for result in queue.results():
+            recorded.update( result )
+        assert sorted( key[ 1 ][ 0 ] for key in recorded ) == [ 'A' , 'B' , 'C' , 'D' ]
+        queue.close()
+
+
+def test_distribute_posts_with_the_lease_it_is_given():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue_file = os.path.join( tmp_dir , 'queue.db' )
+        memo = work_queue.distribute( CountingEngine() , [ 'A' , 'B' ] , 2 ,
+                                      walk_classes , install , queue_file ,
+                                      lease_seconds = 7 )
+        assert memo.get_rxclass_members( 'A' ) == [ 'A-member' ]
+        queue = work_queue.WorkQueue( queue_file )
+        assert queue.setting( 'lease_seconds' ) == 7
+        ## Only the owner may write the pickles workers will load
+        assert os.stat( queue_file ).st_mode & 0o077 == 0
+        queue.close()
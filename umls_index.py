@@ -0,0 +1,429 @@
+import logging as log
+
+import os
+import sys
+
+import argparse
+
+import sqlite3
+import threading
+
+import rrf_utils
+
+########################################################################
+## One-time load of MRCONSO, MRREL and MRSTY into an indexed SQLite
+## database, keeping only the columns (and, optionally, languages and
+## sources) the local engine reads.  SqliteStore then offers the same
+## look-ups as rrf_utils.RrfStore, plus batched versions that resolve a
+## whole BFS frontier with a handful of `IN (...)` queries.
+########################################################################
+
+## Rows handed to executemany at a time while loading
+INSERT_BATCH_SIZE = 50000
+
+## SQLite's default limit on host parameters is 999
+QUERY_BATCH_SIZE = 500
+
+DEFAULT_LANGUAGES = [ 'ENG' ]
+
+## The concept-level (MRREL RB) graph is stored under this name in the
+## closure table; source hierarchies under their SAB
+RB_GRAPH = 'RB'
+DEFAULT_CLOSURE_SABS = [ 'SNOMEDCT_US' ]
+
+## Cyclic RB neighborhoods can make the full closure very large; past
+## this many rows it stops at the last level that fit
+DEFAULT_CLOSURE_MAX_ROWS = 200 * 1000 * 1000
+
+#############################################
+##
+#############################################
+
+def initialize_arg_parser():
+    parser = argparse.ArgumentParser( description = """
+    Build an indexed SQLite copy of the UMLS tables used by the local engine
+    """ )
+    parser.add_argument( '-v' , '--verbose' ,
+                         help = "print more information" ,
+                         action = "store_true" )
+
+    parser.add_argument( '--rrf-dir' , required = True ,
+                         dest = 'rrfDir' ,
+                         help = 'Directory holding MRCONSO.RRF, MRREL.RRF and MRSTY.RRF' )
+
+    parser.add_argument( '--index-file' , required = True ,
+                         dest = 'indexFile' ,
+                         help = 'SQLite file to (re)build' )
+
+    parser.add_argument( '--languages' , default = ','.join( DEFAULT_LANGUAGES ) ,
+                         dest = 'languages' ,
+                         help = 'Comma-separated MRCONSO languages to keep (default:  ENG); empty keeps all' )
+
+    parser.add_argument( '--sabs' , default = '' ,
+                         dest = 'sabs' ,
+                         help = 'Comma-separated MRCONSO sources to keep; empty (the default) keeps all' )
+
+    parser.add_argument( '--closure' , default = False ,
+                         dest = 'closure' ,
+                         help = 'Also precompute the transitive closure of the RB hierarchy and the --closure-sabs is-a hierarchies' ,
+                         action = "store_true" )
+
+    parser.add_argument( '--closure-sabs' , default = ','.join( DEFAULT_CLOSURE_SABS ) ,
+                         dest = 'closureSabs' ,
+                         help = 'Comma-separated sources whose PAR/CHD hierarchy gets a closure (default:  SNOMEDCT_US)' )
+
+    parser.add_argument( '--closure-max-depth' , default = -1 ,
+                         dest = 'closureMaxDepth' ,
+                         help = 'Stop the closure this many levels below each concept (default -1 for no limit)' )
+
+    parser.add_argument( '--closure-max-rows' , default = DEFAULT_CLOSURE_MAX_ROWS ,
+                         dest = 'closureMaxRows' ,
+                         help = 'Stop the closure at the last level that keeps it under this many rows (default {}; -1 for no limit)'.format( DEFAULT_CLOSURE_MAX_ROWS ) )
+    ##
+    return parser
+
+#############################################
+##
+#############################################
+
+def split_list( value ):
+    return( [ item.strip() for item in value.split( ',' ) if item.strip() != '' ] )
+
+
+def batches( rows , batch_size ):
+    batch = []
+    for row in rows:
+        batch.append( row )
+        if( len( batch ) >= batch_size ):
+            yield( batch )
+            batch = []
+    if( len( batch ) > 0 ):
+        yield( batch )
+
+
+def conso_tuples( rrf_dir , languages = None , sabs = None ):
+    for cols in rrf_utils.read_rrf( rrf_utils.rrf_file( rrf_dir , 'MRCONSO' ) ):
+        row = rrf_utils.conso_row( cols )
+        if( languages and row.lat not in languages ):
+            continue
+        if( sabs and row.sab not in sabs ):
+            continue
+        yield( tuple( row ) )
+
+
+def sty_tuples( rrf_dir ):
+    for cols in rrf_utils.read_rrf( rrf_utils.rrf_file( rrf_dir , 'MRSTY' ) ):
+        yield( ( cols[ rrf_utils.mrsty_headers[ 'CUI' ] - 1 ] ,
+                 cols[ rrf_utils.mrsty_headers[ 'TUI' ] - 1 ] ,
+                 cols[ rrf_utils.mrsty_headers[ 'STY' ] - 1 ] ) )
+
+
+def rel_tuples( rrf_dir ):
+    ## ( kind , ... ) where kind 0 is a concept-level relation and
+    ## kind 1 an atom-level source hierarchy relation
+    headers = rrf_utils.mrrel_headers
+    for cols in rrf_utils.read_rrf( rrf_utils.rrf_file( rrf_dir , 'MRREL' ) ):
+        if( rrf_utils.is_concept_relation( cols ) ):
+            yield( ( 0 ,
+                     cols[ headers[ 'CUI2' ] - 1 ] ,
+                     cols[ headers[ 'CUI1' ] - 1 ] ,
+                     cols[ headers[ 'REL' ] - 1 ] ,
+                     cols[ headers[ 'SAB' ] - 1 ] ,
+                     cols[ headers[ 'SUPPRESS' ] - 1 ] ) )
+        elif( rrf_utils.is_source_hierarchy_relation( cols ) ):
+            yield( ( 1 ,
+                     cols[ headers[ 'AUI2' ] - 1 ] ,
+                     cols[ headers[ 'AUI1' ] - 1 ] ,
+                     cols[ headers[ 'REL' ] - 1 ] ,
+                     cols[ headers[ 'SAB' ] - 1 ] ,
+                     cols[ headers[ 'SUPPRESS' ] - 1 ] ) )
+
+
+def build_index( rrf_dir , index_file ,
+                 languages = DEFAULT_LANGUAGES , sabs = None ,
+                 closure = False , closure_sabs = DEFAULT_CLOSURE_SABS ,
+                 closure_max_depth = -1 ,
+                 closure_max_rows = DEFAULT_CLOSURE_MAX_ROWS ):
+    """
+    (Re)build `index_file` from the RRF tables in `rrf_dir`.  Tables
+    are bulk loaded with journaling off and indexed afterwards; the
+    database is written next to `index_file` and moved into place
+    only once complete.
+    """
+    tmp_file = '{}.building'.format( index_file )
+    if( os.path.exists( tmp_file ) ):
+        os.remove( tmp_file )
+    conn = sqlite3.connect( tmp_file )
+    conn.execute( 'PRAGMA journal_mode=OFF' )
+    conn.execute( 'PRAGMA synchronous=OFF' )
+    conn.execute( '''CREATE TABLE conso ( cui TEXT , lat TEXT , ts TEXT , stt TEXT ,
+                                          ispref TEXT , aui TEXT , sab TEXT , tty TEXT ,
+                                          code TEXT , str TEXT , suppress TEXT )''' )
+    conn.execute( 'CREATE TABLE sty ( cui TEXT , tui TEXT , sty TEXT )' )
+    conn.execute( 'CREATE TABLE rel ( cui2 TEXT , cui1 TEXT , rel TEXT , sab TEXT , suppress TEXT )' )
+    conn.execute( '''CREATE TABLE source_rel ( sab TEXT , code2 TEXT , code1 TEXT ,
+                                               rel TEXT , suppress TEXT )''' )
+    conn.execute( 'CREATE TEMP TABLE atom_rel ( aui2 TEXT , aui1 TEXT , rel TEXT , sab TEXT , suppress TEXT )' )
+    ##
+    log.info( 'Loading MRCONSO' )
+    for batch in batches( conso_tuples( rrf_dir , languages , sabs ) , INSERT_BATCH_SIZE ):
+        conn.executemany( 'INSERT INTO conso VALUES ( ? , ? , ? , ? , ? , ? , ? , ? , ? , ? , ? )' ,
+                          batch )
+    log.info( 'Loading MRSTY' )
+    for batch in batches( sty_tuples( rrf_dir ) , INSERT_BATCH_SIZE ):
+        conn.executemany( 'INSERT INTO sty VALUES ( ? , ? , ? )' , batch )
+    log.info( 'Loading MRREL' )
+    for batch in batches( rel_tuples( rrf_dir ) , INSERT_BATCH_SIZE ):
+        conn.executemany( 'INSERT INTO rel VALUES ( ? , ? , ? , ? , ? )' ,
+                          [ row[ 1: ] for row in batch if row[ 0 ] == 0 ] )
+        conn.executemany( 'INSERT INTO atom_rel VALUES ( ? , ? , ? , ? , ? )' ,
+                          [ row[ 1: ] for row in batch if row[ 0 ] == 1 ] )
+    conn.commit()
+    ##
+    log.info( 'Indexing' )
+    conn.execute( 'CREATE INDEX conso_cui ON conso ( cui )' )
+    conn.execute( 'CREATE INDEX conso_sab_code ON conso ( sab , code )' )
+    conn.execute( 'CREATE INDEX sty_cui ON sty ( cui )' )
+    ## MRREL lists every relation in both directions, so indexing on
+    ## CUI2 finds all of a concept's relations
+    conn.execute( 'CREATE INDEX rel_cui2_rel ON rel ( cui2 , rel )' )
+    ## Resolve atom-level hierarchy rows to source codes
+    conn.execute( 'CREATE INDEX conso_aui ON conso ( aui )' )
+    conn.execute( '''INSERT INTO source_rel
+                     SELECT DISTINCT atom_rel.sab , atom2.code , atom1.code ,
+                                     atom_rel.rel , atom_rel.suppress
+                     FROM atom_rel
+                     JOIN conso AS atom2 ON atom2.aui = atom_rel.aui2 AND atom2.sab = atom_rel.sab
+                     JOIN conso AS atom1 ON atom1.aui = atom_rel.aui1 AND atom1.sab = atom_rel.sab''' )
+    conn.execute( 'DROP INDEX conso_aui' )
+    conn.execute( 'DROP TABLE atom_rel' )
+    conn.execute( 'CREATE INDEX source_rel_sab_code2 ON source_rel ( sab , code2 )' )
+    conn.commit()
+    if( closure ):
+        build_closure( conn , closure_sabs , closure_max_depth , closure_max_rows )
+    conn.execute( 'ANALYZE' )
+    conn.close()
+    os.replace( tmp_file , index_file )
+    return( index_file )
+
+
+def build_closure( conn , sabs = DEFAULT_CLOSURE_SABS , max_depth = -1 ,
+                   max_rows = DEFAULT_CLOSURE_MAX_ROWS ):
+    """
+    Fill the `closure` table with every ( graph , ancestor , descendant ,
+    distance ) reachable over unsuppressed RB relations (graph 'RB')
+    and over each of `sabs`' PAR/CHD hierarchies (graph = SAB), keeping
+    the shortest distance.  Built breadth-first, one level per query,
+    stopping after `max_depth` levels or at the last level that keeps
+    it within `max_rows`.  Every direct edge is always kept, so a
+    closure cut short still has each node's children.
+    """
+    unsuppressed = ' , '.join( "'{}'".format( value ) for value in rrf_utils.UNSUPPRESSED )
+    conn.execute( 'CREATE TEMP TABLE edge ( graph TEXT , parent TEXT , child TEXT )' )
+    conn.execute( '''INSERT INTO edge
+                     SELECT DISTINCT ? , cui2 , cui1 FROM rel
+                     WHERE rel = 'RB' AND suppress IN ( {} ) AND cui2 != cui1'''.format( unsuppressed ) ,
+                  ( RB_GRAPH , ) )
+    ## A PAR row seen from code2 makes code1 one of its children (as
+    ## in get_family_tree)
+    for sab in sabs:
+        conn.execute( '''INSERT INTO edge
+                         SELECT DISTINCT sab , code2 , code1 FROM source_rel
+                         WHERE sab = ? AND rel = 'PAR' AND suppress IN ( {} ) AND code2 != code1'''.format( unsuppressed ) ,
+                      ( sab , ) )
+    conn.execute( 'CREATE INDEX temp.edge_parent ON edge ( graph , parent )' )
+    conn.execute( 'DROP TABLE IF EXISTS closure' )
+    conn.execute( 'CREATE TABLE closure ( graph TEXT , ancestor TEXT , descendant TEXT , distance INTEGER )' )
+    conn.execute( 'CREATE UNIQUE INDEX closure_ancestor ON closure ( graph , ancestor , descendant )' )
+    conn.execute( 'CREATE INDEX closure_distance ON closure ( distance )' )
+    rows = conn.execute( 'INSERT OR IGNORE INTO closure SELECT graph , parent , child , 1 FROM edge' ).rowcount
+    distance = 1
+    while( max_depth < 0 or distance < max_depth ):
+        log.info( 'Closing level {}'.format( distance + 1 ) )
+        ## The unique index drops pairs already reached at a shorter
+        ## distance
+        added = conn.execute( '''INSERT OR IGNORE INTO closure
+                                 SELECT closure.graph , closure.ancestor , edge.child , ?
+                                 FROM closure
+                                 JOIN edge ON edge.graph = closure.graph AND edge.parent = closure.descendant
+                                 WHERE closure.distance = ? AND edge.child != closure.ancestor''' ,
+                              ( distance + 1 , distance ) ).rowcount
+        if( added == 0 ):
+            break
+        if( max_rows >= 0 and rows + added > max_rows ):
+            log.warning( 'Closure would pass {} rows; stopping at depth {}'.format( max_rows ,
+                                                                                   distance ) )
+            conn.execute( 'DELETE FROM closure WHERE distance = ?' , ( distance + 1 , ) )
+            break
+        conn.commit()
+        rows += added
+        distance += 1
+    conn.execute( 'DROP INDEX closure_distance' )
+    conn.execute( 'DROP TABLE edge' )
+    conn.commit()
+
+#############################################
+##
+#############################################
+
+class SqliteStore:
+    """
+    rrf_utils store backed by a database from build_index
+    """
+
+    def __init__( self , index_file ):
+        if( not os.path.exists( index_file ) ):
+            raise IOError( 'Missing UMLS index:  {}'.format( index_file ) )
+        self.index_file = index_file
+        self._has_closure = None
+        self.connect()
+
+    def connect( self ):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect( 'file:{}?mode=ro'.format( self.index_file ) ,
+                                     uri = True ,
+                                     check_same_thread = False )
+
+    def reset_after_fork( self ):
+        ## A forked worker must not use its parent's connection
+        self.connect()
+
+    def close( self ):
+        with self._lock:
+            self.conn.close()
+
+    def has_closure( self ):
+        if( self._has_closure is None ):
+            self._has_closure = len( self._query( '''SELECT name FROM sqlite_master
+                                                     WHERE type = 'table' AND name = 'closure' ''' ) ) > 0
+        return( self._has_closure )
+
+    def _query( self , sql , params = () ):
+        with self._lock:
+            return( self.conn.execute( sql , params ).fetchall() )
+
+    def _query_many( self , sql , keys , params = () ):
+        ## `sql` holds a single `{}` where the IN list goes, after any
+        ## other `params`
+        rows = []
+        keys = list( keys )
+        for start in range( 0 , len( keys ) , QUERY_BATCH_SIZE ):
+            chunk = keys[ start:start + QUERY_BATCH_SIZE ]
+            rows += self._query( sql.format( ' , '.join( '?' * len( chunk ) ) ) ,
+                                 list( params ) + chunk )
+        return( rows )
+
+    ####################################################################
+
+    def conso_rows( self , cui ):
+        return( self.conso_rows_many( [ cui ] ).get( cui , [] ) )
+
+    def sty_rows( self , cui ):
+        return( self.sty_rows_many( [ cui ] ).get( cui , [] ) )
+
+    def rel_rows( self , cui ):
+        return( self.rel_rows_many( [ cui ] ).get( cui , [] ) )
+
+    def code_cuis( self , sab , code ):
+        return( [ row[ 0 ] for row in self._query( '''SELECT cui FROM conso
+                                                      WHERE sab = ? AND code = ?
+                                                      GROUP BY cui ORDER BY MIN( rowid )''' ,
+                                                   ( sab , code ) ) ] )
+
+    def source_rel_rows( self , sab , code ):
+        return( [ rrf_utils.SourceRelRow( *row )
+                  for row in self._query( '''SELECT code1 , rel , suppress FROM source_rel
+                                             WHERE sab = ? AND code2 = ?''' ,
+                                          ( sab , code ) ) ] )
+
+    ####################################################################
+    ## Batched versions:  dicts keyed by CUI (CUIs without rows are
+    ## left out)
+    ####################################################################
+
+    def conso_rows_many( self , cuis ):
+        found = {}
+        for row in self._query_many( '''SELECT * FROM conso WHERE cui IN ( {} )
+                                        ORDER BY rowid''' , set( cuis ) ):
+            found.setdefault( row[ 0 ] , [] ).append( rrf_utils.ConsoRow( *row ) )
+        return( found )
+
+    def sty_rows_many( self , cuis ):
+        found = {}
+        for cui , tui , sty in self._query_many( '''SELECT cui , tui , sty FROM sty WHERE cui IN ( {} )
+                                                    ORDER BY rowid''' , set( cuis ) ):
+            found.setdefault( cui , [] ).append( rrf_utils.StyRow( tui = tui , sty = sty ) )
+        return( found )
+
+    def code_cuis_many( self , sab , codes ):
+        found = {}
+        for code , cui in self._query_many( '''SELECT code , cui FROM conso
+                                               WHERE sab = ? AND code IN ( {} )
+                                               GROUP BY code , cui ORDER BY MIN( rowid )''' ,
+                                            set( codes ) , ( sab , ) ):
+            found.setdefault( code , [] ).append( cui )
+        return( found )
+
+    def rel_rows_many( self , cuis ):
+        found = {}
+        for cui2 , cui1 , rel , sab , suppress in self._query_many( '''SELECT cui2 , cui1 , rel , sab , suppress
+                                                                       FROM rel WHERE cui2 IN ( {} )
+                                                                       ORDER BY rowid''' , set( cuis ) ):
+            found.setdefault( cui2 , [] ).append( rrf_utils.RelRow( related_cui = cui1 ,
+                                                                    rel = rel ,
+                                                                    sab = sab ,
+                                                                    suppress = suppress ) )
+        return( found )
+
+    ####################################################################
+    ## Closure look-ups (only when built with `closure = True`)
+    ####################################################################
+
+    def closure( self , graph , ancestors , max_distance = -1 ):
+        """
+        { ancestor : { descendant : shortest distance } } for each of
+        `ancestors`, optionally no further than `max_distance` down
+        """
+        found = dict( ( ancestor , {} ) for ancestor in ancestors )
+        if( max_distance < 0 ):
+            max_distance = sys.maxsize
+        for ancestor , descendant , distance in self._query_many( '''SELECT ancestor , descendant , distance FROM closure
+                                                                     WHERE graph = ? AND distance <= ?
+                                                                     AND ancestor IN ( {} )''' ,
+                                                                  found , ( graph , max_distance ) ):
+            found[ ancestor ][ descendant ] = distance
+        return( found )
+
+    def closure_children( self , graph , ancestors ):
+        """
+        { ancestor : set of its direct children } in `graph`
+        """
+        found = dict( ( ancestor , set() ) for ancestor in ancestors )
+        for ancestor , descendant in self._query_many( '''SELECT ancestor , descendant FROM closure
+                                                          WHERE graph = ? AND distance = 1
+                                                          AND ancestor IN ( {} )''' ,
+                                                       found , ( graph , ) ):
+            found[ ancestor ].add( descendant )
+        return( found )
+
+#############################################
+##
+#############################################
+
+if __name__ == "__main__":
+    ##
+    log.basicConfig( level = log.INFO )
+    args = initialize_arg_parser().parse_args( sys.argv[ 1: ] )
+    if( args.verbose ):
+        log.getLogger().setLevel( log.DEBUG )
+    if( not os.path.exists( args.rrfDir ) ):
+        log.error( 'The RRF directory does not exist:  {}'.format( args.rrfDir ) )
+        exit( 1 )
+    build_index( args.rrfDir , args.indexFile ,
+                 languages = split_list( args.languages ) ,
+                 sabs = split_list( args.sabs ) ,
+                 closure = args.closure ,
+                 closure_sabs = split_list( args.closureSabs ) ,
+                 closure_max_depth = int( args.closureMaxDepth ) ,
+                 closure_max_rows = int( args.closureMaxRows ) )
+    print( 'Wrote {}'.format( args.indexFile ) )
@@ -2,39 +2,541 @@
 import logging as log
 
 from Authentication import *
-import requests
+import cache_utils
+import crosswalk as cw
+import http_utils
 import json
 import argparse
 
+import asyncio
+import os
+import re
+import threading
 import time
 
-## TODO - allow this to be passed via command line or environment variable
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
 UMLS_API_TOKEN = 'NOT-A-REAL-TOKEN-ASDF-QWERTY'
-UMLS_API_TOKEN = 'e4dcd9c2-cafd-4dee-a90d-760476c64fac'
-
-last_auth_time = None
-last_auth_client = None
-
-def init_authentication( api_key ):
-   global last_auth_time , last_auth_client
-   global auth_client
-   now_time = time.time()
-   ## Re-authorize every thirty minutes
-   if( last_auth_time is None or
-       ( now_time - last_auth_time ) > 30 * 60 ):
-      if( last_auth_time is None ):
-         log.debug( 'Authenticating with the UTS server' )
-      else:
-         log.debug( 'Re-authenticating with the UTS server' )
-      last_auth_time = time.time()
-      auth_client = Authentication( api_key )
-      last_auth_client = auth_client
+UMLS_API_TOKEN = os.environ.get( 'UMLS_API_TOKEN' ,
+                                 'e4dcd9c2-cafd-4dee-a90d-760476c64fac' )
+
+## How UTS requests are authenticated:
+##   'apikey' - send the API key as an `apiKey` query parameter on
+##              every request (no extra round trips)
+##   'cas'    - legacy CAS flow from Authentication.py (one service
+##              ticket POST per request)
+UMLS_AUTH_MODES = [ 'apikey' , 'cas' ]
+UMLS_AUTH_MODE = os.environ.get( 'UMLS_AUTH_MODE' , 'apikey' )
+
+UTS_URI = "https://uts-ws.nlm.nih.gov"
+RXNAV_URI = 'https://rxnav.nlm.nih.gov/REST/'
+
+## A long-lived CUI used to discover which concrete UMLS release
+## 'current' points to (the content URLs in the reply embed it)
+RELEASE_PROBE_CUI = 'C0000005'
+
+## Results requested per page from paged UTS endpoints and the number
+## of threads used to fetch pages 2..N once the page count is known
+UTS_PAGE_SIZE = 200
+PAGE_FETCH_WORKERS = 8
+page_executor = None
+page_executor_lock = threading.Lock()
+
+## Threads used by get_concept_bundle to fetch the concept record
+## while the caller pages through the atoms.  Kept apart from the page
+## executor, whose tasks never wait on one another.
+BUNDLE_FETCH_WORKERS = 20
+bundle_executor = None
+bundle_executor_lock = threading.Lock()
+
+## Everything spreadsheet_utils stores about a CUI
+ConceptBundle = namedtuple( 'ConceptBundle' , [ 'name' , 'tuis' , 'eng_atoms' ] )
+
+## Optional on-disk response cache (see set_response_cache)
+response_cache = None
+
+## In-process layers in front of the network (and the on-disk cache):
+## a bounded LRU of recent responses, and single-flight coalescing so
+## concurrent callers asking for the same request share one fetch
+memory_cache = cache_utils.LRUCache()
+in_flight = cache_utils.SingleFlight()
+
+## Look-ups known to come back empty (see set_negative_cache).  Kept
+## in memory only unless a cache file is configured.
+NO_CUI = 'no-cui'
+CUI_NOT_FOUND = 'cui-not-found'
+NO_RB_CHILDREN = 'no-rb-children'
+negative_cache = cache_utils.NegativeCache()
+release_namespaces = {}
+release_namespaces_lock = threading.Lock()
+
+## Optional code <-> CUI crosswalk (see set_crosswalk).  get_cui answers
+## from it when it can and adds whatever it has to search for.
+crosswalk = None
+crosswalk_file = None
+
+## UTS ticket-granting tickets are good for eight hours.  We refresh
+## ours a half hour before that so no request ever races the expiry.
+TGT_LIFETIME = 8 * 60 * 60
+TGT_REFRESH_MARGIN = 30 * 60
+
+
+class UmlsRequestError( Exception ):
+   """
+   A UTS/RxNav request still had no usable answer after every retry
+   """
+   pass
+
+
+class CredentialManager:
+   """
+   Shared, thread-safe holder for a UTS ticket-granting ticket (TGT).
+
+   The TGT is fetched once and re-used until it is close to expiring,
+   so callers only pay for the per-request service ticket (ST).  The
+   `gettgt` / `getst` methods mirror `Authentication` so a manager can
+   be passed anywhere an `auth_client` is expected.  Coroutines should
+   use the `*_async` variants, which run the blocking calls in the
+   event loop's executor and share the same lock.
+
+   In 'apikey' mode no tickets are requested at all and
+   `query_params` simply returns the key.
+   """
+
+   def __init__( self , api_key ,
+                 auth_mode = None ,
+                 tgt_lifetime = TGT_LIFETIME ,
+                 refresh_margin = TGT_REFRESH_MARGIN ):
+      ## Same default as init_authentication
+      if( auth_mode is None ):
+         auth_mode = UMLS_AUTH_MODE
+      if( auth_mode not in UMLS_AUTH_MODES ):
+         raise ValueError( 'Unrecognized UMLS auth mode:  {}'.format( auth_mode ) )
+      self.api_key = api_key
+      self.auth_mode = auth_mode
+      self.auth_client = Authentication( api_key )
+      self.tgt_lifetime = tgt_lifetime
+      self.refresh_margin = refresh_margin
+      self.tgt = None
+      self.tgt_time = None
+      self._lock = threading.Lock()
+
+   def tgt_is_stale( self ):
+      if( self.tgt is None ):
+         return( True )
+      age = time.time() - self.tgt_time
+      return( age > self.tgt_lifetime - self.refresh_margin )
+
+   def refresh( self , stale_tgt = None ):
+      with self._lock:
+         ## Another thread may have already replaced the TGT we were
+         ## told is stale while we waited on the lock
+         if( self.tgt is not None and
+             self.tgt != stale_tgt and
+             not self.tgt_is_stale() ):
+            return( self.tgt )
+         if( self.tgt is None ):
+            log.debug( 'Authenticating with the UTS server' )
+         else:
+            log.debug( 'Re-authenticating with the UTS server' )
+         self.tgt = self.auth_client.gettgt()
+         self.tgt_time = time.time()
+         return( self.tgt )
+
+   def gettgt( self ):
+      tgt = self.tgt
+      if( self.tgt_is_stale() ):
+         tgt = self.refresh( stale_tgt = tgt )
+      return( tgt )
+
+   def getst( self , tgt = None ):
+      if( tgt is None ):
+         tgt = self.gettgt()
+      st = self.auth_client.getst( tgt )
+      if( not st.startswith( 'ST-' ) ):
+         ## The TGT was revoked or expired early on the server side
+         log.warning( 'Service ticket request rejected.  Refreshing the TGT.' )
+         st = self.auth_client.getst( self.refresh( stale_tgt = tgt ) )
+      return( st )
+
+   def query_params( self ):
+      """
+      Authentication parameters to add to a single UTS request
+      """
+      if( self.auth_mode == 'apikey' ):
+         return( { 'apiKey' : self.api_key } )
+      return( { 'ticket' : self.getst() } )
+
+   async def gettgt_async( self ):
+      loop = asyncio.get_running_loop()
+      return( await loop.run_in_executor( None , self.gettgt ) )
+
+   async def getst_async( self , tgt = None ):
+      loop = asyncio.get_running_loop()
+      return( await loop.run_in_executor( None , self.getst , tgt ) )
+
+
+credential_managers = {}
+credential_managers_lock = threading.Lock()
+
+def init_authentication( api_key , auth_mode = None ):
+   ## One manager per API key and auth mode, shared by every caller
+   if( auth_mode is None ):
+      auth_mode = UMLS_AUTH_MODE
+   with credential_managers_lock:
+      if( ( api_key , auth_mode ) not in credential_managers ):
+         log.debug( 'Using \'{}\' authentication for UTS requests'.format( auth_mode ) )
+         credential_managers[ ( api_key , auth_mode ) ] = CredentialManager( api_key ,
+                                                                           auth_mode = auth_mode )
+      return( credential_managers[ ( api_key , auth_mode ) ] )
+
+
+########################################################################
+##
+########################################################################
+
+def set_response_cache( cache_file ,
+                        ttl = cache_utils.DEFAULT_TTL ,
+                        max_bytes = cache_utils.DEFAULT_MAX_BYTES ):
+   global response_cache
+   memory_cache.clear()
+   if( response_cache is not None ):
+      response_cache.close()
+   if( cache_file is None ):
+      response_cache = None
+   else:
+      log.debug( 'Caching UTS/RxNav responses in {}'.format( cache_file ) )
+      response_cache = cache_utils.ResponseCache( cache_file ,
+                                                  ttl = ttl ,
+                                                  max_bytes = max_bytes )
+   return( response_cache )
+
+
+def set_negative_cache( cache_file ,
+                        ttl = cache_utils.DEFAULT_NEGATIVE_TTL ):
+   global negative_cache
+   negative_cache.close()
+   negative_cache = cache_utils.NegativeCache( cache_file , ttl = ttl )
+   return( negative_cache )
+
+
+def set_crosswalk( filename ):
+   """
+   Load the crosswalk in `filename` (or start an empty one if it does
+   not exist yet) for get_cui and get_cuis.  save_crosswalk writes it
+   back, along with any codes searched for in the meantime.
+   """
+   global crosswalk , crosswalk_file
+   crosswalk_file = filename
+   if( filename is None ):
+      crosswalk = None
+   elif( os.path.exists( filename ) ):
+      crosswalk = cw.load_crosswalk( filename )
    else:
-      auth_client = last_auth_client
-   ###################################
-   #get TGT for our session
-   ###################################
-   return auth_client
+      crosswalk = cw.Crosswalk()
+   return( crosswalk )
+
+
+def save_crosswalk():
+   if( crosswalk is not None and crosswalk_file is not None ):
+      crosswalk.save( crosswalk_file )
+
+
+def reset_after_fork( workers = 1 ):
+   """
+   Give a freshly forked worker process its own HTTP sessions, thread
+   pools, credentials and cache connections.  The parent's are left
+   alone (SQLite connections and sockets must not be shared across
+   processes) and `workers` splits the request rate between the pool.
+   """
+   global page_executor , page_executor_lock , bundle_executor , bundle_executor_lock
+   global credential_managers , credential_managers_lock , response_cache , negative_cache
+   http_utils.reset_after_fork( workers )
+   page_executor = None
+   page_executor_lock = threading.Lock()
+   bundle_executor = None
+   bundle_executor_lock = threading.Lock()
+   credential_managers = {}
+   credential_managers_lock = threading.Lock()
+   if( response_cache is not None ):
+      response_cache = cache_utils.ResponseCache( response_cache.filename ,
+                                                  ttl = response_cache.ttl ,
+                                                  max_bytes = response_cache.max_bytes )
+   if( negative_cache.filename is not None ):
+      negative_cache = cache_utils.NegativeCache( negative_cache.filename ,
+                                                  ttl = negative_cache.ttl )
+
+
+def negative_namespace( auth_client ):
+   ## Persisted negatives must be tied to a release; in-memory ones
+   ## only ever see the current release anyway
+   if( negative_cache.conn is None ):
+      return( 'UMLS' )
+   if( auth_client is None ):
+      auth_client = init_authentication( UMLS_API_TOKEN )
+   return( get_release_namespace( 'UMLS' , auth_client ) )
+
+
+def request_stats():
+   """
+   Counters describing how requests were served during this run
+   """
+   stats = { 'memory cache hits' : memory_cache.hits ,
+             'memory cache misses' : memory_cache.misses ,
+             'coalesced requests' : in_flight.shared }
+   for kind in sorted( set( negative_cache.hits ) | set( negative_cache.stores ) ):
+      stats[ 'negative hits ({})'.format( kind ) ] = negative_cache.hits.get( kind , 0 )
+      stats[ 'negative stores ({})'.format( kind ) ] = negative_cache.stores.get( kind , 0 )
+   return( stats )
+
+
+def resolve_umls_release( auth_client ):
+   if( 'UMLS_RELEASE' in os.environ ):
+      return( os.environ[ 'UMLS_RELEASE' ] )
+   query = auth_client.query_params()
+   r = http_utils.get( UTS_URI + '/rest/content/current/CUI/' + RELEASE_PROBE_CUI ,
+                       params = query )
+   r.encoding = 'utf-8'
+   try:
+      atoms_url = json.loads( r.text )[ 'result' ][ 'atoms' ]
+      return( re.search( '/content/([^/]+)/' , atoms_url ).group( 1 ) )
+   except ( ValueError , KeyError , TypeError , AttributeError ) as e:
+      log.warning( 'Unable to resolve the current UMLS release:  {}'.format( e ) )
+      return( 'current' )
+
+
+def resolve_rxnorm_release():
+   if( 'RXNORM_RELEASE' in os.environ ):
+      return( os.environ[ 'RXNORM_RELEASE' ] )
+   r = http_utils.get( RXNAV_URI + 'version.json' )
+   r.encoding = 'utf-8'
+   try:
+      return( json.loads( r.text )[ 'version' ] )
+   except ( ValueError , KeyError , TypeError ) as e:
+      log.warning( 'Unable to resolve the current RxNorm release:  {}'.format( e ) )
+      return( 'current' )
+
+
+def get_release_namespace( source , auth_client = None ):
+   """
+   Cache namespace for a terminology, with 'current' resolved to the
+   concrete release (e.g., 'UMLS-2023AB').  Resolved once per run.
+   """
+   with release_namespaces_lock:
+      if( source not in release_namespaces ):
+         if( source == 'UMLS' ):
+            release = resolve_umls_release( auth_client )
+         else:
+            release = resolve_rxnorm_release()
+         release_namespaces[ source ] = '{}-{}'.format( source , release )
+         log.debug( 'Cache namespace for {}:  {}'.format( source ,
+                                                          release_namespaces[ source ] ) )
+      return( release_namespaces[ source ] )
+
+
+def cached_get( url , params , namespace , auth_client = None ):
+   key = cache_utils.cache_key( url , params )
+   body = memory_cache.get( ( namespace , key ) )
+   if( body is not None ):
+      return( body )
+   return( in_flight.do( ( namespace , key ) ,
+                         lambda: fetch_response( url , params , namespace , key ,
+                                                 auth_client ) ) )
+
+
+def fetch_response( url , params , namespace , key , auth_client = None ):
+   if( response_cache is not None ):
+      body = response_cache.get( namespace , key )
+      if( body is not None ):
+         memory_cache.put( ( namespace , key ) , body )
+         return( body )
+   query = {}
+   if( auth_client is not None ):
+      query.update( auth_client.query_params() )
+   if( params is not None ):
+      query.update( params )
+   r = http_utils.get( url , params = query )
+   r.encoding = 'utf-8'
+   ## http_utils has already retried these as often as the host's
+   ## policy allows, so don't retry them all over again on top
+   if( r.status_code in http_utils.get_retry_policy( url ).retry_statuses ):
+      raise UmlsRequestError( 'HTTP {} for {} after {} retries'.format( r.status_code , url ,
+                                                                       http_utils.get_retry_policy( url ).max_retries ) )
+   ## UTS answers an unknown identifier with a 404.  Anything else
+   ## (bad credentials, a malformed request) says nothing about the
+   ## identifier and must not pass for an empty answer.
+   if( url.startswith( UTS_URI ) and
+       r.status_code not in ( 200 , 404 ) ):
+      raise UmlsRequestError( 'HTTP {} for {}:  {}'.format( r.status_code , url , r.text[ :200 ] ) )
+   ## Throttling pages sometimes come back as 200s with an HTML body
+   ## (or JSON without a result).  Never cache those or a retry would
+   ## be served the same garbage.
+   if( r.status_code == 200 and
+       is_complete_body( url , r.text ) ):
+      memory_cache.put( ( namespace , key ) , r.text )
+      if( response_cache is not None ):
+         response_cache.put( namespace , key , r.text )
+   return( r.text )
+
+
+def is_complete_body( url , text ):
+   ## The same test fetch_json retries on
+   try:
+      items = json.loads( text )
+   except ValueError:
+      return( False )
+   if( url.startswith( UTS_URI ) ):
+      return( has_result_or_error( items ) )
+   return( True )
+
+
+def uts_get( auth_client , content_endpoint , params = None ):
+   """
+   Issue a single authenticated GET against the UTS REST API and
+   return the response body as text.
+   """
+   if( auth_client is None ):
+      auth_client = init_authentication( UMLS_API_TOKEN )
+   namespace = None
+   if( response_cache is not None ):
+      namespace = get_release_namespace( 'UMLS' , auth_client )
+   return( cached_get( UTS_URI + content_endpoint , params ,
+                       namespace , auth_client = auth_client ) )
+
+
+def rxnav_get( content_endpoint , params = None ):
+   namespace = None
+   if( response_cache is not None ):
+      namespace = get_release_namespace( 'RXNORM' )
+   return( cached_get( RXNAV_URI + content_endpoint , params , namespace ) )
+
+
+def fetch_json( fetch , url , is_complete = None ):
+   """
+   Call `fetch` (which returns a response body) until the body decodes
+   as JSON and, if given, `is_complete` accepts it.  Retries back off
+   according to the host's http_utils retry policy.  Raises
+   UmlsRequestError once the retries are used up rather than quietly
+   dropping the response.  Only bad bodies are retried here; failed
+   requests are retried by http_utils alone.
+   """
+   policy = http_utils.get_retry_policy( url )
+   attempt = 0
+   while( True ):
+      response_text = fetch()
+      try:
+         items = json.loads( response_text )
+      except ValueError as e:
+         problem = 'undecodable response ({})'.format( e )
+      else:
+         if( is_complete is None or is_complete( items ) ):
+            return( items )
+         problem = 'incomplete response'
+      if( attempt >= policy.max_retries ):
+         raise UmlsRequestError( '{} for {} after {} retries'.format( problem , url ,
+                                                                      attempt ) )
+      delay = policy.backoff( attempt )
+      log.warning( '{} for {} ( retry {} of {} in {:.1f}s )'.format( problem , url ,
+                                                                    attempt + 1 ,
+                                                                    policy.max_retries ,
+                                                                    delay ) )
+      time.sleep( delay )
+      attempt += 1
+
+
+def has_result_or_error( items ):
+   return( isinstance( items , dict ) and
+           ( 'result' in items or 'error' in items ) )
+
+
+def uts_get_json( auth_client , content_endpoint , params = None ):
+   return( fetch_json( lambda: uts_get( auth_client , content_endpoint , params ) ,
+                       UTS_URI + content_endpoint ,
+                       is_complete = has_result_or_error ) )
+
+
+def rxnav_get_json( content_endpoint , params = None ):
+   return( fetch_json( lambda: rxnav_get( content_endpoint , params ) ,
+                       RXNAV_URI + content_endpoint ) )
+
+
+def get_page_executor():
+   global page_executor
+   with page_executor_lock:
+      if( page_executor is None ):
+         page_executor = ThreadPoolExecutor( max_workers = PAGE_FETCH_WORKERS )
+      return( page_executor )
+
+
+def get_bundle_executor():
+   global bundle_executor
+   with bundle_executor_lock:
+      if( bundle_executor is None ):
+         bundle_executor = ThreadPoolExecutor( max_workers = BUNDLE_FETCH_WORKERS )
+      return( bundle_executor )
+
+
+def uts_get_pages( auth_client , content_endpoint , params = None ):
+   """
+   Fetch every page of a paged UTS result set and return the decoded
+   pages in page order.  The first page tells us the pageCount; pages
+   2..N are then requested concurrently.
+   """
+   if( auth_client is None ):
+      auth_client = init_authentication( UMLS_API_TOKEN )
+   def fetch_page( page_number ):
+      query = { 'pageNumber' : page_number ,
+                'pageSize' : UTS_PAGE_SIZE }
+      if( params is not None ):
+         query.update( params )
+      return( uts_get_json( auth_client , content_endpoint , query ) )
+   first_page = fetch_page( 1 )
+   if( first_page is None ):
+      return( [] )
+   pages = [ first_page ]
+   last_page = first_page.get( 'pageCount' , 1 )
+   if( last_page > 1 ):
+      log.debug( 'Fetching pages 2 through {} of {}'.format( last_page , content_endpoint ) )
+      pages += list( get_page_executor().map( fetch_page ,
+                                              range( 2 , last_page + 1 ) ) )
+   return( pages )
+
+
+def not_found( items ):
+   """
+   True if a UTS body reports that what was asked for does not exist.
+   Any other reported error raises UmlsRequestError, so a failed
+   request is never taken (or negatively cached) as an empty answer.
+   """
+   if( not isinstance( items , dict ) or
+       'error' not in items ):
+      return( False )
+   if( str( items.get( 'status' , 404 ) ) != '404' ):
+      raise UmlsRequestError( 'UTS reported an error:  {}'.format( items[ 'error' ] ) )
+   log.debug( 'Nothing found:  {}'.format( items[ 'error' ] ) )
+   return( True )
+
+
+def page_results( pages ):
+   ## Yield the 'result' payload of each page, in order.  A 'not found'
+   ## first page is an empty result set; an error on a later page (or
+   ## any other error) raises UmlsRequestError rather than quietly
+   ## truncating the results.
+   for page_number , items in enumerate( pages , 1 ):
+      if( items is None ):
+         continue
+      if( 'error' in items ):
+         if( page_number > 1 ):
+            raise UmlsRequestError( 'Page {} of a result set failed:  {}'.format( page_number ,
+                                                                                  items[ 'error' ] ) )
+         not_found( items )
+         return
+      if( 'result' not in items ):
+         log.warning( 'Page {} lacks a result'.format( items.get( 'pageNumber' ) ) )
+         continue
+      yield( items[ 'result' ] )
 
 ########################################################################
 ##
@@ -48,20 +550,14 @@ def search_umls( auth_client , version , identifier , source ,
                                                                        input_type ,
                                                                        return_type ) )
    auth_client = init_authentication( UMLS_API_TOKEN )
-   tgt = auth_client.gettgt()
-   uri = "https://uts-ws.nlm.nih.gov"
    content_endpoint = "/rest/search/current?string="+str(identifier) + \
                                                     "&inputType="+str(input_type) + \
                                                     "&returnIdType="+str(return_type) + \
                                                     "&searchType=exact&sabs="+str(source)
    ##log( content_endpoint )
-   ##ticket is the only parameter needed for this call - paging does not come into play because we're only asking for one Json object
-   query = {'ticket':auth_client.getst(tgt)}
-   r = requests.get(uri+content_endpoint,params=query)
-   r.encoding = 'utf-8'
-   items  = json.loads(r.text)
-   if( 'error' in items ):
-      log.error( 'Query failed due to reported error:  {}'.format( items[ 'error' ] ) )
+   ##authentication is the only parameter needed for this call - paging does not come into play because we're only asking for one Json object
+   items = uts_get_json( auth_client , content_endpoint )
+   if( not_found( items ) ):
       return None
    if( 'result' not in items ):
       return None
@@ -73,22 +569,65 @@ def search_umls( auth_client , version , identifier , source ,
    ############################
    classType = jsonData["classType"]
    if( len( jsonData["results"] ) > 1 ):
-       log.debug( 'Multiple matches.  Only using the last for {}'.format( source ) )
+       log.debug( 'Multiple matches.  Only using the highest for {}'.format( source ) )
    name = None
    cui = None
+   ## Of several matches, keep the highest, as the crosswalk and the
+   ## local engine do, so a code maps the same way whichever answers it
    for inner_results in jsonData["results"]:
-      name = inner_results[ "name" ]
-      cui = inner_results["ui"]
+      if( cui is None or inner_results["ui"] > cui ):
+         name = inner_results[ "name" ]
+         cui = inner_results["ui"]
       ##
    if( cui == None ):
-      print (json.dumps(items, indent = 4))
+      log.debug( 'No {} found for {}:\n{}'.format( return_type , identifier ,
+                                                   json.dumps( items , indent = 4 ) ) )
    return( cui )
 
 def get_cui( auth_client , version , identifier , source ):
    log.debug( 'call to get_cui( ... , {} , ... )'.format( identifier ) )
-   return( search_umls( auth_client , version , identifier , source ,
-                        input_type = 'sourceUi' ,
-                        return_type = 'concept' ) )
+   if( crosswalk is not None and crosswalk.has_code( source , identifier ) ):
+      return( crosswalk.get_cui( source , identifier ) )
+   namespace = negative_namespace( auth_client )
+   source_code = '{}|{}'.format( source , identifier )
+   if( negative_cache.contains( namespace , NO_CUI , source_code ) ):
+      return( None )
+   cui = search_umls( auth_client , version , identifier , source ,
+                      input_type = 'sourceUi' ,
+                      return_type = 'concept' )
+   if( cui is None ):
+      negative_cache.add( namespace , NO_CUI , source_code )
+   else:
+      remember_cui( identifier , source , cui )
+   return( cui )
+
+def remember_cui( identifier , source , cui ):
+   ## Adds a code's CUI to the crosswalk, if there is one (also for
+   ## answers found by worker processes; see parallel_utils)
+   if( crosswalk is not None and cui is not None ):
+      crosswalk.add( source , identifier , cui )
+
+def get_cuis( auth_client , version , identifiers , source ):
+   """
+   get_cui for many codes at once, as a dict.  Codes the crosswalk
+   knows are answered directly; the rest are searched for concurrently.
+   """
+   identifiers = list( identifiers )
+   found = {}
+   missing = []
+   for identifier in identifiers:
+      if( crosswalk is not None and crosswalk.has_code( source , identifier ) ):
+         found[ identifier ] = crosswalk.get_cui( source , identifier )
+      elif( identifier not in missing ):
+         missing.append( identifier )
+   if( len( missing ) > 0 ):
+      if( auth_client is None ):
+         auth_client = init_authentication( UMLS_API_TOKEN )
+      searches = [ get_bundle_executor().submit( get_cui , auth_client , version , identifier , source )
+                   for identifier in missing ]
+      for identifier , search in zip( missing , searches ):
+         found[ identifier ] = search.result()
+   return( found )
 
 def get_concept_id( auth_client , version , identifier , source ):
    log.debug( 'call to get_concept_id( ... , {} , ... )'.format( identifier ) )
@@ -98,104 +637,41 @@ def get_concept_id( auth_client , version , identifier , source ):
 
 def get_atoms( auth_client , version , identifier , source ):
    log.debug( 'call to get_atoms( ... , {} , ... )'.format( identifier ) )
-   current_page = 1
-   last_page = 1
-   tgt = auth_client.gettgt()
-   uri = "https://uts-ws.nlm.nih.gov"
    content_endpoint = "/rest/content/current/CUI/"+str(identifier) + "/atoms?" + \
                       "sabs=" + str( source ) + \
                       "&ttys=PT,HT"
    ##log( 'Content Endpoint\n\n{}\n'.format( content_endpoint ) )
    codes_list = []
    ############################
-   while( current_page <= last_page ):
-      ##content_endpoint = "/rest/search/current?string=" + str(identifier) + "inputType=sourceUi&pageNumber=1"
-      ##ticket is the only parameter needed for this call - paging does not come into play because we're only asking for one Json object
-      query = { 'ticket' : auth_client.getst(tgt) , 'pageNumber' : current_page }
-      r = requests.get(uri+content_endpoint,params=query)
-      r.encoding = 'utf-8'
-      #log( 'Text\n\n{}\n'.format( r.text ) )
-      try:
-         items  = json.loads(r.text)
-      except ValueError as e :
-         current_page +=1
-         continue
-      if( 'error' in items ):
-         log.error( 'Query failed due to reported error:  {}'.format( items[ 'error' ] ) )
-         break
-      if( 'result' not in items ):
-         continue
-      jsonData = items["result"]
+   for jsonData in page_results( uts_get_pages( auth_client , content_endpoint ) ):
       ##uncomment the print statment if you want the raw json output, or you can just look at the documentation :=)
       #https://documentation.uts.nlm.nih.gov/rest/concept/index.html#sample-output
       #https://documentation.uts.nlm.nih.gov/rest/source-asserted-identifiers/index.html#sample-output
-      ##log( 'JSON Dump\n\n{}\n'.format( json.dumps(items, indent = 4) ) )
-      if( current_page == 1 ):
-         last_page = items[ "pageCount" ]
-         ##log( 'Page {} of {}'.format( current_page , last_page ) )
-      ##
       ##log( 'Inner Results\n\n' )
       for inner_results in jsonData:
          source_code_url = inner_results[ 'code' ].split( '/' )
          source_code = source_code_url[ len( source_code_url ) - 1 ]
          codes_list.append( source_code )
          ##log( source_code )
-      current_page +=1
    return( codes_list )
 
 def get_family_tree( auth_client , version , identifier ,
                      relation_type , root_source = 'SNOMEDCT_US' ):
    log.debug( 'call to get_family_tree( ... , {} , ... )'.format( identifier ) )
-   current_page = 1
-   last_page = 1
-   auth_client = init_authentication( UMLS_API_TOKEN )
-   tgt = auth_client.gettgt()
-   uri = "https://uts-ws.nlm.nih.gov"
    content_endpoint = "/rest/content/current/source/" + str( root_source ) + "/"+str(identifier) + "/" + str( relation_type )
    ##print( '{}'.format( content_endpoint ) )
    atoms_set = set()
    ############################
-   while( current_page <= last_page ):
-      ##content_endpoint = "/rest/search/current?string=" + str(identifier) + "inputType=sourceUi&pageNumber=1"
-      ##ticket is the only parameter needed for this call - paging does not come into play because we're only asking for one Json object
-      query = { 'ticket' : auth_client.getst(tgt) , 'pageNumber' : current_page }
-      r = requests.get(uri+content_endpoint,params=query)
-      r.encoding = 'utf-8'
-      ##print( r.text )
-      try:
-         items  = json.loads(r.text)
-      except ValueError as e :
-         current_page +=1
-         continue
-      if( 'error' in items ):
-         log.error( 'Query failed due to reported error:  {}'.format( items[ 'error' ] ) )
-         break
-      if( 'result' not in items ):
-         continue
-      jsonData = items["result"]
+   for jsonData in page_results( uts_get_pages( auth_client , content_endpoint ) ):
       if( jsonData is None ):
          return( atoms_set )
       ##uncomment the print statment if you want the raw json output, or you can just look at the documentation :=)
       #https://documentation.uts.nlm.nih.gov/rest/concept/index.html#sample-output
       #https://documentation.uts.nlm.nih.gov/rest/source-asserted-identifiers/index.html#sample-output
-      ##log( json.dumps(items, indent = 4) )
-      if( current_page == 1 ):
-         last_page = items[ "pageCount" ]
-         ##log( 'Page {} of {}'.format( current_page , last_page ) )
-      ##
       for inner_results in jsonData:
          atomic_ui = inner_results[ "ui" ]
-         ##log( '\t{}'.format( relation_label ) )
-         ##if( target_relation_label is not None and
-         ##    relation_label != target_relation_label ):
-         ##   continue
-         ##name = inner_results[ "relatedIdName" ]
-         ##cui_url = inner_results[ "relatedId" ]
-         ##cui = cui_url.split( '/' )[ -1 ]
-         ##cui_dict[ cui ] = name
          atoms_set.add( atomic_ui )
          ##log( '\t{}'.format( atomic_ui ) )
-      current_page +=1
    return( atoms_set )
 
 def get_parents( auth_client , version , identifier , source ,
@@ -222,110 +698,106 @@ def get_parents( auth_client , version , identifier , source ,
 
 def get_cuis_atom( auth_client , version , identifier , atom_type ):
    log.debug( 'call to get_cuis_atom( ... , {} , {} )'.format( identifier , atom_type ) )
-   current_page = 1
-   last_page = 1
-   auth_client = init_authentication( UMLS_API_TOKEN )
-   tgt = auth_client.gettgt()
-   uri = "https://uts-ws.nlm.nih.gov"
    atom_string = ''
    if( atom_type != '' ):
        atom_string = "/atoms{}".format( str( atom_type ) )
    content_endpoint = "/rest/content/current/CUI/"+str(identifier) + atom_string
    ##print( '{}'.format( content_endpoint ) )
-   if( atom_type == '/preferred' ):
-      all_atoms = None
-   else:
-      all_atoms = set()
    ############################
-   while( current_page <= last_page ):
-      ##content_endpoint = "/rest/search/current?string=" + str(identifier) + "inputType=sourceUi&pageNumber=1"
-      ##ticket is the only parameter needed for this call - paging does not come into play because we're only asking for one Json object
-      query = { 'ticket' : auth_client.getst(tgt) , 'pageNumber' : current_page }
-      r = requests.get(uri+content_endpoint,params=query)
-      r.encoding = 'utf-8'
-      ##log( r.text )
-      try:
-         items  = json.loads(r.text)
-      except ValueError as e :
-         current_page +=1
-         continue
-      if( 'error' in items ):
-         log.error( 'Query failed due to reported error:  {}'.format( items[ 'error' ] ) )
-         break
-      if( 'result' not in items ):
-         continue
-      jsonData = items["result"]
+   ## The preferred atom and the bare concept (for the TUI) are
+   ## single objects rather than paged lists
+   if( atom_type == '/preferred' or
+       atom_type == '' ):
+      items = uts_get_json( auth_client , content_endpoint )
+      if( items is None or
+          not_found( items ) or
+          'result' not in items ):
+         return( None )
+      jsonData = items[ "result" ]
       ##uncomment the print statment if you want the raw json output, or you can just look at the documentation :=)
       #https://documentation.uts.nlm.nih.gov/rest/concept/index.html#sample-output
       #https://documentation.uts.nlm.nih.gov/rest/source-asserted-identifiers/index.html#sample-output
       ##log( json.dumps(items, indent = 4) )
-      if( current_page == 1 ):
-         last_page = items[ "pageCount" ]
-      if( last_page > 1 ):
-         log.debug( 'Page {} of {}'.format( current_page , last_page ) )
-      ##
       if( atom_type == '/preferred' ):
          name = jsonData[ "name" ]
          ##log( '{}\t{}'.format( str( identifier ) , name ) )
          return( name )
-      elif( atom_type == '' ):
-         semantic_types = jsonData[ 'semanticTypes' ]
-         for sem_type in semantic_types:
-            tui = sem_type[ 'uri' ].split( '/' )[ -1 ]
-            return( tui )
-      else:
-         for inner_results in jsonData:
-            name = inner_results[ "name" ]
-            all_atoms.add( name )
-            ##log( '{}\t{}'.format( identifier , name ) )
-      current_page +=1
+      semantic_types = jsonData[ 'semanticTypes' ]
+      for sem_type in semantic_types:
+         tui = sem_type[ 'uri' ].split( '/' )[ -1 ]
+         return( tui )
+      return( None )
+   all_atoms = set()
+   for jsonData in page_results( uts_get_pages( auth_client , content_endpoint ) ):
+      for inner_results in jsonData:
+         name = inner_results[ "name" ]
+         all_atoms.add( name )
+         ##log( '{}\t{}'.format( identifier , name ) )
    return( all_atoms )
 
 def get_cuis_preferred_atom( auth_client , version , identifier ):
    log.debug( 'call to get_cui_preferred_atom( . , {} , {} )'.format( version , identifier ) )
-   return( get_cuis_atom( auth_client , version , identifier , atom_type = '/preferred' ) )
+   namespace = negative_namespace( auth_client )
+   if( negative_cache.contains( namespace , CUI_NOT_FOUND , identifier ) ):
+      return( None )
+   preferred_term = get_cuis_atom( auth_client , version , identifier , atom_type = '/preferred' )
+   if( preferred_term is None ):
+      negative_cache.add( namespace , CUI_NOT_FOUND , identifier )
+   return( preferred_term )
 
 def get_cuis_eng_atom( auth_client , version , identifier ):
    log.debug( 'call to get_cui_eng_atom( . , {} , {} )'.format( version , identifier ) )
    return( get_cuis_atom( auth_client , version , identifier , atom_type = '?language=ENG' ) )
 
+def get_cuis_concept( auth_client , version , identifier ):
+   ## The bare concept record:  name, semantic types, etc.  This is
+   ## the same request (and cache entry) as get_cuis_atom( ... , '' )
+   content_endpoint = "/rest/content/current/CUI/" + str( identifier )
+   items = uts_get_json( auth_client , content_endpoint )
+   if( not_found( items ) ):
+      return( None )
+   return( items.get( 'result' ) )
+
+def get_concept_bundle( auth_client , version , identifier ):
+   """
+   Name, all TUIs and ENG atoms for a CUI as one ConceptBundle, or
+   None if UTS does not know the CUI.  The name and TUIs come from a
+   single concept request; the (paged) ENG atoms are fetched at the
+   same time.
+   """
+   log.debug( 'call to get_concept_bundle( . , {} , {} )'.format( version , identifier ) )
+   namespace = negative_namespace( auth_client )
+   if( negative_cache.contains( namespace , CUI_NOT_FOUND , identifier ) ):
+      return( None )
+   if( auth_client is None ):
+      auth_client = init_authentication( UMLS_API_TOKEN )
+   concept_future = get_bundle_executor().submit( get_cuis_concept ,
+                                                  auth_client , version , identifier )
+   try:
+      eng_atoms = get_cuis_eng_atom( auth_client , version , identifier )
+   finally:
+      ## Never leave the concept request running behind a failure
+      wait( [ concept_future ] )
+   concept = concept_future.result()
+   if( concept is None ):
+      negative_cache.add( namespace , CUI_NOT_FOUND , identifier )
+      return( None )
+   tuis = [ sem_type[ 'uri' ].split( '/' )[ -1 ]
+            for sem_type in concept.get( 'semanticTypes' , [] ) ]
+   return( ConceptBundle( name = concept[ 'name' ] ,
+                          tuis = tuis ,
+                          eng_atoms = eng_atoms ) )
+
 def get_typed_relation( auth_client , version , identifier , target_relation_type , target_relation_label ):
    log.debug( 'call to get_typed_relation( ... , {} , {} , {} )'.format( identifier , target_relation_type , target_relation_label ) )
-   current_page = 1
-   last_page = 1
-   auth_client = init_authentication( UMLS_API_TOKEN )
-   tgt = auth_client.gettgt()
-   uri = "https://uts-ws.nlm.nih.gov"
    content_endpoint = "/rest/content/current/CUI/"+str(identifier) + "/" + str(target_relation_type)
    ##log( '{}'.format( content_endpoint ) )
    cui_dict = {}
    ############################
-   while( current_page <= last_page ):
-      ##content_endpoint = "/rest/search/current?string=" + str(identifier) + "inputType=sourceUi&pageNumber=1"
-      ##ticket is the only parameter needed for this call - paging does not come into play because we're only asking for one Json object
-      query = { 'ticket' : auth_client.getst(tgt) , 'pageNumber' : current_page }
-      r = requests.get(uri+content_endpoint,params=query)
-      r.encoding = 'utf-8'
-      ##log( '{}'.format( r.text ) )
-      try:
-         items  = json.loads(r.text)
-      except ValueError as e :
-         current_page +=1
-         continue
-      if( 'error' in items ):
-         log.error( 'Query failed due to reported error:  {}'.format( items[ 'error' ] ) )
-         break
-      if( 'result' not in items ):
-         continue
-      jsonData = items[ "result" ]
+   for jsonData in page_results( uts_get_pages( auth_client , content_endpoint ) ):
       ##uncomment the print statment if you want the raw json output, or you can just look at the documentation :=)
       #https://documentation.uts.nlm.nih.gov/rest/concept/index.html#sample-output
       #https://documentation.uts.nlm.nih.gov/rest/source-asserted-identifiers/index.html#sample-output
-      ##log( '{}'.format( json.dumps(items, indent = 4) ) )
-      if( current_page == 1 ):
-         last_page = items[ "pageCount" ]
-         ##log( 'Page {} of {}'.format( current_page , last_page ) )
-      ##
       for inner_results in jsonData:
          relation_label = inner_results[ "relationLabel" ]
          ##log( '\t{}'.format( relation_label ) )
@@ -336,14 +808,19 @@ def get_typed_relation( auth_client , version , identifier , target_relation_typ
          cui_url = inner_results[ "relatedId" ]
          cui = cui_url.split( '/' )[ -1 ]
          cui_dict[ cui ] = name
-      current_page +=1
    return( cui_dict )
 
 def get_rbs( auth_client , version , identifier ):
    log.debug( 'call to get_rbs( ... , {} )'.format( identifier ) )
-   return( get_typed_relation( auth_client , version , identifier ,
-                               target_relation_type = 'relations' ,
-                               target_relation_label = 'RB' ) )
+   namespace = negative_namespace( auth_client )
+   if( negative_cache.contains( namespace , NO_RB_CHILDREN , identifier ) ):
+      return( {} )
+   rbs = get_typed_relation( auth_client , version , identifier ,
+                             target_relation_type = 'relations' ,
+                             target_relation_label = 'RB' )
+   if( len( rbs ) == 0 ):
+      negative_cache.add( namespace , NO_RB_CHILDREN , identifier )
+   return( rbs )
 
 def get_rns( auth_client , version , identifier ):
    log.debug( 'call to get_rns( ... , {} )'.format( identifier ) )
@@ -385,9 +862,10 @@ def get_all_snomed_descendants( auth_client , head_concept_id ,
    descendant_concept_ids = get_family_tree( auth_client , 'current' ,
                                              head_concept_id ,
                                              relation_type = 'children' )
+   descendant_cuis = get_cuis( auth_client , 'current' , descendant_concept_ids , 'SNOMEDCT_US' )
    include_list = []
    for descendant_concept_id in descendant_concept_ids:
-      descendant_cui = get_cui( auth_client , 'current' , descendant_concept_id , 'SNOMEDCT_US' )
+      descendant_cui = descendant_cuis[ descendant_concept_id ]
       if( descendant_cui in exclude_list ):
          continue
       include_list.append( descendant_cui )
@@ -417,10 +895,10 @@ def get_first_rxnorm_ancestors( auth_client , head_concept_id ):
                                               head_concept_id ,
                                               relation_type = 'ancestors' ,
                                               root_source = 'RXNORM' )
+    descendant_cuis = get_cuis( auth_client , 'current' , descendant_concept_ids , 'RXNORM' )
     include_list = []
     for descendant_concept_id in descendant_concept_ids:
-        descendant_cui = get_cui( auth_client , 'current' , descendant_concept_id , 'RXNORM' )
-        include_list.append( descendant_cui )
+        include_list.append( descendant_cuis[ descendant_concept_id ] )
     return include_list
 
 ########################################################################
@@ -428,13 +906,9 @@ def get_first_rxnorm_ancestors( auth_client , head_concept_id ):
 ########################################################################
 
 def get_rxcui_umls_cui( rxcui_str ):
-    base_uri = 'https://rxnav.nlm.nih.gov/REST/'
     content_endpoint = "rxcui/" + rxcui_str + "/property.json?propName=UMLSCUI"
-    ##log( '{}{}'.format( base_uri , content_endpoint ) )
-    #query = {'ticket':auth_client.getst(tgt)}
-    r = requests.get( base_uri + content_endpoint )#,params=query)
-    r.encoding = 'utf-8'
-    items  = json.loads(r.text)
+    ##log( '{}{}'.format( RXNAV_URI , content_endpoint ) )
+    items  = rxnav_get_json( content_endpoint )
     all_cuis = set()
     if( 'propConceptGroup' not in items or
         items[ 'propConceptGroup' ] is None or
@@ -450,18 +924,13 @@ def get_rxcui_umls_cui( rxcui_str ):
     return all_cuis
 
 def get_rxclass_members( rxclass_str ):
-    base_uri = 'https://rxnav.nlm.nih.gov/REST/'
     relaSrc = 'ATC'
     if( rxclass_str == 'D009294' ):
         relaSrc = 'MESH'
     ##
     content_endpoint = "rxclass/classMembers.json?classId=" + rxclass_str + "&relaSource=" + relaSrc
-    #log( '{}{}'.format( base_uri , content_endpoint ) )
-    #query = {'ticket':auth_client.getst(tgt)}
-    r = requests.get( base_uri + content_endpoint )#,params=query)
-    r.encoding = 'utf-8'
-    #log( '{}\n---------------\n'.format( r ) )
-    items  = json.loads(r.text)
+    #log( '{}{}'.format( RXNAV_URI , content_endpoint ) )
+    items  = rxnav_get_json( content_endpoint )
     all_cuis = set()
     groupData = items[ "drugMemberGroup" ][ "drugMember" ]
     ##log( '{}\n---------------\n{}'.format( items , groupData ) )
@@ -0,0 +1,339 @@
+import logging as log
+
+import os
+
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import parallel_utils
+
+########################################################################
+## Expanding head CUIs on several machines.  A coordinator deals its
+## heads out into tasks (shares of heads, as parallel_utils does for
+## local processes) in a SQLite file on a filesystem every machine can
+## see.  Workers anywhere claim a task under a lease, keep the lease
+## alive with a heartbeat while they walk its heads, and post back the
+## look-ups they recorded.  A worker that dies stops heartbeating, its
+## lease runs out and the next worker to look claims the task again.
+## The coordinator works tasks too until none are left, then merges
+## every posted recording and replays the serial walk over them, so the
+## output is the same as a run on one machine.
+##
+## Leases are compared against the clock of whichever machine is
+## looking, so keep them well above any clock skew between machines.
+##
+## The walk, its settings, the shares and the recorded look-ups are all
+## pickled into the file, and every worker and the coordinator unpickle
+## them.  Anyone who can write the queue file can run code on all of
+## them, so keep it where only the account running the jobs can write.
+## A new queue file is created readable and writable by its owner only.
+########################################################################
+
+## Seconds a claimed task stays leased without a heartbeat
+DEFAULT_LEASE_SECONDS = 120
+## Seconds between looks at the queue while other workers hold the
+## remaining tasks
+DEFAULT_POLL_SECONDS = 5
+## Claims of a task (leases run out or walks that raised) before it is
+## given up on.  The replay makes the look-ups of a failed task itself.
+DEFAULT_MAX_ATTEMPTS = 3
+
+#############################################
+##
+#############################################
+
+def default_worker_id():
+    return( '{}:{}'.format( socket.gethostname() , os.getpid() ) )
+
+
+class WorkQueue:
+    """
+    Tasks of one job in a SQLite file.  Each task is a pickled share of
+    heads that moves from 'pending' to 'leased' to 'done' (with its
+    pickled result) or, after too many attempts, 'failed'.
+    """
+
+    def __init__( self , filename ):
+        self.filename = filename
+        self._lock = threading.Lock()
+        ## Create the file for its owner only (see the trust note above)
+        if( not os.path.exists( filename ) ):
+            os.close( os.open( filename , os.O_CREAT | os.O_RDWR , 0o600 ) )
+        ## The default rollback journal rather than WAL, which needs
+        ## shared memory that network filesystems don't provide
+        self.conn = sqlite3.connect( filename , timeout = 60 ,
+                                     isolation_level = None ,
+                                     check_same_thread = False )
+        self.conn.execute( '''CREATE TABLE IF NOT EXISTS job (
+                                key TEXT PRIMARY KEY ,
+                                value BLOB )''' )
+        self.conn.execute( '''CREATE TABLE IF NOT EXISTS tasks (
+                                task_id INTEGER PRIMARY KEY ,
+                                payload BLOB NOT NULL ,
+                                state TEXT NOT NULL DEFAULT 'pending' ,
+                                worker TEXT ,
+                                lease TEXT ,
+                                lease_expires REAL ,
+                                attempts INTEGER NOT NULL DEFAULT 0 ,
+                                error TEXT ,
+                                result BLOB )''' )
+
+    def close( self ):
+        with self._lock:
+            self.conn.close()
+
+    def setting( self , key , default = None ):
+        row = self.conn.execute( 'SELECT value FROM job WHERE key = ?' ,
+                                 ( key , ) ).fetchone()
+        if( row is None ):
+            return( default )
+        return( pickle.loads( row[ 0 ] ) )
+
+    def post( self , walk , payloads ,
+              lease_seconds = DEFAULT_LEASE_SECONDS ,
+              max_attempts = DEFAULT_MAX_ATTEMPTS ):
+        """
+        Replace whatever the queue held with a new job:  `walk( payload )`
+        for each of `payloads`.  Returns the new job's id.
+        """
+        job_id = uuid.uuid4().hex
+        settings = { 'job_id' : job_id ,
+                     'walk' : walk ,
+                     'lease_seconds' : float( lease_seconds ) ,
+                     'max_attempts' : int( max_attempts ) }
+        with self._lock:
+            self.conn.execute( 'BEGIN IMMEDIATE' )
+            try:
+                self.conn.execute( 'DELETE FROM job' )
+                self.conn.execute( 'DELETE FROM tasks' )
+                self.conn.executemany( 'INSERT INTO job ( key , value ) VALUES ( ? , ? )' ,
+                                       [ ( key , pickle.dumps( value , protocol = pickle.HIGHEST_PROTOCOL ) )
+                                         for key , value in settings.items() ] )
+                self.conn.executemany( 'INSERT INTO tasks ( payload ) VALUES ( ? )' ,
+                                       [ ( pickle.dumps( payload , protocol = pickle.HIGHEST_PROTOCOL ) , )
+                                         for payload in payloads ] )
+                self.conn.execute( 'COMMIT' )
+            except Exception:
+                self.conn.execute( 'ROLLBACK' )
+                raise
+        return( job_id )
+
+    def claim( self , worker_id ):
+        """
+        Lease the next pending task (or one whose lease ran out).
+        Returns ( task_id , lease , job_id , payload ), or None if there
+        is nothing to claim right now.
+        """
+        with self._lock:
+            self.conn.execute( 'BEGIN IMMEDIATE' )
+            try:
+                now = time.time()
+                lease_seconds = self.setting( 'lease_seconds' , DEFAULT_LEASE_SECONDS )
+                ## Tasks that have used up their attempts aren't claimed
+                ## again
+                self.conn.execute( '''UPDATE tasks SET state = 'failed' ,
+                                        error = COALESCE( error , 'lease expired' )
+                                      WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?''' ,
+                                   ( now , self.setting( 'max_attempts' , DEFAULT_MAX_ATTEMPTS ) ) )
+                row = self.conn.execute( '''SELECT task_id , payload , state , worker FROM tasks
+                                            WHERE state = 'pending' OR ( state = 'leased' AND lease_expires < ? )
+                                            ORDER BY task_id LIMIT 1''' ,
+                                         ( now , ) ).fetchone()
+                if( row is None ):
+                    self.conn.execute( 'COMMIT' )
+                    return( None )
+                task_id , payload , state , previous_worker = row
+                if( state == 'leased' ):
+                    log.warning( 'The lease of {} on task {} ran out; claiming it again'.format( previous_worker ,
+                                                                                                task_id ) )
+                lease = uuid.uuid4().hex
+                self.conn.execute( '''UPDATE tasks SET state = 'leased' , worker = ? , lease = ? ,
+                                        lease_expires = ? , attempts = attempts + 1
+                                      WHERE task_id = ?''' ,
+                                   ( worker_id , lease , now + lease_seconds , task_id ) )
+                job_id = self.setting( 'job_id' )
+                self.conn.execute( 'COMMIT' )
+            except Exception:
+                self.conn.execute( 'ROLLBACK' )
+                raise
+        return( ( task_id , lease , job_id , pickle.loads( payload ) ) )
+
+    def heartbeat( self , task_id , lease ):
+        """
+        Extend a lease.  False once it has been lost to another worker.
+        """
+        with self._lock:
+            lease_seconds = self.setting( 'lease_seconds' , DEFAULT_LEASE_SECONDS )
+            cursor = self.conn.execute( '''UPDATE tasks SET lease_expires = ?
+                                           WHERE task_id = ? AND lease = ? AND state = 'leased' ''' ,
+                                        ( time.time() + lease_seconds , task_id , lease ) )
+        return( cursor.rowcount > 0 )
+
+    def complete( self , task_id , lease , result ):
+        """
+        Post a task's result.  False (and nothing posted) if the lease
+        was lost to another worker in the meantime.
+        """
+        blob = pickle.dumps( result , protocol = pickle.HIGHEST_PROTOCOL )
+        with self._lock:
+            cursor = self.conn.execute( '''UPDATE tasks SET state = 'done' , result = ? , lease_expires = NULL
+                                           WHERE task_id = ? AND lease = ? AND state = 'leased' ''' ,
+                                        ( blob , task_id , lease ) )
+        return( cursor.rowcount > 0 )
+
+    def release( self , task_id , lease , error ):
+        """
+        Give a task back after its walk failed, to be tried again unless
+        it is out of attempts
+        """
+        with self._lock:
+            self.conn.execute( '''UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END ,
+                                    error = ? , lease = NULL , lease_expires = NULL
+                                  WHERE task_id = ? AND lease = ? AND state = 'leased' ''' ,
+                               ( self.setting( 'max_attempts' , DEFAULT_MAX_ATTEMPTS ) ,
+                                 error , task_id , lease ) )
+
+    def counts( self ):
+        with self._lock:
+            rows = self.conn.execute( 'SELECT state , COUNT(*) FROM tasks GROUP BY state' ).fetchall()
+        return( dict( rows ) )
+
+    def settled( self ):
+        """
+        True once a job has been posted and none of its tasks are still
+        pending or leased
+        """
+        if( self.setting( 'job_id' ) is None ):
+            return( False )
+        counts = self.counts()
+        return( counts.get( 'pending' , 0 ) + counts.get( 'leased' , 0 ) == 0 )
+
+    def results( self ):
+        with self._lock:
+            rows = self.conn.execute( '''SELECT result FROM tasks WHERE state = 'done'
+                                         ORDER BY task_id''' ).fetchall()
+        for row in rows:
+            yield( pickle.loads( row[ 0 ] ) )
+
+
+class Heartbeat( threading.Thread ):
+    """
+    Keeps a lease alive in the background while its task is walked
+    """
+
+    def __init__( self , queue , task_id , lease ):
+        super().__init__( daemon = True )
+        self.queue = queue
+        self.task_id = task_id
+        self.lease = lease
+        self.every = queue.setting( 'lease_seconds' , DEFAULT_LEASE_SECONDS ) / 3.0
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run( self ):
+        while( not self.stopped.wait( self.every ) ):
+            if( not self.queue.heartbeat( self.task_id , self.lease ) ):
+                self.lost = True
+                return
+
+    def stop( self ):
+        self.stopped.set()
+        self.join()
+
+#############################################
+##
+#############################################
+
+def serve( queue , engine , install ,
+           worker_id = None ,
+           poll_seconds = None ):
+    """
+    Claim and walk tasks from `queue`, with `install( engine )` routing
+    look-ups through a recording engine, until every task of the posted
+    job is done or failed.  Waits for a job to be posted if there isn't
+    one yet.  Returns the number of tasks this worker completed.
+    """
+    if( worker_id is None ):
+        worker_id = default_worker_id()
+    if( poll_seconds is None ):
+        poll_seconds = DEFAULT_POLL_SECONDS
+    recorder = parallel_utils.MemoEngine( engine )
+    install( recorder )
+    walks = {}
+    completed = 0
+    try:
+        while( True ):
+            task = queue.claim( worker_id )
+            if( task is None ):
+                if( queue.settled() ):
+                    break
+                time.sleep( poll_seconds )
+                continue
+            task_id , lease , job_id , share = task
+            if( job_id not in walks ):
+                walks = { job_id : queue.setting( 'walk' ) }
+            heartbeat = Heartbeat( queue , task_id , lease )
+            heartbeat.start()
+            try:
+                walks[ job_id ]( share )
+            except Exception as e:
+                log.error( 'Task {} failed on {}:  {}'.format( task_id , worker_id , e ) )
+                queue.release( task_id , lease , repr( e ) )
+                continue
+            finally:
+                heartbeat.stop()
+            ## Look-ups answered from earlier tasks were posted with
+            ## those tasks
+            if( queue.complete( task_id , lease , recorder.take_recorded() ) ):
+                completed += 1
+            else:
+                log.warning( 'Task {} was claimed by another worker before {} finished it'.format( task_id ,
+                                                                                                  worker_id ) )
+    finally:
+        install( engine )
+    log.info( '{} completed {} tasks ({} look-ups made, {} answered from earlier tasks)'.format( worker_id ,
+                                                                                               completed ,
+                                                                                               recorder.misses ,
+                                                                                               recorder.hits ) )
+    return( completed )
+
+
+def serve_file( queue_file , engine , install , worker_id = None ):
+    queue = WorkQueue( queue_file )
+    try:
+        return( serve( queue , engine , install , worker_id = worker_id ) )
+    finally:
+        queue.close()
+
+
+def distribute( engine , heads , workers , walk , install , queue_file ,
+                lease_seconds = DEFAULT_LEASE_SECONDS ):
+    """
+    Post shares of `heads` to the queue in `queue_file` as tasks of
+    `walk( share )` (leased for `lease_seconds` at a time), work on them
+    alongside any workers serving the same file, and return a
+    MemoEngine over `engine` holding every look-up they recorded
+    """
+    memo = {}
+    heads = list( heads )
+    queue = WorkQueue( queue_file )
+    try:
+        queue.post( walk , parallel_utils.shares( heads , workers ) ,
+                    lease_seconds = lease_seconds ,
+                    max_attempts = DEFAULT_MAX_ATTEMPTS )
+        serve( queue , engine , install ,
+               worker_id = 'coordinator@{}'.format( default_worker_id() ) )
+        for recorded in queue.results():
+            for key , value in recorded.items():
+                memo.setdefault( key , value )
+        counts = queue.counts()
+    finally:
+        queue.close()
+    if( counts.get( 'failed' , 0 ) > 0 ):
+        log.warning( '{} tasks failed; their look-ups will be made during the replay'.format( counts[ 'failed' ] ) )
+    log.info( 'Workers recorded {} look-ups for {} heads'.format( len( memo ) , len( heads ) ) )
+    return( parallel_utils.MemoEngine( engine , memo ) )